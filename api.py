@@ -0,0 +1,418 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import re
+import secrets
+from urllib.parse import parse_qs, urlsplit
+
+import db
+import image_store
+import surveys
+import tiles
+import write_queue
+from validation import ValidationError
+
+
+logger = logging.getLogger(__name__)
+
+# Address the API listens on by default, next to Streamlit's 8501
+API_HOST = os.environ.get("BUILDING_SURVEY_API_HOST", "127.0.0.1")
+API_PORT = int(os.environ.get("BUILDING_SURVEY_API_PORT", 8502))
+
+# Bearer token required by the reviewer endpoints (queue listing, reviews and photos
+# added to existing surveys). When unset those endpoints are refused; survey
+# submission stays open like the form.
+API_TOKEN = os.environ.get("BUILDING_SURVEY_API_TOKEN")
+
+# Key of the upload tokens handed out with each accepted survey, with which its
+# submitter attaches the photos without the reviewer token. When unset a random key
+# is drawn at startup, so tokens last until the API restarts; set it to keep them
+# valid across restarts and between several API processes.
+UPLOAD_SECRET = os.environ.get("BUILDING_SURVEY_UPLOAD_SECRET")
+
+# Largest request body accepted, enough for a full-resolution phone photo
+MAX_BODY = 32 * 1024 * 1024
+
+# Seconds an idle keep-alive connection is held open
+KEEP_ALIVE = 15
+
+REASONS = {200: "OK", 201: "Created", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
+           404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 411: "Length Required", 413: "Payload Too Large",
+           500: "Internal Server Error", 502: "Bad Gateway"}
+
+# Browsers keep served tiles this many seconds before asking again
+TILE_MAX_AGE = 7 * 24 * 3600
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, errors=None):
+        super().__init__(message)
+        self.status = status
+        self.body = {"error": message, **({"errors": errors} if errors else {})}
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = parse_qs(url.query)
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        try:
+            data = json.loads(self.body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "body must be JSON")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "body must be a JSON object")
+        return data
+
+    def arg(self, name, default=None):
+        values = self.query.get(name)
+        return values[-1] if values else default
+
+
+class SurveyAPI:
+    """Routes requests to the shared write path. Database and image work blocks, so
+    it runs on the default thread pool while the event loop keeps accepting requests.
+
+    With a write queue, submissions are answered 202 with a ticket as soon as they
+    are journaled, and GET /submissions/<ticket> reports when they are persisted.
+    With a tile cache, GET /tiles/<z>/<x>/<y>.png serves the app's basemap. The
+    app's maps only use it once BUILDING_SURVEY_TILE_URL is set to the public
+    address of this route; until then they load OpenStreetMap directly.
+
+    Handlers return (status, body) where a dict body is sent as JSON, or
+    (status, bytes, headers) for anything else.
+    """
+
+    def __init__(self, pool, store, token=API_TOKEN, queue=None, tile_cache=None, upload_secret=UPLOAD_SECRET):
+        self.pool = pool
+        self.store = store
+        self.token = token
+        self.queue = queue
+        self.tile_cache = tile_cache
+        self.upload_secret = (upload_secret or secrets.token_hex(32)).encode()
+        self.routes = [
+            ("POST", re.compile(r"/surveys"), self.post_survey),
+            ("POST", re.compile(r"/surveys/(\d+)/photos/(\w+)"), self.post_survey_photo),
+            ("GET", re.compile(r"/queue"), self.get_queue),
+            ("POST", re.compile(r"/claims"), self.post_claims),
+            ("GET", re.compile(r"/claims"), self.get_claims),
+            ("DELETE", re.compile(r"/claims/(\d+)"), self.delete_claim),
+            ("POST", re.compile(r"/surveys/(\d+)/reviews"), self.post_review),
+            ("POST", re.compile(r"/reviews/(\d+)/photos/(\w+)"), self.post_review_photo),
+            ("GET", re.compile(r"/submissions/(\w+)"), self.get_submission),
+            ("GET", re.compile(r"/tiles/(\d+)/(\d+)/(\d+)\.png"), self.get_tile),
+        ]
+
+    async def handle(self, request):
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = pattern.fullmatch(request.path)
+            if match:
+                allowed = True
+                if method == request.method:
+                    return await handler(request, *match.groups())
+        raise HTTPError(405 if allowed else 404, "method not allowed" if allowed else "not found")
+
+    def _authorize(self, request):
+        if not self.token:
+            raise HTTPError(403, "reviewer endpoints are disabled; set BUILDING_SURVEY_API_TOKEN")
+        supplied = request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(supplied.encode(), self.token.encode()):
+            raise HTTPError(401, "invalid or missing bearer token")
+
+    # Function to return the token that lets the submitter of a survey attach its photos
+    def upload_token(self, survey_id):
+        return hmac.new(self.upload_secret, str(survey_id).encode(), hashlib.sha256).hexdigest()
+
+    def _authorize_upload(self, request, survey_id):
+        supplied = request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(supplied.encode(), self.upload_token(survey_id).encode()):
+            self._authorize(request)
+
+    async def _run(self, func, *args, **kwargs):
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        except ValidationError as e:
+            raise HTTPError(400, "invalid record", e.errors)
+        except surveys.NotFound as e:
+            raise HTTPError(404, str(e))
+        except surveys.Claimed as e:
+            raise HTTPError(409, str(e))
+
+    # POST /surveys with the survey form answers as JSON -> {"id", "duplicate_of",
+    # "upload_token"}. The upload token is the bearer token for the survey's photos.
+    async def post_survey(self, request):
+        if self.queue is not None:
+            return 202, {"ticket": await self._run(self.queue.submit_survey, request.json())}
+        survey_id, duplicate_of = await self._run(surveys.submit_survey, self.pool, self.store, request.json())
+        return 201, {"id": survey_id, "duplicate_of": duplicate_of, "upload_token": self.upload_token(survey_id)}
+
+    # POST /surveys/<id>/photos/<image type> with the image file as the body. Needs the
+    # survey's upload token or the reviewer token: otherwise anyone could attach
+    # photos to any survey.
+    async def post_survey_photo(self, request, survey_id, image_type):
+        self._authorize_upload(request, int(survey_id))
+        return await self._post_photo("survey_images", int(survey_id), image_type, request)
+
+    # Function to read the queue filters and sort order of db.fetch_queue_page from the
+    # query string. Lists accept repeated parameters; with a reviewer, listings
+    # claimed by other reviewers are left out. Returns (filters, sort).
+    def _queue_filters(self, request):
+        filters = {"collapse_duplicates": request.arg("collapse_duplicates", "1") not in ("0", "false"),
+                   "any_hazard": request.arg("any_hazard", "0") not in ("0", "false"),
+                   "use_types": request.query.get("use_type", []),
+                   "importance_categories": request.query.get("importance_category", []),
+                   "reviewer": request.arg("reviewer")}
+        sort = request.arg("sort", "Newest first")
+        if sort not in db.QUEUE_SORTS:
+            raise HTTPError(400, f"sort must be one of {', '.join(db.QUEUE_SORTS)}")
+        try:
+            for key in ("year_min", "year_max", "floors_min", "floors_max"):
+                if request.arg(key) is not None:
+                    filters[key] = int(request.arg(key))
+        except ValueError:
+            raise HTTPError(400, "year_* and floors_* must be integers")
+        return filters, sort
+
+    def _refresh_scores(self, sort):
+        if db.QUEUE_SORTS[sort][0] == "priority_score":
+            # Imported here so serving the API does not require pandas
+            import scoring
+
+            scoring.refresh(self.pool)
+
+    # GET /queue?sort=&after=&limit=&reviewer= plus the filters of
+    # db.fetch_queue_page. The cursor is the "next" value of the previous page.
+    async def get_queue(self, request):
+        self._authorize(request)
+        filters, sort = self._queue_filters(request)
+        try:
+            limit = max(1, min(int(request.arg("limit", db.QUEUE_PAGE_SIZE)), 500))
+            after = json.loads(request.arg("after")) if request.arg("after") else None
+            # Every sort key is numeric or NULL and the tiebreak is the survey id
+            if after is not None and not (isinstance(after, list) and len(after) == 2
+                                          and (after[0] is None or type(after[0]) in (int, float))
+                                          and type(after[1]) is int):
+                raise ValueError(after)
+        except ValueError:
+            raise HTTPError(400, "limit must be an integer and after a cursor")
+
+        def page():
+            self._refresh_scores(sort)
+            with self.pool.connection() as conn:
+                rows, cursor = db.fetch_queue_page(conn, filters, sort, after, limit)
+                return db.count_queue(conn, filters), rows, cursor
+
+        total, rows, cursor = await self._run(page)
+        columns = db.QUEUE_COLUMNS + ("duplicates",)
+        return 200, {"total": total, "items": [dict(zip(columns, row)) for row in rows],
+                     "next": json.dumps(cursor) if cursor else None}
+
+    # POST /claims with {"reviewer", "count"} and the queue parameters of GET /queue
+    # -> {"claims": [{"survey_id", "expires_at"}]}, every listing the reviewer holds
+    async def post_claims(self, request):
+        self._authorize(request)
+        body = request.json()
+        reviewer = body.get("reviewer")
+        if not isinstance(reviewer, str) or not reviewer.strip():
+            raise HTTPError(400, "reviewer is required")
+        count = body.get("count", db.CLAIM_BATCH)
+        if not isinstance(count, int) or not 1 <= count <= 100:
+            raise HTTPError(400, "count must be an integer from 1 to 100")
+        filters, sort = self._queue_filters(request)
+
+        def claim():
+            self._refresh_scores(sort)
+            with self.pool.transaction() as conn:
+                return db.claim_next(conn, reviewer.strip(), filters, sort, count)
+
+        return 200, {"claims": _claims(await self._run(claim))}
+
+    # GET /claims?reviewer= -> {"claims": [{"survey_id", "expires_at"}]}
+    async def get_claims(self, request):
+        self._authorize(request)
+        if not request.arg("reviewer"):
+            raise HTTPError(400, "reviewer is required")
+
+        def claims():
+            with self.pool.connection() as conn:
+                return db.fetch_claims(conn, request.arg("reviewer"))
+
+        return 200, {"claims": _claims(await self._run(claims))}
+
+    # DELETE /claims/<survey id>?reviewer= -> {"released"}, handing a listing back
+    async def delete_claim(self, request, survey_id):
+        self._authorize(request)
+        if not request.arg("reviewer"):
+            raise HTTPError(400, "reviewer is required")
+
+        def release():
+            with self.pool.transaction() as conn:
+                return db.release_claim(conn, int(survey_id), request.arg("reviewer"))
+
+        return 200, {"released": await self._run(release)}
+
+    # POST /surveys/<id>/reviews?reviewer= with the review form answers as JSON ->
+    # {"id"}. Submitting again replaces the review; a listing claimed by another
+    # reviewer is refused with 409.
+    async def post_review(self, request, survey_id):
+        self._authorize(request)
+        reviewer = request.arg("reviewer")
+        if self.queue is not None:
+            return 202, {"ticket": await self._run(self.queue.submit_review, int(survey_id), request.json(),
+                                                   reviewer=reviewer)}
+        review_id = await self._run(surveys.submit_review, self.pool, self.store, int(survey_id), request.json(),
+                                    reviewer=reviewer)
+        return 201, {"id": review_id}
+
+    # POST /reviews/<id>/photos/<image type> with the image file as the body
+    async def post_review_photo(self, request, review_id, image_type):
+        self._authorize(request)
+        return await self._post_photo("review_images", int(review_id), image_type, request)
+
+    # GET /submissions/<ticket> -> {"status": pending|done|failed, "kind", "result",
+    # "error"}, plus the "upload_token" of a saved survey
+    async def get_submission(self, request, ticket):
+        if self.queue is None:
+            raise HTTPError(404, "submissions are written immediately; there is no queue")
+        status = await self._run(self.queue.status, ticket)
+        if status is None:
+            raise HTTPError(404, f"unknown ticket {ticket}")
+        if status["status"] == write_queue.DONE and status["kind"] == "survey":
+            status["upload_token"] = self.upload_token(status["result"])
+        return 200, status
+
+    # GET /tiles/<z>/<x>/<y>.png -> the PNG tile, from the cache or the upstream
+    async def get_tile(self, request, z, x, y):
+        if self.tile_cache is None:
+            raise HTTPError(404, "the tile cache is disabled")
+        z, x, y = int(z), int(x), int(y)
+        if not tiles.valid_tile(z, x, y):
+            raise HTTPError(404, f"no tile {z}/{x}/{y}")
+        data = await self._run(self.tile_cache.get, z, x, y)
+        if data is None:
+            raise HTTPError(502, "the tile is not cached and the upstream did not provide it")
+        return 200, data, {"Content-Type": "image/png", "Cache-Control": f"public, max-age={TILE_MAX_AGE}"}
+
+    async def _post_photo(self, table, owner_id, image_type, request):
+        if not request.body:
+            raise HTTPError(400, "body must be the image file")
+        ordinal, image_hash = await self._run(surveys.add_photo, self.pool, self.store, table, owner_id,
+                                              image_type, io.BytesIO(request.body))
+        return 201, {"ordinal": ordinal, "hash": image_hash}
+
+
+def _claims(rows):
+    return [{"survey_id": survey_id, "expires_at": expires_at} for survey_id, expires_at in rows]
+
+
+async def read_request(reader):
+    line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE)
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if "chunked" in headers.get("transfer-encoding", ""):
+        raise HTTPError(411, "chunked bodies are not supported; send Content-Length")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPError(400, "Content-Length must be an integer")
+    if length < 0:
+        raise HTTPError(400, "Content-Length must not be negative")
+    if length > MAX_BODY:
+        raise HTTPError(413, f"body larger than {MAX_BODY} bytes")
+    body = await reader.readexactly(length) if length else b""
+    request = Request(method.upper(), target, headers, body)
+    request.keep_alive = (headers.get("connection", "").lower() != "close"
+                          if version == "HTTP/1.1" else headers.get("connection", "").lower() == "keep-alive")
+    return request
+
+
+def write_response(writer, status, body, keep_alive, headers=None):
+    if isinstance(body, bytes):
+        data = body
+    else:
+        data, headers = json.dumps(body).encode(), {"Content-Type": "application/json"}
+    head = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n{head}"
+                 f"Content-Length: {len(data)}\r\n"
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data)
+
+
+# Function to serve one client connection, answering requests until it closes
+async def serve_client(api, reader, writer):
+    try:
+        while True:
+            request = None
+            try:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                status, body, *headers = await api.handle(request)
+                keep_alive = request.keep_alive
+            except HTTPError as e:
+                status, body, keep_alive, headers = e.status, e.body, False, []
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                break
+            except Exception:
+                # The details stay in the server log; clients get a fixed message
+                logger.exception("Unhandled error answering %s",
+                                 f"{request.method} {request.path}" if request else "a request")
+                status, body, keep_alive, headers = 500, {"error": "internal server error"}, False, []
+            write_response(writer, status, body, keep_alive, *headers)
+            await writer.drain()
+            if not keep_alive:
+                break
+    finally:
+        writer.close()
+
+
+async def serve(pool, store, host=API_HOST, port=API_PORT, token=API_TOKEN, queue=None, tile_cache=None):
+    api = SurveyAPI(pool, store, token, queue, tile_cache)
+    server = await asyncio.start_server(lambda r, w: serve_client(api, r, w), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the survey HTTP API next to the Streamlit app.")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--db", default=db.DB_PATH, help="path of the survey database")
+    parser.add_argument("--store", default=image_store.IMAGE_STORE_DIR, help="root directory of the image store")
+    parser.add_argument("--write-behind", action="store_true", default=write_queue.WRITE_BEHIND,
+                        help="journal submissions and write them in batches from a background writer")
+    parser.add_argument("--queue-db", default=write_queue.QUEUE_DB_PATH, help="path of the submission journal")
+    parser.add_argument("--tile-cache", default=tiles.TILE_DB_PATH, help="MBTiles file the basemap tiles are cached in")
+    parser.add_argument("--no-tiles", action="store_true", help="do not serve the basemap tiles")
+    args = parser.parse_args(argv)
+
+    pool, store = db.get_pool(args.db), image_store.ImageStore(args.store)
+    queue = write_queue.get_queue(pool, store, args.queue_db) if args.write_behind else None
+    tile_cache = None if args.no_tiles else tiles.get_cache(args.tile_cache)
+    print(f"Serving the survey API on http://{args.host}:{args.port}")
+    asyncio.run(serve(pool, store, args.host, args.port, queue=queue, tile_cache=tile_cache))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import streamlit as st
+
+import db
+import image_store
+import profiling
+
+
+# Process-wide resources shared by every page of the app. Streamlit keys its caches on
+# the function, so each page importing these gets the same pool and store.
+
+# Initialize SQLite database once per process; every session shares the pool
+@st.cache_resource
+def get_pool():
+    return db.get_pool()
+
+
+@st.cache_resource
+def get_store():
+    return image_store.get_store()
+
+
+# Function to load one stored photo, falling back to the BLOB of rows not yet moved to the image store
+@profiling.timed
+def load_image(table, image_id, image_hash, thumbnail=False):
+    if image_hash:
+        return get_store().read(image_hash, thumbnail)
+    with get_pool().connection() as conn:
+        return db.fetch_image_blob(conn, table, image_id)
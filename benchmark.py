@@ -0,0 +1,439 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import db
+import image_store
+import importer
+import reports
+import spatial
+import stats
+import survey_options
+import surveys
+
+
+# Survey counts benchmarked by default
+SIZES = (1000, 10000, 100000)
+
+# File every run is appended to, one JSON object per case
+RESULTS_PATH = "bench_results.jsonl"
+
+# Timed runs per case, after one untimed warm-up run
+REPEAT = 20
+
+# Share of surveys with a completed review, and with an unfinished draft review
+REVIEWED_SHARE = 0.3
+DRAFT_SHARE = 0.05
+
+# Distinct synthetic photos generated per database; surveys reuse them, as the
+# content-addressed store would for repeated uploads
+PHOTO_POOL = 24
+
+# Size of the synthetic camera photos, in pixels
+PHOTO_SIZE = (4000, 3000)
+
+# Population centres surveys cluster around, as (lat, lon, weight); the rest are
+# spread uniformly over spatial.DEFAULT_BOUNDS
+CITIES = [(37.98, 23.73, 0.35), (40.64, 22.94, 0.15), (38.25, 21.73, 0.05), (35.34, 25.13, 0.05),
+          (39.64, 22.42, 0.04), (39.36, 22.94, 0.03), (36.43, 28.22, 0.03)]
+
+# Relative frequency of each answer, in the order of the option lists of the form
+WEIGHTS = {
+    "use_type": [70, 8, 6, 12, 4],
+    "num_users": [60, 32, 8],
+    "importance_category": [15, 60, 20, 5],
+    "danger_falling": [80, 20],
+    "structure_condition": [75, 25],
+    "vertical_damage": [85, 15],
+    "danger_impact": [85, 15],
+    "soft_floor": [70, 30],
+    "short_column": [90, 10],
+}
+
+# Modules stapp.py imports at the top: what every visitor of the public form pays
+# for. Third-party ones come first; whatever they load themselves is not our doing.
+PUBLIC_PAGE_DEPENDENCIES = ("streamlit", "folium", "folium.plugins", "streamlit_folium")
+PUBLIC_PAGE_MODULES = ("app_resources", "db", "export", "image_store", "profiling", "spatial", "stats",
+                       "survey_options", "surveys", "tiles", "write_queue", "validation")
+
+# Modules only the admin dashboard or photo handling need; the app's own modules
+# must not load them for the public form
+ADMIN_ONLY_MODULES = ("pandas", "matplotlib", "PIL", "pyarrow")
+
+# Most a fresh interpreter may spend importing PUBLIC_PAGE_MODULES, in milliseconds
+STARTUP_BUDGET_MS = 2000
+
+# Most the app's own modules may add on top of their dependencies, and a rerun may
+# spend on imports. These hold on slow CI machines too, since they leave out the cost
+# of importing streamlit itself.
+OWN_STARTUP_BUDGET_MS = 250
+RERUN_BUDGET_MS = 50
+
+# Runs in a fresh interpreter: imports the modules twice, the second time standing
+# in for a Streamlit rerun, and reports which admin-only modules the app's own
+# modules brought along
+_STARTUP_SCRIPT = """
+import importlib, json, sys, time
+dependencies, own, watched = (arg.split(",") for arg in sys.argv[1:4])
+modules, missing = dependencies + own, []
+start = time.perf_counter()
+for name in modules:
+    if name == own[0]:
+        baseline, own_start = set(sys.modules), time.perf_counter()
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        missing.append(name)
+cold = time.perf_counter() - start
+own_cold = time.perf_counter() - own_start
+start = time.perf_counter()
+for name in modules:
+    if name not in missing:
+        importlib.import_module(name)
+rerun = time.perf_counter() - start
+print(json.dumps({"cold_ms": cold * 1000, "own_ms": own_cold * 1000, "rerun_ms": rerun * 1000, "missing": missing,
+                  "loaded": [name for name in watched if name in sys.modules and name not in baseline]}))
+"""
+
+SURVEY_PHOTO_COLUMNS = dict(zip(survey_options.HAZARD_COLUMNS, survey_options.SURVEY_IMAGE_TYPES))
+
+
+def _has_pillow():
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# Function to make a camera-like JPEG: smooth gradients with sensor noise, so it
+# compresses like a real photo rather than like a flat colour or pure noise
+def synthetic_photo(rng, size=PHOTO_SIZE):
+    from PIL import Image, ImageFilter
+
+    small = Image.new("RGB", (size[0] // 50, size[1] // 50))
+    small.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+                   for _ in range(small.width * small.height)])
+    img = small.resize(size, Image.BICUBIC).filter(ImageFilter.GaussianBlur(4))
+    noise = Image.effect_noise(size, 24).convert("RGB")
+    img = Image.blend(img, noise, 0.15)
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG", quality=88)
+    return buffered.getvalue()
+
+
+def _choice(rng, column):
+    options = {"use_type": survey_options.USE_TYPES, "num_users": survey_options.NUM_USERS,
+               "importance_category": survey_options.IMPORTANCE_CATEGORIES,
+               "structure_condition": survey_options.STRUCTURE_CONDITIONS}.get(column, survey_options.YES_NO)
+    return rng.choices(options, WEIGHTS[column])[0]
+
+
+def synthetic_location(rng):
+    if rng.random() < sum(weight for _, _, weight in CITIES):
+        lat, lon, _ = rng.choices(CITIES, [weight for _, _, weight in CITIES])[0]
+        return lat + rng.gauss(0, 0.05), lon + rng.gauss(0, 0.05)
+    south, west, north, east = spatial.DEFAULT_BOUNDS
+    return rng.uniform(south, north), rng.uniform(west, east)
+
+
+def synthetic_survey(rng):
+    lat, lon = synthetic_location(rng)
+    survey = {column: _choice(rng, column) for column in WEIGHTS}
+    survey.update(latitude=lat, longitude=lon, num_floors=min(int(rng.expovariate(1 / 3)) + 1, 30),
+                  year_construction=int(min(max(rng.gauss(1975, 20), survey_options.MIN_YEAR),
+                                            survey_options.MAX_YEAR)))
+    return survey
+
+
+def synthetic_review(rng):
+    return {"structural_system": rng.choice(survey_options.STRUCTURAL_SYSTEMS),
+            "arrangement_walls": rng.choice(survey_options.YES_NO),
+            "irregular_vertical": rng.choice(survey_options.YES_NO),
+            "irregular_horizontal": rng.choice(survey_options.YES_NO),
+            "torsion_rotation": rng.choice(survey_options.YES_NO),
+            "structural_vulnerabilities": ",".join(rng.sample(survey_options.STRUCTURAL_VULNERABILITIES,
+                                                              rng.randint(0, 2))),
+            "heavy_finishes": rng.choice(survey_options.YES_NO), "input_quality": rng.randint(1, 5),
+            "soil_class": rng.choice(survey_options.SOIL_CLASSES),
+            "load_capacity_reduction": rng.choice(survey_options.LOAD_CAPACITY_REDUCTIONS),
+            "constructed_area": round(rng.uniform(60, 2000)), "structure_performance": "",
+            "retrofitting_methods": ",".join(rng.sample(survey_options.RETROFITTING_METHODS, rng.randint(0, 2)))}
+
+
+# Function to build a synthetic database of ``count`` surveys at ``path`` with an
+# image store under ``store_dir``. Hazards answered Yes get one to three photos when
+# Pillow is installed. Returns the number of photo rows written.
+def generate(path, store_dir, count, seed=0, batch_size=importer.BATCH_SIZE):
+    rng = random.Random(seed)
+    pool = db.get_pool(path)
+    store = image_store.ImageStore(store_dir)
+    hashes = []
+    if _has_pillow():
+        import ingest
+
+        hashes = [store.put(*ingest.process_image(io.BytesIO(synthetic_photo(rng))))
+                  for _ in range(PHOTO_POOL)]
+    photo_rows = 0
+    for start in range(0, count, batch_size):
+        batch = [synthetic_survey(rng) for _ in range(min(batch_size, count - start))]
+        images = {}
+        for index, survey in enumerate(batch):
+            rows = [(img_type, ordinal, rng.choice(hashes))
+                    for column, img_type in SURVEY_PHOTO_COLUMNS.items()
+                    if hashes and survey[column] == survey_options.HAZARD_COLUMNS[column]
+                    for ordinal in range(rng.randint(1, 3))]
+            if rows:
+                images[index] = rows
+                photo_rows += len(rows)
+        with pool.transaction() as conn:
+            ids = importer.insert_batch(conn, batch, images)
+            for survey_id in ids:
+                draw = rng.random()
+                if draw < REVIEWED_SHARE + DRAFT_SHARE:
+                    db.insert_review(conn, dict(synthetic_review(rng), survey_id=survey_id,
+                                                reviewed=draw < REVIEWED_SHARE), [])
+    return photo_rows
+
+
+def _time(func, repeat):
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+# Function to build the benchmark cases of one database as {name: callable}. Each
+# mirrors what the Streamlit page does for that step, without the rendering.
+def cases(pool, store, rng):
+    with pool.connection() as conn:
+        max_id = conn.execute("SELECT MAX(id) FROM survey_data").fetchone()[0]
+        photographed = [row[0] for row in conn.execute("SELECT DISTINCT survey_id FROM survey_images LIMIT 200")]
+    filters = {"collapse_duplicates": True}
+    targets = photographed or list(range(1, max_id + 1))
+
+    def queue_first_page():
+        with pool.connection() as conn:
+            db.count_queue(conn, filters)
+            db.fetch_queue_page(conn, filters, "Newest first")
+
+    def queue_filtered_page():
+        with pool.connection() as conn:
+            page_filters = dict(filters, use_types=["Residential"], any_hazard=True)
+            db.count_queue(conn, page_filters)
+            rows, cursor = db.fetch_queue_page(conn, page_filters, "Oldest buildings first")
+            db.fetch_queue_page(conn, page_filters, "Oldest buildings first", cursor)
+
+    def review_listing():
+        survey_id = rng.choice(targets)
+        with pool.connection() as conn:
+            db.fetch_survey(conn, survey_id)
+            images = db.fetch_survey_images(conn, survey_id)
+            db.fetch_duplicates(conn, survey_id)
+        for photos in images.values():
+            for _, image_hash in photos[:4]:
+                store.read(image_hash, thumbnail=True)
+
+    def data_visualization():
+        with pool.connection() as conn:
+            data = stats.load(conn)
+        if charts is not None:
+            charts.render_bar_chart(list(data["use_type"]), list(data["use_type"].values()), "Use type",
+                                    "Buildings by use type")
+
+    def queue_priority_page():
+        if scoring is not None:
+            scoring.refresh(pool)
+        with pool.connection() as conn:
+            db.fetch_queue_page(conn, filters, "Highest priority first")
+
+    def rescore_all():
+        with pool.transaction() as conn:
+            conn.execute("UPDATE survey_data SET score_version = NULL")
+        scoring.refresh(pool)
+
+    # Reports of the first 500 reviewed buildings, worker start-up included
+    def batch_reports():
+        with pool.connection() as conn:
+            survey_ids = db.fetch_reviewed_survey_ids(conn)[:500]
+        reports.generate_reports(pool, store, survey_ids, io.BytesIO())
+
+    def overview_map():
+        with pool.connection() as conn:
+            spatial.markers_in_view(conn, spatial.DEFAULT_BOUNDS, 6)
+
+    submission = {"latitude": 38.0, "longitude": 23.7, "use_type": "Residential", "num_users": "0-10",
+                  "importance_category": "Σ2", "danger_falling": "Yes", "num_floors": 3,
+                  "structure_condition": "No", "year_construction": 1985, "vertical_damage": "No",
+                  "danger_impact": "No", "soft_floor": "No", "short_column": "No"}
+
+    def full_submission():
+        uploads = {"falling_photo": [io.BytesIO(photo), io.BytesIO(photo)]} if photo else {}
+        surveys.submit_survey(pool, store, dict(submission, latitude=38.0 + rng.uniform(-0.5, 0.5)), uploads)
+
+    try:
+        import charts
+    except ImportError:
+        charts = None
+    try:
+        import scoring
+    except ImportError:
+        scoring = None
+    photo = synthetic_photo(rng) if _has_pillow() else None
+
+    found = {"queue_first_page": queue_first_page, "queue_filtered_page": queue_filtered_page,
+             "review_listing": review_listing, "data_visualization": data_visualization,
+             "queue_priority_page": queue_priority_page, "overview_map": overview_map,
+             "full_submission": full_submission, "batch_reports": batch_reports}
+    if scoring is not None:
+        found["rescore_all"] = rescore_all
+    if photo:
+        import ingest
+
+        found["resize_image"] = lambda: ingest.process_image(io.BytesIO(photo))
+    return found
+
+
+# Function to time the imports of the public form in fresh interpreters. Returns
+# (cold start timings, timings of the app's own modules, rerun timings, modules not
+# installed, admin-only modules loaded).
+def measure_startup(repeat=5):
+    cold, own, rerun, missing, loaded = [], [], [], [], set()
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT, ",".join(PUBLIC_PAGE_DEPENDENCIES),
+                               ",".join(PUBLIC_PAGE_MODULES), ",".join(ADMIN_ONLY_MODULES)], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = json.loads(proc.stdout)
+        cold.append(result["cold_ms"])
+        own.append(result["own_ms"])
+        rerun.append(result["rerun_ms"])
+        missing = result["missing"]
+        loaded.update(result["loaded"])
+    return cold, own, rerun, missing, sorted(loaded)
+
+
+# Function to list what is wrong with the public form's startup: admin-only modules
+# pulled in by the app's imports, or a cold start over STARTUP_BUDGET_MS
+def check_startup(repeat=5, budget=STARTUP_BUDGET_MS):
+    cold, own, _, missing, loaded = measure_startup(repeat)
+    problems = [f"{name} is imported by the public form" for name in loaded]
+    if statistics.median(cold) > budget:
+        problems.append(f"cold start took {statistics.median(cold):.0f} ms, over the {budget} ms budget")
+    if statistics.median(own) > OWN_STARTUP_BUDGET_MS:
+        problems.append(f"the app's own modules took {statistics.median(own):.0f} ms to import, "
+                        f"over the {OWN_STARTUP_BUDGET_MS} ms budget")
+    if missing:
+        print(f"Not installed, so not measured: {', '.join(missing)}")
+    return problems
+
+
+# Function to check that no hot query regressed to a full scan, on a generated
+# database of ``rows`` surveys. Returns the list of problems found.
+def check_plans(rows=1000, seed=0):
+    workdir = tempfile.mkdtemp(prefix="survey-plans-")
+    try:
+        path = os.path.join(workdir, "plans.db")
+        generate(path, os.path.join(workdir, "images"), rows, seed)
+        pool = db.get_pool(path)
+        with pool.connection() as conn:
+            problems = [f"{name} scans: {'; '.join(scans)}" for name, scans in db.check_query_plans(conn).items()]
+        pool.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return problems
+
+
+def _version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def _previous(path):
+    previous = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                result = json.loads(line)
+                previous[(result["rows"], result["case"])] = result
+    return previous
+
+
+# Function to generate a database per size, time every case on it and append the
+# results to ``out``. Returns the list of result records.
+def run(sizes=SIZES, out=RESULTS_PATH, repeat=REPEAT, workdir=None, seed=0):
+    version, previous, results = _version(), _previous(out), []
+    scratch = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="survey-bench-")
+    cold, _, rerun, _, _ = measure_startup()
+    for case, timings in (("cold_start", cold), ("rerun_imports", rerun)):
+        results.append(_result(version, 0, case, timings))
+    try:
+        for rows in sizes:
+            path = os.path.join(workdir, f"bench_{rows}.db")
+            store_dir = os.path.join(workdir, f"images_{rows}")
+            if not os.path.exists(path):
+                start = time.perf_counter()
+                photo_rows = generate(path, store_dir, rows, seed)
+                print(f"Generated {rows} surveys and {photo_rows} photo rows in {time.perf_counter() - start:.1f}s")
+            pool = db.get_pool(path)
+            for case, func in cases(pool, image_store.ImageStore(store_dir), random.Random(seed)).items():
+                results.append(_result(version, rows, case, [t * 1000 for t in _time(func, repeat)]))
+            pool.close()
+    finally:
+        if scratch:
+            shutil.rmtree(workdir, ignore_errors=True)
+    with open(out, "a", encoding="utf-8") as f:
+        for result in results:
+            before = previous.get((result["rows"], result["case"]))
+            change = (f" ({result['median_ms'] / before['median_ms'] - 1:+.0%} vs {before['version']})"
+                      if before and before["median_ms"] else "")
+            print(f"{result['rows']:>7} {result['case']:<20} median {result['median_ms']:9.2f} ms  "
+                  f"p95 {result['p95_ms']:9.2f} ms{change}")
+            f.write(json.dumps(result) + "\n")
+    return results
+
+
+def _result(version, rows, case, timings):
+    return {"timestamp": time.time(), "version": version, "python": platform.python_version(),
+            "rows": rows, "case": case, "runs": len(timings),
+            "min_ms": round(min(timings), 3), "median_ms": round(statistics.median(timings), 3),
+            "p95_ms": round(statistics.quantiles(timings, n=20)[-1], 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the hot paths of the app on synthetic databases.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="survey counts to benchmark")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="timed runs per case")
+    parser.add_argument("--out", default=RESULTS_PATH, help="JSON lines file the results are appended to")
+    parser.add_argument("--workdir", help="keep the generated databases here and reuse them on later runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check-startup", action="store_true",
+                        help="only check the public form's startup cost; exits non-zero on a regression")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="only check the hot queries for full scans; exits non-zero on a regression")
+    args = parser.parse_args(argv)
+    if args.check_startup or args.check_plans:
+        problems = (check_startup() if args.check_startup else []) + (check_plans() if args.check_plans else [])
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    run(args.sizes, args.out, args.repeat, args.workdir, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Change tracking for syncing field-device databases with the central database.
+# Triggers keep one change_log row per tracked row with the sequence number of its
+# latest change; deleted rows stay behind as tombstones so deletions sync too.
+
+import migrations
+
+
+# Tables synced between databases and the columns copied with each row, parents
+# first. These are the columns whose updates the triggers of migration 14 log.
+TRACKED = migrations.CHANGE_LOG_COLUMNS
+
+# Columns holding the id of another tracked row, which differs between databases
+REFERENCES = {
+    "survey_data": {"duplicate_of": "survey_data"},
+    "survey_images": {"survey_id": "survey_data"},
+    "review_data": {"survey_id": "survey_data"},
+    "review_images": {"review_id": "review_data"},
+}
+
+# Columns unique within a table besides id: a received row whose key the target
+# already has, e.g. a survey reviewed on two devices, updates the target's row
+UNIQUE_KEYS = {
+    "review_data": "survey_id",
+}
+
+
+# Function to log rows inserted while their insert trigger was disabled, e.g. by a
+# bulk import. Without bounds, every row of the table is logged.
+def log_rows(conn, table, first_id=None, last_id=None):
+    # The WHERE clause is required: it keeps the upsert from parsing as a join
+    where = "id BETWEEN ? AND ?" if first_id is not None else "true"
+    conn.execute(f'''INSERT INTO change_log (table_name, row_id, seq, deleted)
+                     SELECT '{table}', id,
+                            (SELECT COALESCE(MAX(seq), 0) FROM change_log) + ROW_NUMBER() OVER (ORDER BY id), 0
+                     FROM {table} WHERE {where}
+                     ON CONFLICT (table_name, row_id) DO UPDATE SET
+                         seq = excluded.seq, deleted = 0, origin = NULL''',
+                 (first_id, last_id) if first_id is not None else ())
+
+
+# Function to log the surveys of a bulk import, see importer.BULK_TRIGGERS
+def log_surveys(conn, first_id, last_id):
+    log_rows(conn, "survey_data", first_id, last_id)
+
+
+def database_id(conn):
+    return conn.execute("SELECT value FROM sync_meta WHERE name = 'database_id'").fetchone()[0]
+
+
+# Function to list up to ``limit`` changes after ``seq`` as (seq, table, row id,
+# deleted), oldest first, leaving out the rows that were received from ``peer``
+def changes_since(conn, seq, peer, limit):
+    return conn.execute('''SELECT seq, table_name, row_id, deleted FROM change_log
+                           WHERE seq > ? AND origin IS NOT ? ORDER BY seq LIMIT ?''',
+                        (seq, peer, limit)).fetchall()
+
+
+# Function to return the highest change sequence number
+def last_seq(conn):
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log").fetchone()[0]
@@ -0,0 +1,24 @@
+import io
+
+import matplotlib
+
+# The app renders to PNG bytes only, so skip probing for an interactive backend
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt  # noqa: E402
+
+
+# Function to draw one dashboard breakdown as a bar chart and return it as PNG bytes
+def render_bar_chart(labels, counts, xlabel, title):
+    fig, ax = plt.subplots()
+    ax.bar(labels, counts, color='skyblue')
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("Number of Buildings")
+    ax.set_title(title)
+    if len(labels) > 6:
+        ax.tick_params(axis="x", labelrotation=45)
+    fig.tight_layout()
+    buffered = io.BytesIO()
+    fig.savefig(buffered, format="png")
+    plt.close(fig)
+    return buffered.getvalue()
@@ -0,0 +1,545 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import migrations
+import profiling
+from survey_options import HAZARD_COLUMNS
+
+
+# Path of the SQLite database shared by all pages
+DB_PATH = os.environ.get("BUILDING_SURVEY_DB", "building_survey.db")
+
+# Seconds a connection waits for a competing writer before raising "database is locked"
+BUSY_TIMEOUT = 10.0
+
+# Pragmas applied to every pooled connection. WAL lets readers run alongside the
+# single writer, and NORMAL synchronous is durable in WAL mode while avoiding an
+# fsync on every commit.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+    f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}",
+)
+
+
+# Function to open a tuned connection to the survey database
+def connect(path=DB_PATH):
+    # With profiling on, statements are timed for the diagnostics panel
+    factory = profiling.TracedConnection if profiling.ENABLED else sqlite3.Connection
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False,
+                           factory=factory)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """Bounded pool of autocommit connections shared by every Streamlit session.
+
+    Connections are checked out per thread, so nested ``connection()`` calls in
+    the same thread reuse the connection already held instead of taking another.
+    """
+
+    def __init__(self, path=DB_PATH, size=8):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return connect(self.path)
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        held = getattr(self._local, "conn", None)
+        if held is not None:
+            yield held
+            return
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two writers queue on
+        # busy_timeout instead of deadlocking when a read transaction upgrades
+        with self.connection() as conn:
+            if conn.in_transaction:
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# Function to get the process-wide pool for a database. Pending schema migrations
+# run once, when the pool is first created, rather than on every Streamlit rerun.
+def get_pool(path=DB_PATH):
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = ConnectionPool(path)
+            with pool.connection() as conn:
+                migrations.migrate(conn)
+            _pools[path] = pool
+        return pool
+
+
+# Function to return the EXPLAIN QUERY PLAN detail lines of a statement
+def explain(conn, sql, params=()):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+# Function to list plan steps that fall back to a full table scan. ``allowed`` names
+# the tables a query is expected to walk in full, e.g. the driving table of a listing.
+def full_scans(conn, sql, params=(), allowed=()):
+    scans = []
+    for detail in explain(conn, sql, params):
+        # An automatic index is rebuilt from a full scan on every execution
+        if "AUTOMATIC" in detail:
+            scans.append(detail)
+        elif detail.startswith("SCAN ") and "USING" not in detail and detail.split()[1] not in allowed:
+            scans.append(detail)
+    return scans
+
+
+# Anti-join against the (survey_id, reviewed) index instead of materialising NOT IN
+UNREVIEWED_SQL = "NOT EXISTS (SELECT 1 FROM review_data r WHERE r.survey_id = s.id AND r.reviewed = 1)"
+
+# Leaves out listings with an active claim; _queue_where() closes it
+CLAIMED_SQL = "NOT EXISTS (SELECT 1 FROM review_claims c WHERE c.survey_id = s.id AND c.expires_at > ?"
+
+# Columns shown in the review queue; everything else is loaded per listing
+QUEUE_COLUMNS = ("id", "latitude", "longitude", "use_type", "importance_category", "num_floors", "year_construction",
+                 "priority_score")
+
+# Sort orders of the review queue: label -> (column, descending). Every order ends
+# on id so keyset pagination has a unique position to resume from.
+QUEUE_SORTS = {
+    "Newest first": ("id", True),
+    "Oldest first": ("id", False),
+    "Oldest buildings first": ("year_construction", False),
+    "Newest buildings first": ("year_construction", True),
+    "Most floors first": ("num_floors", True),
+    "Highest priority first": ("priority_score", True),
+}
+
+QUEUE_PAGE_SIZE = 50
+
+# Number of other submissions linked to a queue row as duplicates, appended after QUEUE_COLUMNS
+DUPLICATE_COUNT_SQL = "(SELECT COUNT(*) FROM survey_data d WHERE d.duplicate_of = s.id)"
+
+SURVEY_IMAGES_SQL = ("SELECT id, image_type, image_hash FROM survey_images "
+                     "WHERE survey_id = ? ORDER BY image_type, ordinal")
+
+
+# Hot queries and the tables each may scan; check_query_plans() flags anything else
+QUERY_PLAN_CHECKS = {
+    "review_queue": (f"SELECT id FROM survey_data s WHERE {UNREVIEWED_SQL} ORDER BY s.id DESC LIMIT 50", (),
+                     ("s",)),
+    "claimed_queue": (f"SELECT id FROM survey_data s WHERE {UNREVIEWED_SQL} AND {CLAIMED_SQL}) "
+                      f"ORDER BY s.id DESC LIMIT 50", (0,), ("s",)),
+    "survey": ("SELECT * FROM survey_data WHERE id = ?", (1,), ()),
+    "survey_images": (SURVEY_IMAGES_SQL, (1,), ()),
+    "reviewed_listings": ("SELECT r.id FROM review_data r JOIN survey_data s ON s.id = r.survey_id "
+                          "WHERE r.reviewed = 1 ORDER BY r.id DESC LIMIT 50", (), ("r",)),
+}
+
+
+# Function to report, per hot query, the plan steps that regressed to a full scan
+def check_query_plans(conn):
+    problems = {}
+    for name, (sql, params, allowed) in QUERY_PLAN_CHECKS.items():
+        scans = full_scans(conn, sql, params, allowed)
+        if scans:
+            problems[name] = scans
+    return problems
+
+
+# Users
+
+def create_user(conn, username, password):
+    conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
+
+
+def find_user(conn, username, password):
+    return conn.execute("SELECT * FROM users WHERE username = ? AND password = ?",
+                        (username, password)).fetchone()
+
+
+# Surveys
+
+# Function to insert a survey and its image references. ``survey`` may carry
+# duplicate_of, the id of the survey of the same building it repeats.
+def insert_survey(conn, survey, images):
+    cur = conn.execute('''INSERT INTO survey_data (latitude, longitude, use_type, num_users, importance_category,
+                                danger_falling, num_floors, structure_condition, year_construction, vertical_damage,
+                                danger_impact, soft_floor, short_column, duplicate_of)
+                            VALUES (:latitude, :longitude, :use_type, :num_users, :importance_category,
+                                :danger_falling, :num_floors, :structure_condition, :year_construction, :vertical_damage,
+                                :danger_impact, :soft_floor, :short_column, :duplicate_of)''',
+                       dict(survey, duplicate_of=survey.get("duplicate_of")))
+    survey_id = cur.lastrowid
+    conn.executemany("INSERT INTO survey_images (survey_id, image_type, ordinal, image_hash) VALUES (?, ?, ?, ?)",
+                     [(survey_id, img_type, ordinal, image_hash) for img_type, ordinal, image_hash in images])
+    return survey_id
+
+
+# Columns of survey_data filled by the survey form, in insert order
+SURVEY_COLUMNS = ("latitude", "longitude", "use_type", "num_users", "importance_category", "danger_falling",
+                  "num_floors", "structure_condition", "year_construction", "vertical_damage", "danger_impact",
+                  "soft_floor", "short_column")
+
+# Next id of survey_data; AUTOINCREMENT never reuses ids, so deleted ones count too
+NEXT_SURVEY_ID_SQL = '''SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'survey_data'), 0),
+                              COALESCE((SELECT MAX(id) FROM survey_data), 0)) + 1'''
+
+
+# Function to insert many surveys with a single executemany, for bulk imports. Must
+# run inside a write transaction: ids are handed out up front from the current
+# maximum, so the caller learns them without a round trip per row. Returns the ids
+# in the order of ``surveys``.
+def insert_surveys(conn, surveys):
+    first = conn.execute(NEXT_SURVEY_ID_SQL).fetchone()[0]
+    ids = range(first, first + len(surveys))
+    conn.executemany(f"INSERT INTO survey_data (id, {', '.join(SURVEY_COLUMNS)}) "
+                     f"VALUES (?{', ?' * len(SURVEY_COLUMNS)})",
+                     ((survey_id, *(survey.get(col) for col in SURVEY_COLUMNS))
+                      for survey_id, survey in zip(ids, surveys)))
+    return list(ids)
+
+
+# Function to insert the image references of many surveys as
+# (survey_id, image_type, ordinal, image_hash) rows
+def insert_survey_images(conn, rows):
+    conn.executemany("INSERT INTO survey_images (survey_id, image_type, ordinal, image_hash) VALUES (?, ?, ?, ?)",
+                     rows)
+
+
+# Function to build the WHERE clause of the review queue from the admin filters:
+# use_types, importance_categories (lists), year_min/year_max, floors_min/floors_max
+# and any_hazard (at least one hazard question answered positively). With
+# collapse_duplicates, only the first survey of each building is listed. With a
+# reviewer, listings other reviewers hold an active claim on are left out; with
+# unclaimed, every listing with an active claim is.
+def _queue_where(filters):
+    clauses, params = [UNREVIEWED_SQL], []
+    if filters.get("reviewer") or filters.get("unclaimed"):
+        clauses.append(CLAIMED_SQL + ("" if filters.get("unclaimed") else " AND c.reviewer != ?") + ")")
+        params.append(time.time())
+        if not filters.get("unclaimed"):
+            params.append(filters["reviewer"])
+    if filters.get("collapse_duplicates"):
+        clauses.append("s.duplicate_of IS NULL")
+    for key, column in (("use_types", "use_type"), ("importance_categories", "importance_category")):
+        values = filters.get(key)
+        if values:
+            clauses.append(f"s.{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    for key, column, op in (("year_min", "year_construction", ">="), ("year_max", "year_construction", "<="),
+                            ("floors_min", "num_floors", ">="), ("floors_max", "num_floors", "<=")):
+        if filters.get(key) is not None:
+            clauses.append(f"s.{column} {op} ?")
+            params.append(filters[key])
+    if filters.get("any_hazard"):
+        clauses.append("(" + " OR ".join(f"s.{column} = ?" for column in HAZARD_COLUMNS) + ")")
+        params.extend(HAZARD_COLUMNS.values())
+    return " AND ".join(clauses), params
+
+
+# Function to count the listings matching the queue filters
+def count_queue(conn, filters=None):
+    where, params = _queue_where(filters or {})
+    return conn.execute(f"SELECT COUNT(*) FROM survey_data s WHERE {where}", params).fetchone()[0]
+
+
+# Function to fetch one page of the review queue. ``after`` is the cursor returned
+# with the previous page; the query seeks straight to it through the sort index
+# instead of skipping rows with OFFSET, so every page costs the same.
+# Returns (rows, cursor of the next page or None).
+def fetch_queue_page(conn, filters=None, sort="Newest first", after=None, limit=QUEUE_PAGE_SIZE):
+    column, descending = QUEUE_SORTS[sort]
+    where, params = _queue_where(filters or {})
+    op, direction = ("<", "DESC") if descending else (">", "ASC")
+    if column == "id":
+        order_by = f"s.id {direction}"
+        if after is not None:
+            where += f" AND s.id {op} ?"
+            params.append(after[1])
+    else:
+        order_by = f"s.{column} {direction}, s.id {direction}"
+        if after is not None:
+            where += f" AND (s.{column}, s.id) {op} (?, ?)"
+            params.extend(after)
+    rows = conn.execute(f"SELECT {', '.join('s.' + col for col in QUEUE_COLUMNS)}, {DUPLICATE_COUNT_SQL} "
+                        f"FROM survey_data s "
+                        f"WHERE {where} ORDER BY {order_by} LIMIT ?", params + [limit + 1]).fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, (last[QUEUE_COLUMNS.index(column)], last[0])
+
+
+def fetch_survey(conn, survey_id):
+    return conn.execute("SELECT * FROM survey_data WHERE id = ?", (survey_id,)).fetchone()
+
+
+# Function to return the survey a saved submission was linked to as a duplicate, or None
+def fetch_duplicate_of(conn, survey_id):
+    row = conn.execute("SELECT duplicate_of FROM survey_data WHERE id = ?", (survey_id,)).fetchone()
+    return row[0] if row else None
+
+
+# Function to fetch the image references of a survey in one round trip, as lists of
+# (image id, image_hash) per image type in upload order. No image data is read.
+def fetch_survey_images(conn, survey_id):
+    images = {}
+    for image_id, img_type, image_hash in conn.execute(SURVEY_IMAGES_SQL, (survey_id,)):
+        images.setdefault(img_type, []).append((image_id, image_hash))
+    return images
+
+
+# Function to read the BLOB of an image row that has not been moved to the image store
+def fetch_image_blob(conn, table, image_id):
+    row = conn.execute(f"SELECT image FROM {table} WHERE id = ?", (image_id,)).fetchone()
+    return row[0] if row else None
+
+
+# Function to list the ids of the surveys linked to ``survey_id`` as duplicates
+def fetch_duplicates(conn, survey_id):
+    return [row[0] for row in conn.execute("SELECT id FROM survey_data WHERE duplicate_of = ? ORDER BY id",
+                                           (survey_id,))]
+
+
+# Function to detach a survey that was wrongly linked as a duplicate
+def unlink_duplicate(conn, survey_id):
+    conn.execute("UPDATE survey_data SET duplicate_of = NULL WHERE id = ?", (survey_id,))
+
+
+def update_survey(conn, survey_id, survey):
+    conn.execute('''UPDATE survey_data SET
+                        use_type = :use_type, num_users = :num_users, importance_category = :importance_category,
+                        danger_falling = :danger_falling, num_floors = :num_floors,
+                        structure_condition = :structure_condition, year_construction = :year_construction,
+                        vertical_damage = :vertical_damage, danger_impact = :danger_impact,
+                        soft_floor = :soft_floor, short_column = :short_column
+                    WHERE id = :id''', dict(survey, id=survey_id))
+
+
+# Reviews
+
+# Function to save the review of a survey. A survey has one review: submitting
+# again updates it in place, and replaces its photos of the types uploaded this
+# time, so a retried submission leaves exactly what one submission would.
+# Returns the review id.
+def insert_review(conn, review, images):
+    review_id = conn.execute('''INSERT INTO review_data (
+                        survey_id, structural_system, arrangement_walls, irregular_vertical, irregular_horizontal,
+                        torsion_rotation, structural_vulnerabilities, heavy_finishes, input_quality, soil_class,
+                        load_capacity_reduction, constructed_area, structure_performance, retrofitting_methods, reviewed
+                    ) VALUES (
+                        :survey_id, :structural_system, :arrangement_walls, :irregular_vertical, :irregular_horizontal,
+                        :torsion_rotation, :structural_vulnerabilities, :heavy_finishes, :input_quality, :soil_class,
+                        :load_capacity_reduction, :constructed_area, :structure_performance, :retrofitting_methods, :reviewed
+                    ) ON CONFLICT (survey_id) DO UPDATE SET
+                        structural_system = excluded.structural_system, arrangement_walls = excluded.arrangement_walls,
+                        irregular_vertical = excluded.irregular_vertical,
+                        irregular_horizontal = excluded.irregular_horizontal,
+                        torsion_rotation = excluded.torsion_rotation,
+                        structural_vulnerabilities = excluded.structural_vulnerabilities,
+                        heavy_finishes = excluded.heavy_finishes, input_quality = excluded.input_quality,
+                        soil_class = excluded.soil_class, load_capacity_reduction = excluded.load_capacity_reduction,
+                        constructed_area = excluded.constructed_area,
+                        structure_performance = excluded.structure_performance,
+                        retrofitting_methods = excluded.retrofitting_methods, reviewed = excluded.reviewed
+                    RETURNING id''', review).fetchone()[0]
+    conn.executemany("DELETE FROM review_images WHERE review_id = ? AND image_type = ?",
+                     [(review_id, img_type) for img_type in {img_type for img_type, _, _ in images}])
+    conn.executemany("INSERT INTO review_images (review_id, image_type, ordinal, image_hash) VALUES (?, ?, ?, ?)",
+                     [(review_id, img_type, ordinal, image_hash) for img_type, ordinal, image_hash in images])
+    return review_id
+
+
+# Column linking each image table to the row its photos belong to
+IMAGE_OWNERS = {"survey_images": "survey_id", "review_images": "review_id"}
+
+
+# Function to append a photo to an existing survey or review as the next ordinal of
+# its type. Returns the ordinal.
+def add_image(conn, table, owner_id, image_type, image_hash):
+    owner = IMAGE_OWNERS[table]
+    ordinal = conn.execute(f"SELECT COALESCE(MAX(ordinal) + 1, 0) FROM {table} "
+                           f"WHERE {owner} = ? AND image_type = ?", (owner_id, image_type)).fetchone()[0]
+    conn.execute(f"INSERT INTO {table} ({owner}, image_type, ordinal, image_hash) VALUES (?, ?, ?, ?)",
+                 (owner_id, image_type, ordinal, image_hash))
+    return ordinal
+
+
+def fetch_review(conn, review_id):
+    return conn.execute("SELECT * FROM review_data WHERE id = ?", (review_id,)).fetchone()
+
+
+# Columns of the reviewed listings browser, review first and then its survey. Only
+# what the list shows is read; answers are fetched for the selected review alone.
+REVIEWED_COLUMNS = ("r.id", "r.survey_id", "s.latitude", "s.longitude", "s.use_type", "s.importance_category",
+                    "r.structural_system", "r.soil_class", "r.input_quality")
+
+# Answers of the review form, in the order they are shown
+REVIEW_ANSWER_COLUMNS = ("structural_system", "arrangement_walls", "irregular_vertical", "irregular_horizontal",
+                         "torsion_rotation", "structural_vulnerabilities", "heavy_finishes", "input_quality",
+                         "soil_class", "load_capacity_reduction", "constructed_area", "structure_performance",
+                         "retrofitting_methods")
+
+REVIEW_IMAGES_SQL = ("SELECT id, image_type, image_hash FROM review_images "
+                     "WHERE review_id = ? ORDER BY image_type, ordinal")
+
+
+# Function to build the WHERE clause of the reviewed listings from structural_systems,
+# soil_classes and use_types (lists)
+def _reviewed_where(filters):
+    clauses, params = ["r.reviewed = 1"], []
+    for key, column in (("structural_systems", "r.structural_system"), ("soil_classes", "r.soil_class"),
+                        ("use_types", "s.use_type")):
+        values = filters.get(key)
+        if values:
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    return " AND ".join(clauses), params
+
+
+# Function to count the reviewed listings matching the filters
+def count_reviewed(conn, filters=None):
+    where, params = _reviewed_where(filters or {})
+    return conn.execute(f"SELECT COUNT(*) FROM review_data r JOIN survey_data s ON s.id = r.survey_id "
+                        f"WHERE {where}", params).fetchone()[0]
+
+
+# Function to fetch one page of reviewed listings, newest review first. ``after`` is
+# the review id returned with the previous page, so every page costs the same.
+# Returns (rows of REVIEWED_COLUMNS, cursor of the next page or None).
+def fetch_reviewed_page(conn, filters=None, after=None, limit=QUEUE_PAGE_SIZE):
+    where, params = _reviewed_where(filters or {})
+    if after is not None:
+        where += " AND r.id < ?"
+        params.append(after)
+    rows = conn.execute(f"SELECT {', '.join(REVIEWED_COLUMNS)} "
+                        f"FROM review_data r JOIN survey_data s ON s.id = r.survey_id "
+                        f"WHERE {where} ORDER BY r.id DESC LIMIT ?", params + [limit + 1]).fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, rows[-1][0]
+
+
+# Function to list the surveys with a reviewed listing matching the filters, in id order
+def fetch_reviewed_survey_ids(conn, filters=None):
+    where, params = _reviewed_where(filters or {})
+    return [row[0] for row in conn.execute(f"SELECT r.survey_id FROM review_data r "
+                                           f"JOIN survey_data s ON s.id = r.survey_id "
+                                           f"WHERE {where} ORDER BY r.survey_id", params)]
+
+
+# Function to return the answers of a review as a dict of REVIEW_ANSWER_COLUMNS, or None
+def fetch_review_answers(conn, review_id):
+    row = conn.execute(f"SELECT {', '.join(REVIEW_ANSWER_COLUMNS)} FROM review_data WHERE id = ?",
+                       (review_id,)).fetchone()
+    return dict(zip(REVIEW_ANSWER_COLUMNS, row)) if row else None
+
+
+# Function to fetch the image references of a review as lists of (image id,
+# image_hash) per image type, like fetch_survey_images()
+def fetch_review_images(conn, review_id):
+    images = {}
+    for image_id, img_type, image_hash in conn.execute(REVIEW_IMAGES_SQL, (review_id,)):
+        images.setdefault(img_type, []).append((image_id, image_hash))
+    return images
+
+
+# Claims
+
+# Seconds a claimed listing stays reserved for its reviewer. A reviewer who walks
+# away loses the claim when it expires, so the listing returns to the queue.
+CLAIM_LEASE = 30 * 60
+
+# Listings handed out per claim
+CLAIM_BATCH = 5
+
+# Function to claim the next listings of the queue for ``reviewer`` inside the
+# caller's write transaction, so two reviewers can never claim the same listing.
+# The reviewer's active claims are renewed and count toward ``count``; the rest are
+# taken from the queue in ``sort`` order, skipping listings claimed by anyone.
+# Returns the claimed survey ids with their expiry as (survey_id, expires_at).
+def claim_next(conn, reviewer, filters=None, sort="Newest first", count=CLAIM_BATCH, lease=CLAIM_LEASE):
+    now = time.time()
+    conn.execute("DELETE FROM review_claims WHERE expires_at <= ?", (now,))
+    conn.execute("UPDATE review_claims SET expires_at = ? WHERE reviewer = ?", (now + lease, reviewer))
+    held = conn.execute("SELECT COUNT(*) FROM review_claims WHERE reviewer = ?", (reviewer,)).fetchone()[0]
+    if held < count:
+        rows, _ = fetch_queue_page(conn, dict(filters or {}, unclaimed=True), sort, limit=count - held)
+        conn.executemany("INSERT INTO review_claims (survey_id, reviewer, expires_at) VALUES (?, ?, ?)",
+                         [(row[0], reviewer, now + lease) for row in rows])
+    return fetch_claims(conn, reviewer)
+
+
+# Function to list the active claims of a reviewer as (survey_id, expires_at)
+def fetch_claims(conn, reviewer):
+    return conn.execute("SELECT survey_id, expires_at FROM review_claims WHERE reviewer = ? AND expires_at > ? "
+                        "ORDER BY survey_id", (reviewer, time.time())).fetchall()
+
+
+# Function to return the reviewer holding an active claim on a survey, or None
+def claim_holder(conn, survey_id):
+    row = conn.execute("SELECT reviewer FROM review_claims WHERE survey_id = ? AND expires_at > ?",
+                       (survey_id, time.time())).fetchone()
+    return row[0] if row else None
+
+
+# Function to give up the claim on a survey; with a reviewer, only that reviewer's.
+# Returns True if a claim was released.
+def release_claim(conn, survey_id, reviewer=None):
+    if reviewer is None:
+        cur = conn.execute("DELETE FROM review_claims WHERE survey_id = ?", (survey_id,))
+    else:
+        cur = conn.execute("DELETE FROM review_claims WHERE survey_id = ? AND reviewer = ?", (survey_id, reviewer))
+    return cur.rowcount > 0
@@ -0,0 +1,186 @@
+import argparse
+import csv
+import io
+import json
+import os
+import tempfile
+import zipfile
+
+import db
+import image_store
+
+
+# Rows fetched from SQLite per step; the export never holds more than this in memory
+CHUNK_SIZE = 1000
+
+EXPORT_FORMATS = ("csv", "geojson", "parquet")
+
+# Review columns exported next to each survey, prefixed with review_
+REVIEW_COLUMNS = ("id", "structural_system", "arrangement_walls", "irregular_vertical", "irregular_horizontal",
+                  "torsion_rotation", "structural_vulnerabilities", "heavy_finishes", "input_quality", "soil_class",
+                  "load_capacity_reduction", "constructed_area", "structure_performance", "retrofitting_methods")
+
+# Every survey with its latest completed review, if any
+EXPORT_SQL = f'''SELECT s.*, {", ".join(f"r.{col} AS review_{col}" for col in REVIEW_COLUMNS)}
+                 FROM survey_data s
+                 LEFT JOIN review_data r ON r.id = (SELECT MAX(id) FROM review_data
+                                                    WHERE survey_id = s.id AND reviewed = 1)
+                 ORDER BY s.id'''
+
+PHOTOS_SQL = {
+    "survey_images": '''SELECT id, survey_id, image_type, ordinal, image_hash FROM survey_images
+                        ORDER BY survey_id, image_type, ordinal''',
+    "review_images": '''SELECT i.id, r.survey_id, i.image_type, i.ordinal, i.image_hash
+                        FROM review_images i JOIN review_data r ON r.id = i.review_id
+                        ORDER BY r.survey_id, i.image_type, i.ordinal''',
+}
+
+
+# Function to stream the export rows. SQLite steps the statement as rows are
+# fetched, so the cursor behaves as a server-side cursor. Returns (columns, chunks).
+def iter_export(conn, chunk_size=CHUNK_SIZE):
+    cursor = conn.execute(EXPORT_SQL)
+    columns = [desc[0] for desc in cursor.description]
+
+    def chunks():
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+
+    return columns, chunks()
+
+
+def write_csv(columns, chunks, out):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+
+
+def write_geojson(columns, chunks, out):
+    lat, lon = columns.index("latitude"), columns.index("longitude")
+    out.write('{"type": "FeatureCollection", "features": [\n')
+    first = True
+    for rows in chunks:
+        for row in rows:
+            geometry = None
+            if row[lat] is not None and row[lon] is not None:
+                geometry = {"type": "Point", "coordinates": [row[lon], row[lat]]}
+            feature = {"type": "Feature", "geometry": geometry, "properties": dict(zip(columns, row))}
+            out.write(("" if first else ",\n") + json.dumps(feature, ensure_ascii=False))
+            first = False
+    out.write("\n]}\n")
+
+
+# Function to map export columns to their declared SQLite types
+def declared_types(conn):
+    types = {}
+    for table, prefix in (("survey_data", ""), ("review_data", "review_")):
+        for _, name, decl, *_ in conn.execute(f"PRAGMA table_info({table})"):
+            types[prefix + name] = decl.upper()
+    return types
+
+
+# Function to write one Parquet row group per chunk. The schema comes from the
+# declared column types, so every chunk shares it even when a column is all NULL.
+# pyarrow is only needed for this format, so it is imported here.
+def write_parquet(columns, chunks, path, types):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+
+    arrow_types = {"INTEGER": pa.int64(), "REAL": pa.float64()}
+    schema = pa.schema([(col, arrow_types.get(types.get(col), pa.string())) for col in columns])
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in chunks:
+            writer.write_table(pa.Table.from_pydict({col: [row[i] for row in rows] for i, col in enumerate(columns)},
+                                                    schema=schema))
+
+
+# Function to write the data file of an export to ``path``
+def export_data(conn, fmt, path, chunk_size=CHUNK_SIZE):
+    columns, chunks = iter_export(conn, chunk_size)
+    if fmt == "parquet":
+        write_parquet(columns, chunks, path, declared_types(conn))
+        return
+    with open(path, "w", newline="", encoding="utf-8") as out:
+        (write_csv if fmt == "csv" else write_geojson)(columns, chunks, out)
+
+
+# Function to add every photo to an open zip, one file at a time, as
+# photos/<survey id>/<table>/<image type>_<ordinal>.<ext>, the extension following
+# the image format. Photos missing from the store are skipped. Returns (photos
+# written, photos missing).
+def write_photos(conn, store, zf, chunk_size=CHUNK_SIZE):
+    count = missing = 0
+    for table, sql in PHOTOS_SQL.items():
+        cursor = conn.execute(sql)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for image_id, survey_id, image_type, ordinal, image_hash in rows:
+                name = f"photos/{survey_id}/{table}/{image_type}_{ordinal}"
+                if image_hash:
+                    if not os.path.exists(store.path(image_hash)):
+                        missing += 1
+                        continue
+                    zf.write(store.path(image_hash), name + store.extension(image_hash))
+                else:
+                    blob = db.fetch_image_blob(conn, table, image_id)
+                    if blob is None:
+                        continue
+                    zf.writestr(name + image_store.image_extension(blob[:16]), blob)
+                count += 1
+    return count, missing
+
+
+# Function to write a zip with the data file and, optionally, every photo. Entries
+# are streamed into ``out``, which does not need to be seekable. Returns the number
+# of photos missing from the store.
+def export_bundle(conn, store, fmt, out, photos=True, chunk_size=CHUNK_SIZE):
+    missing = 0
+    # Photos are already compressed; storing them avoids burning CPU for nothing
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as zf:
+        if fmt == "parquet":
+            # Parquet needs a seekable file, so it is staged on disk first
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "surveys.parquet")
+                export_data(conn, fmt, path, chunk_size)
+                zf.write(path, "surveys.parquet", compress_type=zipfile.ZIP_DEFLATED)
+        else:
+            columns, chunks = iter_export(conn, chunk_size)
+            with zf.open(f"surveys.{fmt}", "w", force_zip64=True) as raw:
+                with io.TextIOWrapper(raw, encoding="utf-8", newline="") as text:
+                    (write_csv if fmt == "csv" else write_geojson)(columns, chunks, text)
+        if photos:
+            _, missing = write_photos(conn, store, zf, chunk_size)
+    return missing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export surveys joined with their reviews.")
+    parser.add_argument("output", help="file to write; a .zip bundle when --photos is given")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--photos", action="store_true", help="bundle the data file and all photos in a zip")
+    parser.add_argument("--db", default=db.DB_PATH, help="path of the survey database")
+    parser.add_argument("--store", default=image_store.IMAGE_STORE_DIR, help="root directory of the image store")
+    args = parser.parse_args(argv)
+
+    pool = db.get_pool(args.db)
+    with pool.connection() as conn:
+        if args.photos:
+            with open(args.output, "wb") as out:
+                missing = export_bundle(conn, image_store.ImageStore(args.store), args.format, out)
+            if missing:
+                print(f"Skipped {missing} photos missing from the image store")
+        else:
+            export_data(conn, args.format, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import argparse
+import hashlib
+import io
+import mmap
+import os
+import tempfile
+import threading
+
+import db
+
+
+# Root directory of the content-addressed image store
+IMAGE_STORE_DIR = os.environ.get("BUILDING_SURVEY_IMAGES", "image_store")
+
+# Longest side, in pixels, of the thumbnails stored next to each image
+THUMBNAIL_SIZE = 320
+
+# Tables whose rows reference images, migrated by migrate_blobs()
+IMAGE_TABLES = ("survey_images", "review_images")
+
+# File extensions by the leading bytes of an encoded image. Stored files carry no
+# extension, and what they hold depends on BUILDING_SURVEY_IMAGE_FORMAT at ingest.
+_SIGNATURES = (
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF8", ".gif"),
+)
+
+
+class ImageStore:
+    """Write-once image files addressed by the SHA-256 of their content.
+
+    ``ab/cd/abcd…`` holds the display-size image and ``ab/cd/abcd….thumb`` its
+    thumbnail. Identical uploads hash to the same file and are stored once.
+    """
+
+    def __init__(self, root=IMAGE_STORE_DIR):
+        self.root = root
+
+    def path(self, digest, thumbnail=False):
+        name = digest + ".thumb" if thumbnail else digest
+        return os.path.join(self.root, digest[:2], digest[2:4], name)
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    # Function to store an image and return its hash. ``thumbnail`` may be passed
+    # when the caller already produced one; otherwise it is derived from ``data``.
+    def put(self, data, thumbnail=None):
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self:
+            self._write(self.path(digest), data)
+        if not os.path.exists(self.path(digest, thumbnail=True)):
+            self._write(self.path(digest, thumbnail=True), thumbnail or make_thumbnail(data))
+        return digest
+
+    def _write(self, path, data):
+        # Write to a temporary file and rename, so readers never see a partial image
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    # Function to return the file extension of a stored image, from its header
+    def extension(self, digest, thumbnail=False):
+        with open(self.path(digest, thumbnail), "rb") as f:
+            return image_extension(f.read(16))
+
+    def read(self, digest, thumbnail=False):
+        with open(self.path(digest, thumbnail), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return b""
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                return mm[:]
+
+
+# Function to return the file extension matching encoded image ``data`` (its first
+# 16 bytes are enough), or "" when the format is not recognised
+def image_extension(data):
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return ".avif"
+    for signature, ext in _SIGNATURES:
+        if data.startswith(signature):
+            return ext
+    return ""
+
+
+# Function to shrink an image to a JPEG thumbnail
+def make_thumbnail(data):
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(data))
+    img.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    img = img.convert("RGB")
+    img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG", quality=80)
+    return buffered.getvalue()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+# Function to get the process-wide store for a directory
+def get_store(root=IMAGE_STORE_DIR):
+    with _stores_lock:
+        store = _stores.get(root)
+        if store is None:
+            store = _stores[root] = ImageStore(root)
+        return store
+
+
+# Function to move image BLOBs still held in SQLite into the store, batch by batch so
+# memory stays bounded. Returns the number of rows moved per table.
+def migrate_blobs(conn, store, batch_size=100):
+    moved = {}
+    for table in IMAGE_TABLES:
+        moved[table] = 0
+        last_id = 0
+        while True:
+            rows = conn.execute(f"SELECT id, image FROM {table} WHERE id > ? AND image IS NOT NULL "
+                                f"ORDER BY id LIMIT ?", (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            # Files are written before the rows are updated, so an interrupted run
+            # leaves at most some unreferenced files and can simply be restarted
+            updates = [(store.put(image), row_id) for row_id, image in rows]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(f"UPDATE {table} SET image_hash = ?, image = NULL WHERE id = ?", updates)
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            moved[table] += len(rows)
+            last_id = rows[-1][0]
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move image BLOBs from the survey database into the image store.")
+    parser.add_argument("--db", default=db.DB_PATH, help="path of the survey database")
+    parser.add_argument("--store", default=IMAGE_STORE_DIR, help="root directory of the image store")
+    parser.add_argument("--vacuum", action="store_true", help="reclaim the freed space afterwards")
+    args = parser.parse_args(argv)
+
+    pool = db.get_pool(args.db)
+    with pool.connection() as conn:
+        moved = migrate_blobs(conn, ImageStore(args.store))
+        if args.vacuum:
+            conn.execute("VACUUM")
+    for table, count in moved.items():
+        print(f"{table}: moved {count} images")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import argparse
+import csv
+import json
+import os
+
+import changes
+import db
+import image_store
+import spatial
+import stats
+from survey_options import SURVEY_IMAGE_TYPES
+from validation import ValidationError, validate_survey
+
+
+# Rows inserted per transaction
+BATCH_SIZE = 10000
+
+# Separator between several photo paths in one cell
+PHOTO_SEPARATOR = ";"
+
+IMPORT_FORMATS = ("csv", "geojson", "xlsx")
+
+
+# Readers yield (row number, record) pairs; row numbers match what the user sees in
+# their spreadsheet or feature list, so errors can be traced back to the source.
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for number, record in enumerate(csv.DictReader(f), start=2):
+            yield number, record
+
+
+# Function to read a GeoJSON FeatureCollection. Point geometries provide the
+# coordinates; every other answer comes from the feature properties.
+def read_geojson(path):
+    with open(path, encoding="utf-8") as f:
+        features = json.load(f).get("features", [])
+    for number, feature in enumerate(features, start=1):
+        record = dict(feature.get("properties") or {})
+        geometry = feature.get("geometry") or {}
+        coordinates = geometry.get("coordinates")
+        # A Point without usable coordinates is left to validation to reject
+        if geometry.get("type") == "Point" and isinstance(coordinates, list) and len(coordinates) >= 2:
+            record["longitude"], record["latitude"] = coordinates[:2]
+        yield number, record
+
+
+# Function to read the first sheet of a workbook, with the column names in the first
+# row. openpyxl is only needed for this format, so it is imported here.
+def read_xlsx(path):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("Excel import needs openpyxl (pip install openpyxl)")
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(name).strip() if name is not None else "" for name in next(rows, ())]
+        for number, values in enumerate(rows, start=2):
+            if any(value is not None for value in values):
+                yield number, dict(zip(header, values))
+    finally:
+        workbook.close()
+
+
+READERS = {"csv": read_csv, "geojson": read_geojson, "xlsx": read_xlsx}
+
+
+def detect_format(path):
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    return {"json": "geojson", "xls": "xlsx"}.get(ext, ext)
+
+
+# Function to list the photos of a record as (image type, ordinal, path). Each
+# photo column holds paths relative to ``photo_dir``, separated by semicolons.
+def photo_paths(record, photo_dir):
+    photos = []
+    for img_type in SURVEY_IMAGE_TYPES:
+        value = record.get(img_type)
+        if not value or not photo_dir:
+            continue
+        names = [name.strip() for name in str(value).split(PHOTO_SEPARATOR) if name.strip()]
+        photos.extend((img_type, ordinal, os.path.join(photo_dir, name)) for ordinal, name in enumerate(names))
+    return photos
+
+
+# Function to resize and store the photos of a batch. Photos stream through
+# ingest.iter_process_images, so only a few are decoded or encoded at a time. A
+# record's photos are stored once all of them are processed, so a record rejected
+# for one unreadable photo leaves nothing in the store. Returns the image rows per
+# batch index and the errors per batch index.
+def store_photos(batch_photos, store, max_workers=None):
+    import ingest
+
+    remaining = {index: len(photos) for index, photos in enumerate(batch_photos) if photos}
+    jobs = (((index, img_type, ordinal, path), path)
+            for index, photos in enumerate(batch_photos) for img_type, ordinal, path in photos)
+    processed, images, errors = {}, {}, {}
+    for (index, img_type, ordinal, path), result in ingest.iter_process_images(
+            jobs, max_workers or ingest.MAX_WORKERS, return_exceptions=True):
+        if isinstance(result, Exception):
+            errors.setdefault(index, []).append(f"{os.path.basename(path)}: {result}")
+        else:
+            processed.setdefault(index, []).append((img_type, ordinal, result))
+        remaining[index] -= 1
+        if not remaining[index]:
+            photos = processed.pop(index, [])
+            if index not in errors:
+                images[index] = [(img_type, ordinal, store.put(*result)) for img_type, ordinal, result in photos]
+    return images, errors
+
+
+# Insert triggers replaced by one set-based pass per batch; each is dropped and
+# recreated inside the batch transaction, so other writers never see it missing
+BULK_TRIGGERS = {
+    "survey_stats_insert": stats.add_surveys,
+    "survey_rtree_insert": spatial.index_surveys,
+    "change_log_survey_data_insert": changes.log_surveys,
+}
+
+
+# Function to insert a batch of validated surveys and their image rows, given per
+# batch index, inside the caller's transaction. Returns the new survey ids.
+def insert_batch(conn, surveys, images):
+    triggers = conn.execute(f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' "
+                            f"AND name IN ({', '.join('?' * len(BULK_TRIGGERS))})", tuple(BULK_TRIGGERS)).fetchall()
+    for name, _ in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    ids = db.insert_surveys(conn, surveys)
+    db.insert_survey_images(conn, [(ids[index], *image) for index, rows in images.items() for image in rows])
+    for name, sql in triggers:
+        BULK_TRIGGERS[name](conn, ids[0], ids[-1])
+        conn.execute(sql)
+    return ids
+
+
+# Function to import surveys from ``path``. Invalid rows, and rows whose photos could
+# not be read, are skipped and reported; everything else is inserted in batches of
+# ``batch_size``, one transaction per batch. Returns {"inserted": n, "errors": [(row, [messages])]}.
+def import_surveys(pool, path, fmt=None, photo_dir=None, store=None, batch_size=BATCH_SIZE):
+    fmt = fmt or detect_format(path)
+    if fmt not in READERS:
+        raise ValueError(f"Unsupported import format {fmt!r}; expected one of {', '.join(IMPORT_FORMATS)}")
+    store = store or image_store.get_store()
+    report = {"inserted": 0, "errors": []}
+
+    def flush(batch):
+        images, photo_errors = store_photos([photos for _, _, photos in batch], store) if photo_dir else ({}, {})
+        surveys, kept = [], {}
+        for index, (number, survey, _) in enumerate(batch):
+            if index in photo_errors:
+                report["errors"].append((number, photo_errors[index]))
+                continue
+            if index in images:
+                kept[len(surveys)] = images[index]
+            surveys.append(survey)
+        if not surveys:
+            return
+        with pool.transaction() as conn:
+            insert_batch(conn, surveys, kept)
+        report["inserted"] += len(surveys)
+
+    batch = []
+    for number, record in READERS[fmt](path):
+        try:
+            survey = validate_survey(record)
+        except ValidationError as exc:
+            report["errors"].append((number, exc.errors))
+            continue
+        batch.append((number, survey, photo_paths(record, photo_dir)))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import an existing building inventory as surveys.")
+    parser.add_argument("input", help="CSV, GeoJSON or Excel file with one building per row or feature")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="input format; guessed from the extension by default")
+    parser.add_argument("--photos", help="directory the photo columns are relative to")
+    parser.add_argument("--db", default=db.DB_PATH, help="path of the survey database")
+    parser.add_argument("--store", default=image_store.IMAGE_STORE_DIR, help="root directory of the image store")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows inserted per transaction")
+    args = parser.parse_args(argv)
+
+    report = import_surveys(db.get_pool(args.db), args.input, args.format, args.photos,
+                            image_store.ImageStore(args.store), args.batch_size)
+    for number, messages in report["errors"]:
+        print(f"row {number}: {'; '.join(messages)}")
+    print(f"Imported {report['inserted']} surveys, skipped {len(report['errors'])} rows")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import io
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from PIL import Image, ImageOps
+
+
+# Longest side, in pixels, of the stored display image
+MAX_DIMENSION = int(os.environ.get("BUILDING_SURVEY_IMAGE_MAX_DIMENSION", 1600))
+
+# Longest side, in pixels, of the thumbnail produced alongside it
+THUMBNAIL_DIMENSION = 320
+
+# Output encoding of processed photos
+IMAGE_FORMAT = os.environ.get("BUILDING_SURVEY_IMAGE_FORMAT", "WEBP")
+IMAGE_QUALITY = int(os.environ.get("BUILDING_SURVEY_IMAGE_QUALITY", 80))
+
+# Photos of one submission processed at the same time
+MAX_WORKERS = 4
+
+# Upper bound on decoded pixel data held by concurrent workers
+MEMORY_BUDGET = 256 * 1024 * 1024
+
+# Formats that cannot store an alpha channel
+_NO_ALPHA = {"JPEG"}
+
+
+class MemoryBudget:
+    """Blocks workers until their estimated decode size fits in the budget.
+
+    A single image larger than the whole budget is still let through once
+    nothing else is in flight, so one huge photo cannot stall a submission.
+    """
+
+    def __init__(self, limit=MEMORY_BUDGET):
+        self.limit = limit
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, cost):
+        with self._cond:
+            while self.in_use and self.in_use + cost > self.limit:
+                self._cond.wait()
+            self.in_use += cost
+
+    def release(self, cost):
+        with self._cond:
+            self.in_use -= cost
+            self._cond.notify_all()
+
+
+def _encode(img, image_format, quality):
+    if image_format.upper() in _NO_ALPHA and img.mode not in ("RGB", "L"):
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        else:
+            img = img.convert("RGB")
+    buffered = io.BytesIO()
+    img.save(buffered, format=image_format, quality=quality)
+    return buffered.getvalue()
+
+
+# Function to open an upload lazily, reading only its header. For JPEGs, draft mode
+# makes the decoder scale down by a power of two while decoding, so a 48 MP photo is
+# never fully materialised.
+def open_image(image, max_dimension=MAX_DIMENSION):
+    img = Image.open(image)
+    img.draft("RGB", (max_dimension, max_dimension))
+    return img
+
+
+# Function to estimate the bytes needed to decode and resize an opened image
+def decode_cost(img):
+    return img.width * img.height * 4 * 2
+
+
+# Function to turn an uploaded photo into (display image, thumbnail) bytes
+def process_image(image, max_dimension=MAX_DIMENSION, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY,
+                  budget=None):
+    img = image if isinstance(image, Image.Image) else open_image(image, max_dimension)
+    cost = decode_cost(img)
+    if budget is not None:
+        budget.acquire(cost)
+    try:
+        # Honour the camera orientation before sizing, so portrait shots stay upright
+        ImageOps.exif_transpose(img, in_place=True)
+        img.thumbnail((max_dimension, max_dimension), reducing_gap=3.0)
+        display = _encode(img, image_format, quality)
+        img.thumbnail((THUMBNAIL_DIMENSION, THUMBNAIL_DIMENSION), reducing_gap=3.0)
+        thumbnail = _encode(img, image_format, quality)
+    finally:
+        img.close()
+        if budget is not None:
+            budget.release(cost)
+    return display, thumbnail
+
+
+# Function to process ``(key, upload)`` pairs as a stream, yielding ``(key, result)``
+# in completion order. At most ``max_workers`` uploads are in flight, so memory stays
+# bounded however many photos a submission carries. Pillow releases the GIL while
+# decoding and resampling, so threads scale across cores. With return_exceptions, an
+# upload that fails yields its exception as the result instead of raising it.
+def iter_process_images(items, max_workers=MAX_WORKERS, budget=None, return_exceptions=False, **options):
+    budget = budget or MemoryBudget()
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while True:
+            for key, upload in items:
+                running[executor.submit(process_image, upload, budget=budget, **options)] = key
+                if len(running) >= max_workers:
+                    break
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                if return_exceptions and future.exception() is not None:
+                    yield key, future.exception()
+                else:
+                    yield key, future.result()
+
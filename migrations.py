@@ -0,0 +1,495 @@
+import time
+
+
+# Columns of the survey_data table as first declared in stapp.py, mapped to the
+# names the app has actually been writing to
+LEGACY_SURVEY_COLUMNS = {
+    "id": "id",
+    "latitude": "latitude",
+    "longitude": "longitude",
+    "type_of_use": "use_type",
+    "number_of_users": "num_users",
+    "building_importance_category": "importance_category",
+    "non_structural_falling_danger": "danger_falling",
+    "number_of_floors": "num_floors",
+    "condition_of_structure": "structure_condition",
+    "year_of_construction": "year_construction",
+    "previous_damages": "vertical_damage",
+    "neighboring_buildings_impact": "danger_impact",
+    "soft_floor": "soft_floor",
+    "short_column": "short_column",
+}
+
+# Inline photo columns of the legacy survey_data table and their survey_images type
+LEGACY_SURVEY_PHOTOS = {
+    "non_structural_falling_photo": "falling_photo",
+    "structure_condition_photo": "rust_photo",
+    "previous_damages_photo": "damage_photo",
+    "neighboring_impact_photo": "impact_photo",
+    "soft_floor_photo": "soft_floor_photo",
+    "short_column_photo": "short_column_photo",
+}
+
+# Inline photo columns of review_data, moved to review_images by migration 3
+REVIEW_PHOTOS = (
+    "irregular_vertical_photo",
+    "irregular_horizontal_photo",
+    "torsion_rotation_photo",
+    "heavy_finishes_photo",
+    "constructed_area_photo",
+)
+
+SURVEY_DATA_DDL = '''CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                latitude REAL,
+                longitude REAL,
+                use_type TEXT,
+                num_users TEXT,
+                importance_category TEXT,
+                danger_falling TEXT,
+                num_floors INTEGER,
+                structure_condition TEXT,
+                year_construction INTEGER,
+                vertical_damage TEXT,
+                danger_impact TEXT,
+                soft_floor TEXT,
+                short_column TEXT
+            )'''
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+# 1) Bring any database to the survey_data/survey_images layout the app writes to.
+# Databases created by the original DDL get their columns renamed and their inline
+# photos moved to survey_images.
+def _baseline(conn):
+    columns = _columns(conn, "survey_data")
+    legacy = "type_of_use" in columns
+    # Tables are rebuilt with the create/copy/drop/rename sequence so foreign keys
+    # in other tables keep pointing at the final name
+    conn.execute(SURVEY_DATA_DDL.format(table="survey_data_new" if legacy else "survey_data"))
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS survey_images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                survey_id INTEGER,
+                image_type TEXT,
+                image BLOB,
+                FOREIGN KEY (survey_id) REFERENCES survey_data(id)
+            )''')
+
+    if legacy:
+        old = [col for col in LEGACY_SURVEY_COLUMNS if col in columns]
+        new = [LEGACY_SURVEY_COLUMNS[col] for col in old]
+        conn.execute(f"INSERT INTO survey_data_new ({', '.join(new)}) "
+                     f"SELECT {', '.join(old)} FROM survey_data")
+        for column, image_type in LEGACY_SURVEY_PHOTOS.items():
+            if column in columns:
+                conn.execute(f"INSERT INTO survey_images (survey_id, image_type, image) "
+                             f"SELECT id, ?, {column} FROM survey_data WHERE {column} IS NOT NULL",
+                             (image_type,))
+        conn.execute("DROP TABLE survey_data")
+        conn.execute("ALTER TABLE survey_data_new RENAME TO survey_data")
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS review_data (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                survey_id INTEGER,
+                structural_system TEXT,
+                arrangement_walls TEXT,
+                irregular_vertical TEXT,
+                irregular_vertical_photo BLOB,
+                irregular_horizontal TEXT,
+                irregular_horizontal_photo BLOB,
+                torsion_rotation TEXT,
+                torsion_rotation_photo BLOB,
+                structural_vulnerabilities TEXT,
+                heavy_finishes TEXT,
+                heavy_finishes_photo BLOB,
+                input_quality INTEGER,
+                soil_class TEXT,
+                load_capacity_reduction TEXT,
+                constructed_area INTEGER,
+                constructed_area_photo BLOB,
+                structure_performance TEXT,
+                retrofitting_methods TEXT,
+                reviewed BOOLEAN DEFAULT FALSE
+            )''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE,
+                password TEXT
+            )''')
+
+
+# 2) Indexes behind the review queue and image lookups
+def _review_queue_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_survey_images_survey_type "
+                 "ON survey_images (survey_id, image_type)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_review_data_survey_reviewed "
+                 "ON review_data (survey_id, reviewed)")
+
+
+# 3) Move review photos out of the wide review_data row into review_images
+def _review_images(conn):
+    conn.execute('''CREATE TABLE review_images (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                review_id INTEGER,
+                image_type TEXT,
+                image BLOB,
+                FOREIGN KEY (review_id) REFERENCES review_data(id)
+            )''')
+    conn.execute("CREATE INDEX idx_review_images_review_type ON review_images (review_id, image_type)")
+
+    for column in REVIEW_PHOTOS:
+        conn.execute(f"INSERT INTO review_images (review_id, image_type, image) "
+                     f"SELECT id, ?, {column} FROM review_data WHERE {column} IS NOT NULL",
+                     (column,))
+
+    # Rebuild review_data without the BLOB columns
+    conn.execute('''CREATE TABLE review_data_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                survey_id INTEGER,
+                structural_system TEXT,
+                arrangement_walls TEXT,
+                irregular_vertical TEXT,
+                irregular_horizontal TEXT,
+                torsion_rotation TEXT,
+                structural_vulnerabilities TEXT,
+                heavy_finishes TEXT,
+                input_quality INTEGER,
+                soil_class TEXT,
+                load_capacity_reduction TEXT,
+                constructed_area INTEGER,
+                structure_performance TEXT,
+                retrofitting_methods TEXT,
+                reviewed BOOLEAN DEFAULT FALSE
+            )''')
+    kept = ", ".join(_columns(conn, "review_data_new"))
+    conn.execute(f"INSERT INTO review_data_new ({kept}) SELECT {kept} FROM review_data")
+    conn.execute("DROP TABLE review_data")
+    conn.execute("ALTER TABLE review_data_new RENAME TO review_data")
+    conn.execute("CREATE INDEX idx_review_data_survey_reviewed ON review_data (survey_id, reviewed)")
+
+
+# 4) Formerly a survey_list view that no query read. It is no longer created;
+# migration 16 drops it from databases that have it. The version stays recorded
+# so later migrations keep their numbers.
+def _survey_list_view(conn):
+    pass
+
+
+# 5) Images live in the on-disk store; rows keep only the content hash
+def _image_hashes(conn):
+    for table in ("survey_images", "review_images"):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN image_hash TEXT")
+
+
+# 6) Several photos per question, kept in upload order
+def _image_ordinals(conn):
+    conn.execute("ALTER TABLE survey_images ADD COLUMN ordinal INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE review_images ADD COLUMN ordinal INTEGER NOT NULL DEFAULT 0")
+    conn.execute("DROP INDEX idx_survey_images_survey_type")
+    conn.execute("CREATE INDEX idx_survey_images_survey_type ON survey_images (survey_id, image_type, ordinal)")
+    conn.execute("DROP INDEX idx_review_images_review_type")
+    conn.execute("CREATE INDEX idx_review_images_review_type ON review_images (review_id, image_type, ordinal)")
+
+
+# 7) Indexes behind the review queue filters and sort orders
+def _queue_filter_indexes(conn):
+    for column in ("use_type", "importance_category", "year_construction", "num_floors"):
+        conn.execute(f"CREATE INDEX idx_survey_data_{column} ON survey_data ({column})")
+
+
+# (dimension, bucket, condition) of each summary count as migration 8 shipped it.
+# {row} is NEW or OLD inside the triggers and survey_data in the initial fill.
+# stats.add_surveys counts bulk imports with this list too.
+STATS_COUNTERS = (
+    ("total", "'surveys'", "1"),
+    ("use_type", "COALESCE({row}.use_type, 'Unknown')", "1"),
+    ("importance_category", "COALESCE({row}.importance_category, 'Unknown')", "1"),
+    ("decade", "COALESCE(({row}.year_construction / 10) * 10, 'Unknown')", "1"),
+    ("floors", "COALESCE({row}.num_floors, 'Unknown')", "1"),
+    ("hazard", "'danger_falling'", "{row}.danger_falling = 'Yes'"),
+    ("hazard", "'structure_condition'", "{row}.structure_condition = 'Corrosion/Spalling'"),
+    ("hazard", "'vertical_damage'", "{row}.vertical_damage = 'Yes'"),
+    ("hazard", "'danger_impact'", "{row}.danger_impact = 'Yes'"),
+    ("hazard", "'soft_floor'", "{row}.soft_floor = 'Yes'"),
+    ("hazard", "'short_column'", "{row}.short_column = 'Yes'"),
+)
+STATS_COLUMNS = ("use_type", "importance_category", "year_construction", "num_floors", "danger_falling",
+                 "structure_condition", "vertical_damage", "danger_impact", "soft_floor", "short_column")
+
+
+def _stats_increment(dimension, bucket, condition):
+    return (f"INSERT INTO survey_stats (dimension, bucket, count) SELECT '{dimension}', {bucket}, 1 "
+            f"WHERE {condition} ON CONFLICT (dimension, bucket) DO UPDATE SET count = count + 1;")
+
+
+def _stats_decrement(dimension, bucket, condition):
+    return (f"UPDATE survey_stats SET count = count - 1 "
+            f"WHERE dimension = '{dimension}' AND bucket = {bucket} AND {condition};")
+
+
+def _stats_counters(step, row):
+    return [step(d, b.format(row=row), c.format(row=row)) for d, b, c in STATS_COUNTERS]
+
+
+# 8) Trigger-maintained summary counts for the dashboard
+def _survey_stats(conn):
+    bump = _stats_increment("meta", "'generation'", "1")
+    other_review = ("SELECT 1 FROM review_data WHERE survey_id = {row}.survey_id "
+                    "AND reviewed = 1 AND id != {row}.id")
+    any_review = "SELECT 1 FROM review_data WHERE survey_id = {row}.survey_id AND reviewed = 1"
+    conn.execute('''CREATE TABLE IF NOT EXISTS survey_stats (
+                    dimension TEXT,
+                    bucket TEXT,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (dimension, bucket)
+                ) WITHOUT ROWID''')
+    triggers = {
+        "survey_stats_insert AFTER INSERT ON survey_data": _stats_counters(_stats_increment, "NEW"),
+        "survey_stats_delete AFTER DELETE ON survey_data": _stats_counters(_stats_decrement, "OLD"),
+        f"survey_stats_update AFTER UPDATE OF {', '.join(STATS_COLUMNS)} ON survey_data":
+            _stats_counters(_stats_decrement, "OLD") + _stats_counters(_stats_increment, "NEW"),
+        f"review_stats_insert AFTER INSERT ON review_data "
+        f"WHEN NEW.reviewed = 1 AND NOT EXISTS ({other_review.format(row='NEW')})":
+            [_stats_increment("review_status", "'Reviewed'", "1")],
+        f"review_stats_delete AFTER DELETE ON review_data "
+        f"WHEN OLD.reviewed = 1 AND NOT EXISTS ({any_review.format(row='OLD')})":
+            [_stats_decrement("review_status", "'Reviewed'", "1")],
+        "review_stats_update AFTER UPDATE OF reviewed, survey_id ON review_data "
+        "WHEN OLD.reviewed IS NOT NEW.reviewed OR OLD.survey_id IS NOT NEW.survey_id": [
+            _stats_decrement("review_status", "'Reviewed'",
+                             f"OLD.reviewed = 1 AND NOT EXISTS ({any_review.format(row='OLD')})"),
+            _stats_increment("review_status", "'Reviewed'",
+                             f"NEW.reviewed = 1 AND NOT EXISTS ({other_review.format(row='NEW')})"),
+        ],
+    }
+    for head, body in triggers.items():
+        conn.execute(f"CREATE TRIGGER {head} BEGIN\n" + "\n".join(body + [bump]) + "\nEND")
+
+    # Initial counts of the surveys already in the database
+    conn.execute("DELETE FROM survey_stats WHERE dimension != 'meta'")
+    for dimension, bucket, condition in STATS_COUNTERS:
+        conn.execute(f"INSERT INTO survey_stats (dimension, bucket, count) "
+                     f"SELECT '{dimension}', {bucket.format(row='survey_data')}, COUNT(*) FROM survey_data "
+                     f"WHERE {condition.format(row='survey_data')} GROUP BY 2")
+    conn.execute("INSERT INTO survey_stats (dimension, bucket, count) "
+                 "SELECT 'review_status', 'Reviewed', COUNT(DISTINCT survey_id) FROM review_data WHERE reviewed = 1")
+    conn.execute(bump)
+
+
+# 9) R*Tree over survey locations for the overview map
+def _survey_rtree(conn):
+    conn.execute("CREATE VIRTUAL TABLE survey_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+    conn.execute('''CREATE TRIGGER survey_rtree_insert AFTER INSERT ON survey_data
+                    WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL BEGIN
+                        INSERT INTO survey_rtree VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+                    END''')
+    conn.execute('''CREATE TRIGGER survey_rtree_update AFTER UPDATE OF latitude, longitude ON survey_data BEGIN
+                        DELETE FROM survey_rtree WHERE id = OLD.id;
+                        INSERT INTO survey_rtree SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+                            WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+                    END''')
+    conn.execute('''CREATE TRIGGER survey_rtree_delete AFTER DELETE ON survey_data BEGIN
+                        DELETE FROM survey_rtree WHERE id = OLD.id;
+                    END''')
+    conn.execute('''INSERT INTO survey_rtree
+                    SELECT id, latitude, latitude, longitude, longitude FROM survey_data
+                    WHERE latitude IS NOT NULL AND longitude IS NOT NULL''')
+
+
+# 10) Link probable duplicate surveys of the same building to its first survey
+def _duplicate_links(conn):
+    conn.execute("ALTER TABLE survey_data ADD COLUMN duplicate_of INTEGER REFERENCES survey_data(id)")
+    conn.execute("CREATE INDEX idx_survey_data_duplicate_of ON survey_data (duplicate_of)")
+
+
+# 11) Tickets of write-behind submissions already applied, so a replayed journal
+# entry is never inserted twice
+def _applied_submissions(conn):
+    conn.execute('''CREATE TABLE applied_submissions (
+                    ticket TEXT PRIMARY KEY,
+                    result INTEGER
+                ) WITHOUT ROWID''')
+
+
+# 12) Generation counter for caches of the reviewed listings
+def _review_generation(conn):
+    bump = _stats_increment("meta", "'reviews'", "1")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f"CREATE TRIGGER review_generation_{event.lower()} AFTER {event} ON review_data BEGIN\n"
+                     f"{bump}\nEND")
+
+
+# Survey and review columns the priority score depends on
+SCORED_SURVEY_COLUMNS = ("importance_category", "num_floors", "year_construction", "danger_falling",
+                         "structure_condition", "vertical_damage", "danger_impact", "soft_floor", "short_column")
+SCORED_REVIEW_COLUMNS = ("survey_id", "reviewed", "soil_class", "structural_system", "irregular_vertical",
+                         "irregular_horizontal", "torsion_rotation", "heavy_finishes")
+
+
+# 13) Priority scores stored with the version of the weights that produced them. A
+# NULL version marks a survey to rescore; triggers set it whenever an answer the
+# score depends on changes, so scoring.refresh() only touches those rows.
+def _priority_scores(conn):
+    conn.execute("ALTER TABLE survey_data ADD COLUMN priority_score REAL NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE survey_data ADD COLUMN score_version TEXT")
+    conn.execute("CREATE INDEX idx_survey_data_priority_score ON survey_data (priority_score)")
+    conn.execute("CREATE INDEX idx_survey_data_score_version ON survey_data (score_version)")
+    conn.execute(f'''CREATE TRIGGER survey_score_update AFTER UPDATE OF {", ".join(SCORED_SURVEY_COLUMNS)}
+                     ON survey_data BEGIN
+                         UPDATE survey_data SET score_version = NULL WHERE id = NEW.id;
+                     END''')
+    conn.execute('''CREATE TRIGGER review_score_insert AFTER INSERT ON review_data BEGIN
+                        UPDATE survey_data SET score_version = NULL WHERE id = NEW.survey_id;
+                    END''')
+    conn.execute(f'''CREATE TRIGGER review_score_update AFTER UPDATE OF {", ".join(SCORED_REVIEW_COLUMNS)}
+                     ON review_data BEGIN
+                         UPDATE survey_data SET score_version = NULL WHERE id IN (OLD.survey_id, NEW.survey_id);
+                     END''')
+    conn.execute('''CREATE TRIGGER review_score_delete AFTER DELETE ON review_data BEGIN
+                        UPDATE survey_data SET score_version = NULL WHERE id = OLD.survey_id;
+                    END''')
+
+
+# Tables and columns migration 14 tracks in the change log, which are also the
+# columns sync copies (changes.TRACKED)
+CHANGE_LOG_COLUMNS = {
+    "survey_data": ("latitude", "longitude", "use_type", "num_users", "importance_category", "danger_falling",
+                    "num_floors", "structure_condition", "year_construction", "vertical_damage", "danger_impact",
+                    "soft_floor", "short_column", "duplicate_of"),
+    "survey_images": ("survey_id", "image_type", "ordinal", "image_hash", "image"),
+    "review_data": ("survey_id", "structural_system", "arrangement_walls", "irregular_vertical",
+                    "irregular_horizontal", "torsion_rotation", "structural_vulnerabilities", "heavy_finishes",
+                    "input_quality", "soil_class", "load_capacity_reduction", "constructed_area",
+                    "structure_performance", "retrofitting_methods", "reviewed"),
+    "review_images": ("review_id", "image_type", "ordinal", "image_hash", "image"),
+}
+
+
+# 14) Change log with tombstones and sync bookkeeping, for delta sync between databases
+def _change_log(conn):
+    conn.execute('''CREATE TABLE change_log (
+                    table_name TEXT,
+                    row_id INTEGER,
+                    seq INTEGER NOT NULL,
+                    deleted INTEGER NOT NULL DEFAULT 0,
+                    origin TEXT,
+                    PRIMARY KEY (table_name, row_id)
+                ) WITHOUT ROWID''')
+    conn.execute("CREATE UNIQUE INDEX idx_change_log_seq ON change_log (seq)")
+    for table, columns in CHANGE_LOG_COLUMNS.items():
+        events = (("insert", "AFTER INSERT", "NEW", 0),
+                  ("update", f"AFTER UPDATE OF {', '.join(columns)}", "NEW", 0),
+                  ("delete", "AFTER DELETE", "OLD", 1))
+        for name, event, row, deleted in events:
+            conn.execute(f"CREATE TRIGGER change_log_{table}_{name} {event} ON {table} BEGIN\n"
+                         f"INSERT INTO change_log (table_name, row_id, seq, deleted) VALUES ('{table}', {row}.id, "
+                         f"(SELECT COALESCE(MAX(seq), 0) + 1 FROM change_log), {deleted}) "
+                         f"ON CONFLICT (table_name, row_id) DO UPDATE SET seq = excluded.seq, "
+                         f"deleted = excluded.deleted, origin = NULL;\nEND")
+        # Every existing row counts as changed, so a first sync sends everything
+        conn.execute(f'''INSERT INTO change_log (table_name, row_id, seq, deleted)
+                         SELECT '{table}', id,
+                                (SELECT COALESCE(MAX(seq), 0) FROM change_log) + ROW_NUMBER() OVER (ORDER BY id), 0
+                         FROM {table} WHERE true
+                         ON CONFLICT (table_name, row_id) DO UPDATE SET
+                             seq = excluded.seq, deleted = 0, origin = NULL''')
+
+    # Identity of this database, so peers can tell which changes came from it
+    conn.execute("CREATE TABLE sync_meta (name TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+    conn.execute("INSERT INTO sync_meta (name, value) VALUES ('database_id', lower(hex(randomblob(16))))")
+    # Per peer, the last of its change sequence numbers applied here
+    conn.execute("CREATE TABLE sync_state (peer TEXT PRIMARY KEY, received_seq INTEGER NOT NULL) WITHOUT ROWID")
+    # Rows received from a peer: our id and the id the row has in the peer
+    conn.execute('''CREATE TABLE sync_ids (
+                    peer TEXT,
+                    table_name TEXT,
+                    local_id INTEGER,
+                    remote_id INTEGER,
+                    PRIMARY KEY (peer, table_name, local_id)
+                ) WITHOUT ROWID''')
+    conn.execute("CREATE UNIQUE INDEX idx_sync_ids_remote ON sync_ids (peer, table_name, remote_id)")
+
+
+# 15) One review per survey, and leases on the listings reviewers are working on.
+# Surveys reviewed more than once keep their latest completed review, or their
+# latest draft if none was completed, which is the one every view already showed;
+# the superseded reviews and their photo rows are dropped.
+def _review_claims(conn):
+    conn.execute('''CREATE TABLE review_claims (
+                    survey_id INTEGER PRIMARY KEY REFERENCES survey_data(id),
+                    reviewer TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )''')
+    conn.execute("CREATE INDEX idx_review_claims_reviewer ON review_claims (reviewer, expires_at)")
+    superseded = '''SELECT id FROM review_data r WHERE id != (SELECT id FROM review_data k
+                                                        WHERE k.survey_id = r.survey_id
+                                                        ORDER BY reviewed DESC, id DESC LIMIT 1)'''
+    conn.execute(f"DELETE FROM review_images WHERE review_id IN ({superseded})")
+    conn.execute(f"DELETE FROM review_data WHERE id IN ({superseded})")
+    conn.execute("CREATE UNIQUE INDEX idx_review_data_survey ON review_data (survey_id)")
+
+
+# 16) Drop the unused survey_list view of migration 4
+def _drop_survey_list(conn):
+    conn.execute("DROP VIEW IF EXISTS survey_list")
+
+
+# Ordered list of (version, description, function). Append new migrations here;
+# never edit or reorder one that has shipped.
+MIGRATIONS = [
+    (1, "baseline survey schema", _baseline),
+    (2, "review queue indexes", _review_queue_indexes),
+    (3, "review photos in review_images", _review_images),
+    (4, "survey_list projection", _survey_list_view),
+    (5, "image store hashes", _image_hashes),
+    (6, "photo ordinals", _image_ordinals),
+    (7, "review queue filter indexes", _queue_filter_indexes),
+    (8, "survey statistics", _survey_stats),
+    (9, "survey location index", _survey_rtree),
+    (10, "duplicate survey links", _duplicate_links),
+    (11, "write-behind submission tickets", _applied_submissions),
+    (12, "review generation counter", _review_generation),
+    (13, "priority scores", _priority_scores),
+    (14, "change tracking for sync", _change_log),
+    (15, "one review per survey and review claims", _review_claims),
+    (16, "drop the survey_list view", _drop_survey_list),
+]
+
+
+# Function to return the schema version a database is at
+def current_version(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at REAL
+                )''')
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+
+
+# Function to apply every pending migration, each in its own transaction.
+# Returns the list of versions applied.
+def migrate(conn):
+    applied = []
+    if current_version(conn) >= MIGRATIONS[-1][0]:
+        return applied
+    for version, description, func in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-check under the write lock in case another process migrated first
+            if version <= current_version(conn):
+                conn.rollback()
+                continue
+            func(conn)
+            conn.execute("INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)",
+                         (version, description, time.time()))
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        applied.append(version)
+    return applied
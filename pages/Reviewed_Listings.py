@@ -1,16 +1,129 @@
 import streamlit as st
 import folium
 from streamlit_folium import st_folium
-from PIL import Image
-import sqlite3
-import io
-from folium.plugins import LocateControl
 
+import db
+import stats
+import survey_options
+import tiles
+from app_resources import get_pool, load_image
 
-# Initialize SQLite database
-conn = sqlite3.connect('building_survey.db')
-c = conn.cursor()
+
+# Database pool shared by every session and page
+pool = get_pool()
+
+# Number of photos shown per row when a review's photos are loaded
+PHOTOS_PER_ROW = 4
+
+# Labels of the review answers shown for the selected listing
+ANSWER_LABELS = {
+    "structural_system": "Structural System",
+    "arrangement_walls": "Arrangement of Walls",
+    "irregular_vertical": "Vertical Irregularity",
+    "irregular_horizontal": "Horizontal Irregularity",
+    "torsion_rotation": "Torsion/Rotation",
+    "structural_vulnerabilities": "Structural Vulnerabilities",
+    "heavy_finishes": "Heavy Finishes",
+    "input_quality": "Input Quality",
+    "soil_class": "Soil Class",
+    "load_capacity_reduction": "Load Capacity Reduction",
+    "constructed_area": "Constructed Area",
+    "structure_performance": "Structure Performance",
+    "retrofitting_methods": "Retrofitting Methods",
+}
+
+# Cached pages and answers are keyed on the review generation, which triggers bump on
+# every write to review_data, so a new or edited review is listed on the next rerun
+# while unchanged pages are served without touching the database.
+@st.cache_data(max_entries=256)
+def load_page(generation, filters, after):
+    with pool.connection() as conn:
+        rows, next_cursor = db.fetch_reviewed_page(conn, filters, after)
+        return db.count_reviewed(conn, filters), rows, next_cursor
+
+@st.cache_data(max_entries=256)
+def load_answers(generation, review_id):
+    with pool.connection() as conn:
+        return db.fetch_review_answers(conn, review_id)
+
+# Function to show the thumbnails of a listing's photos. Nothing is read until the
+# reviewer asks for the photos of that listing.
+def display_photos(review_id, survey_id):
+    if not st.toggle("Show photos", key=f"photos_{review_id}"):
+        return
+    with pool.connection() as conn:
+        photos = [("survey_images", img_type, photo)
+                  for img_type, entries in db.fetch_survey_images(conn, survey_id).items() for photo in entries]
+        photos += [("review_images", img_type, photo)
+                   for img_type, entries in db.fetch_review_images(conn, review_id).items() for photo in entries]
+    if not photos:
+        st.info("No photos were submitted for this listing.")
+        return
+    columns = st.columns(PHOTOS_PER_ROW)
+    for i, (table, img_type, (image_id, image_hash)) in enumerate(photos):
+        with columns[i % PHOTOS_PER_ROW]:
+            st.image(load_image(table, image_id, image_hash, thumbnail=True),
+                     caption=img_type.removesuffix("_photo").replace("_", " ").capitalize(),
+                     use_container_width=True)
+
+# Function to show the survey and review answers of the selected listing
+def display_review(generation, listing):
+    review_id, survey_id, latitude, longitude, use_type, importance_category = listing[:6]
+    st.header(f"Review {review_id} of Listing {survey_id}")
+    st.write("**Location:**", f"Latitude: {latitude}, Longitude: {longitude}")
+    m = folium.Map(location=[latitude, longitude], zoom_start=16, tiles=tiles.TILE_URL,
+                   attr=tiles.ATTRIBUTION)
+    folium.Marker([latitude, longitude], popup="Building Location").add_to(m)
+    st_folium(m, width=700, height=250, returned_objects=[])
+    st.write("**Type of Use:**", use_type)
+    st.write("**Building Importance Category:**", importance_category)
+
+    answers = load_answers(generation, review_id)
+    for column, label in ANSWER_LABELS.items():
+        st.write(f"**{label}:**", answers[column])
+    display_photos(review_id, survey_id)
+
+# Only administrators browse reviews; they log in on the main page
+if not st.session_state.get("logged_in"):
+    st.title("Reviewed Listings")
+    st.info("Log in as admin on the main page to browse the reviewed listings.")
+    st.stop()
 
 st.title("Reviewed Listings")
 
-st.write("Select a listing from the list.")
+with st.expander("Filters"):
+    filters = {
+        "structural_systems": st.multiselect("Structural System", survey_options.STRUCTURAL_SYSTEMS,
+                                             key="reviewed_systems"),
+        "soil_classes": st.multiselect("Soil Class", survey_options.SOIL_CLASSES, key="reviewed_soil"),
+        "use_types": st.multiselect("Type of Use", survey_options.USE_TYPES, key="reviewed_use_types"),
+    }
+
+# Start again from the first page whenever the filters change
+query_key = repr(filters)
+if st.session_state.get("reviewed_key") != query_key:
+    st.session_state.reviewed_key = query_key
+    st.session_state.reviewed_cursors = [None]
+cursors = st.session_state.reviewed_cursors
+
+with pool.connection() as conn:
+    generation = stats.review_generation(conn)
+total, listings, next_cursor = load_page(generation, filters, cursors[-1])
+
+if not listings:
+    st.info("No reviewed listings available.")
+    st.stop()
+
+st.caption(f"{total} reviewed listings - page {len(cursors)}")
+previous_col, next_col = st.columns(2)
+if previous_col.button("Previous page", disabled=len(cursors) == 1):
+    cursors.pop()
+    st.rerun()
+if next_col.button("Next page", disabled=next_cursor is None):
+    cursors.append(next_cursor)
+    st.rerun()
+
+listing_labels = {listing[0]: f"Listing {listing[1]} - {listing[4]} - {listing[6]}, soil class {listing[7]}"
+                  for listing in listings}
+selected = st.selectbox("Select a listing from the list.", list(listing_labels), format_func=listing_labels.get)
+display_review(generation, next(listing for listing in listings if listing[0] == selected))
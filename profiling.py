@@ -0,0 +1,291 @@
+import argparse
+import collections
+import functools
+import json
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Instrumentation is opt-in: when unset, connections are plain and sections cost a
+# thread-local lookup
+ENABLED = os.environ.get("BUILDING_SURVEY_PROFILE", "") not in ("", "0", "false")
+
+# Rolling log of one JSON line per rerun, for reviewing production latency
+METRICS_LOG = os.environ.get("BUILDING_SURVEY_METRICS_LOG", "metrics.jsonl")
+
+# Size at which the log is rotated to <log>.1, roughly 20k reruns
+MAX_LOG_BYTES = 5 * 1024 * 1024
+
+# SQLite VM instructions between progress callbacks; the count approximates how
+# much work each statement made SQLite do
+PROGRESS_STEPS = 1000
+
+# Statements shown in the diagnostics panel, slowest first
+TOP_STATEMENTS = 15
+
+PERCENTILES = (50, 90, 99)
+
+_local = threading.local()
+_log_lock = threading.Lock()
+
+
+class Statement:
+    def __init__(self, sql):
+        self.sql = " ".join(sql.split())
+        self.seconds = 0.0
+        self.rows = 0
+        self.steps = 0
+        self.expanded = None
+
+
+class Profiler:
+    """Timings of one Streamlit rerun: wall time per section and every SQL statement."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.total = None
+        self.sections = {}
+        self.statements = []
+        self._stack = []
+
+    @contextmanager
+    def section(self, name):
+        start = time.perf_counter()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            self.sections[name] = self.sections.get(name, 0.0) + time.perf_counter() - start
+
+    def statement(self, sql):
+        statement = Statement(sql)
+        self.statements.append(statement)
+        return statement
+
+    def sql_seconds(self):
+        return sum(statement.seconds for statement in self.statements)
+
+    # Function to aggregate statements by text, slowest first, as dicts of sql, calls,
+    # ms, rows, steps and the slowest call with its parameters bound
+    def top_statements(self, limit=TOP_STATEMENTS):
+        grouped = {}
+        for statement in self.statements:
+            entry = grouped.setdefault(statement.sql, {"sql": statement.sql, "calls": 0, "ms": 0.0, "rows": 0,
+                                                       "steps": 0, "slowest": None, "_slowest": -1.0})
+            entry["calls"] += 1
+            entry["ms"] += statement.seconds * 1000
+            entry["rows"] += statement.rows
+            entry["steps"] += statement.steps
+            if statement.seconds > entry["_slowest"]:
+                entry["_slowest"], entry["slowest"] = statement.seconds, statement.expanded or statement.sql
+        ranked = sorted(grouped.values(), key=lambda entry: entry["ms"], reverse=True)[:limit]
+        for entry in ranked:
+            del entry["_slowest"]
+            entry["ms"] = round(entry["ms"], 3)
+        return ranked
+
+    def record(self):
+        return {"timestamp": time.time(), "page": self.name, "total_ms": round(self.total * 1000, 2),
+                "sql_ms": round(self.sql_seconds() * 1000, 2), "statements": len(self.statements),
+                "sections": {name: round(seconds * 1000, 2) for name, seconds in self.sections.items()}}
+
+
+def current():
+    return getattr(_local, "profiler", None)
+
+
+# Function to begin profiling a rerun on this thread. Returns None when disabled.
+def start(name):
+    _local.profiler = Profiler(name) if ENABLED else None
+    return _local.profiler
+
+
+# Function to end the rerun's profile and append it to the metrics log
+def finish(log=METRICS_LOG):
+    profiler = current()
+    if profiler is None:
+        return None
+    _local.profiler = None
+    profiler.total = time.perf_counter() - profiler.started
+    append_metrics(profiler.record(), log)
+    return profiler
+
+
+@contextmanager
+def section(name):
+    profiler = current()
+    if profiler is None:
+        yield
+        return
+    with profiler.section(name):
+        yield
+
+
+# Function to time every call of a function as a section named after it
+def timed(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with section(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor that charges execution and fetch time, and rows returned, to the
+    statement it is running. SQLite steps lazily, so fetching is where most of a
+    query's time goes."""
+
+    _statement = None
+
+    def _timed(self, method, *args):
+        statement = self._statement
+        if statement is None:
+            return method(*args)
+        _local.statement = statement
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            statement.seconds += time.perf_counter() - start
+            _local.statement = None
+
+    def execute(self, sql, parameters=()):
+        profiler = current()
+        self._statement = profiler.statement(sql) if profiler else None
+        self._timed(super().execute, sql, parameters)
+        if self._statement is not None and self.description is None:
+            self._statement.rows = max(self.rowcount, 0)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        profiler = current()
+        self._statement = profiler.statement(sql) if profiler else None
+        self._timed(super().executemany, sql, seq_of_parameters)
+        if self._statement is not None:
+            self._statement.rows = max(self.rowcount, 0)
+        return self
+
+    def _count(self, rows):
+        if self._statement is not None:
+            self._statement.rows += rows
+        return rows
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        self._count(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._timed(super().fetchmany, size or self.arraysize)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._count(len(rows))
+        return rows
+
+    def __next__(self):
+        row = self._timed(super().__next__)
+        self._count(1)
+        return row
+
+
+class TracedConnection(sqlite3.Connection):
+    """Connection whose statements are recorded on the profiler of the calling thread.
+
+    The trace callback keeps each statement as SQLite ran it, with its parameters
+    bound, and the progress handler counts its VM instructions, both charged to
+    the statement being timed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(_on_trace)
+        self.set_progress_handler(_on_progress, PROGRESS_STEPS)
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _on_trace(sql):
+    statement = getattr(_local, "statement", None)
+    if statement is not None and statement.expanded is None:
+        statement.expanded = sql
+
+
+def _on_progress():
+    statement = getattr(_local, "statement", None)
+    if statement is not None:
+        statement.steps += PROGRESS_STEPS
+    # A non-zero return would abort the statement
+    return 0
+
+
+# Function to append one rerun to the metrics log, rotating it once it is full
+def append_metrics(record, log=METRICS_LOG):
+    with _log_lock:
+        try:
+            if os.path.exists(log) and os.path.getsize(log) >= MAX_LOG_BYTES:
+                os.replace(log, log + ".1")
+            with open(log, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError:
+            # Metrics must never break the page
+            pass
+
+
+def _percentiles(values):
+    if len(values) < 2:
+        return {f"p{p}": round(values[0], 2) if values else None for p in PERCENTILES}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {f"p{p}": round(cuts[p - 1], 2) for p in PERCENTILES}
+
+
+# Function to read the metrics log and return, per page and per section, the count
+# of reruns and the p50/p90/p99 in milliseconds
+def summarize(log=METRICS_LOG, last=None):
+    samples = {}
+    try:
+        with open(log, encoding="utf-8") as f:
+            lines = collections.deque(f, maxlen=last)
+    except OSError:
+        return {}
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # A line cut short by a crash or a full disk is skipped, not fatal
+            continue
+        samples.setdefault(f"{record['page']} (total)", []).append(record["total_ms"])
+        samples.setdefault(f"{record['page']} (sql)", []).append(record["sql_ms"])
+        for name, ms in record["sections"].items():
+            samples.setdefault(name, []).append(ms)
+    return {name: {"reruns": len(values), **_percentiles(values)} for name, values in sorted(samples.items())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarise the rerun metrics log with percentiles.")
+    parser.add_argument("log", nargs="?", default=METRICS_LOG)
+    parser.add_argument("--last", type=int, help="only the most recent N reruns")
+    args = parser.parse_args(argv)
+    summary = summarize(args.log, args.last)
+    print(f"{'section':<40} {'reruns':>7} " + " ".join(f"{'p' + str(p):>9}" for p in PERCENTILES))
+    for name, row in summary.items():
+        print(f"{name:<40} {row['reruns']:>7} " + " ".join(f"{row[f'p{p}']:>9}" for p in PERCENTILES))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+import argparse
+import html
+import io
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import db
+import image_store
+import tiles
+
+
+# Directory of rendered location maps, reused by every later report run
+MAP_CACHE_DIR = os.environ.get("BUILDING_SURVEY_MAP_CACHE", "static_maps")
+
+# Zoom level and pixel size of the location map of each report
+MAP_ZOOM = 17
+MAP_SIZE = (640, 400)
+
+TILE_SIZE = 256
+
+# Report worker processes. Rendering maps and pages is CPU-bound, so one per core.
+WORKERS = os.cpu_count() or 1
+
+# Reports handed to a worker per round trip
+CHUNK_SIZE = 16
+
+# Survey answers of a report, labelled as on the survey form
+SURVEY_FIELDS = (
+    ("use_type", "Type of Use"),
+    ("num_users", "Number of Users"),
+    ("importance_category", "Building Importance Category"),
+    ("danger_falling", "Danger of Non-Structural Element Falling"),
+    ("num_floors", "Number of Floors"),
+    ("structure_condition", "Condition of Structure"),
+    ("year_construction", "Year of Construction"),
+    ("vertical_damage", "Previous Damages in Vertical Elements"),
+    ("danger_impact", "Danger of Impact with Neighboring Buildings"),
+    ("soft_floor", "Soft Floor (Pilotis)"),
+    ("short_column", "Short Column"),
+)
+
+# Review findings of a report, labelled as on the review form. Retrofitting methods
+# get a section of their own.
+REVIEW_FIELDS = (
+    ("structural_system", "Type of Structural System"),
+    ("arrangement_walls", "Arrangement of Walls"),
+    ("irregular_vertical", "Irregular Structures Vertically"),
+    ("irregular_horizontal", "Irregular Structures Horizontally"),
+    ("torsion_rotation", "Torsion/Rotation"),
+    ("structural_vulnerabilities", "Structural Vulnerabilities"),
+    ("heavy_finishes", "Heavy Finishes"),
+    ("input_quality", "Quality of User Input (1-5)"),
+    ("soil_class", "Soil Class"),
+    ("load_capacity_reduction", "Load Bearing Capacity Reduction (R)"),
+    ("constructed_area", "Total Constructed Area"),
+    ("structure_performance", "Additional Description of Structure Performance"),
+)
+
+# Review answers stored comma-separated, see validation.REVIEW_MULTI_CHOICES
+MULTI_CHOICE_FIELDS = ("structural_vulnerabilities", "retrofitting_methods")
+
+# Caption of each photo question
+PHOTO_CAPTIONS = {
+    "falling_photo": "Non-Structural Element",
+    "rust_photo": "Corrosion/Spalling",
+    "damage_photo": "Vertical Element Damage",
+    "impact_photo": "Neighboring Building",
+    "soft_floor_photo": "Soft Floor (Pilotis)",
+    "short_column_photo": "Short Column",
+    "irregular_vertical_photo": "Vertical irregularity",
+    "irregular_horizontal_photo": "Horizontal irregularity",
+    "torsion_rotation_photo": "Torsion/Rotation",
+    "heavy_finishes_photo": "Heavy finishes",
+    "constructed_area_photo": "Constructed area",
+}
+
+STYLE = '''body { font-family: sans-serif; max-width: 60em; margin: 2em auto; color: #222; }
+           table { border-collapse: collapse; width: 100%; margin-bottom: 1.5em; }
+           th, td { border-bottom: 1px solid #ddd; padding: 0.3em 0.5em; text-align: left; vertical-align: top; }
+           th { width: 45%; font-weight: normal; color: #555; }
+           figure { display: inline-block; margin: 0 0.5em 0.5em 0; }
+           figcaption { font-size: 0.8em; color: #555; }
+           img { max-width: 100%; }
+           @media print { body { margin: 0; } h2 { break-after: avoid; } figure { break-inside: avoid; } }'''
+
+
+# Function to convert a latitude/longitude to its global pixel position at a zoom level
+def _pixel(lat, lon, z):
+    lat = max(min(lat, 85.0511), -85.0511)
+    scale = TILE_SIZE * (1 << z)
+    return ((lon + 180.0) / 360.0 * scale,
+            (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * scale)
+
+
+# Function to list the tiles behind the location map of a point. Returns (left, top,
+# tiles), with the global pixel of the map's top-left corner.
+def map_tiles(lat, lon, zoom=MAP_ZOOM, size=MAP_SIZE):
+    x, y = _pixel(lat, lon, zoom)
+    left, top = int(x - size[0] / 2), int(y - size[1] / 2)
+    needed = [(zoom, tx, ty)
+              for tx in range(left // TILE_SIZE, (left + size[0] - 1) // TILE_SIZE + 1)
+              for ty in range(top // TILE_SIZE, (top + size[1] - 1) // TILE_SIZE + 1)]
+    return left, top, [tile for tile in needed if tiles.valid_tile(*tile)]
+
+
+def map_path(map_dir, lat, lon, zoom=MAP_ZOOM, size=MAP_SIZE):
+    return os.path.join(map_dir, f"{zoom}_{size[0]}x{size[1]}_{lat:.6f}_{lon:.6f}.png")
+
+
+# Function to draw the location map of a point from cached basemap tiles, with a
+# marker on the building. Never goes upstream. Returns (PNG bytes, whether every
+# tile was cached). Pillow is imported here like in image_store.make_thumbnail().
+def render_map(cache, lat, lon, zoom=MAP_ZOOM, size=MAP_SIZE):
+    from PIL import Image, ImageDraw
+
+    left, top, needed = map_tiles(lat, lon, zoom, size)
+    img = Image.new("RGB", size, (229, 227, 223))
+    complete = True
+    for z, tx, ty in needed:
+        data = cache.cached(z, tx, ty)
+        if data is None:
+            complete = False
+            continue
+        img.paste(Image.open(io.BytesIO(data)).convert("RGB"), (tx * TILE_SIZE - left, ty * TILE_SIZE - top))
+    draw = ImageDraw.Draw(img)
+    cx, cy = size[0] // 2, size[1] // 2
+    draw.ellipse((cx - 8, cy - 8, cx + 8, cy + 8), fill=(214, 39, 40), outline=(255, 255, 255), width=3)
+    text = "(c) OpenStreetMap contributors"
+    x0, y0, x1, y1 = draw.textbbox((0, 0), text)
+    origin = (size[0] - (x1 - x0) - 6, size[1] - (y1 - y0) - 6)
+    draw.rectangle((origin[0] - 3, origin[1] - 3, size[0], size[1]), fill=(255, 255, 255))
+    draw.text(origin, text, fill=(60, 60, 60))
+    buffered = io.BytesIO()
+    img.save(buffered, format="PNG", optimize=True)
+    return buffered.getvalue(), complete
+
+
+# Function to return the location map of a point as a cached file path, rendering it
+# on a miss. Maps missing some tiles are returned as bytes and not cached, so they
+# are drawn again once the tiles are there.
+def location_map(cache, map_dir, lat, lon):
+    path = map_path(map_dir, lat, lon)
+    if os.path.exists(path):
+        return path
+    data, complete = render_map(cache, lat, lon)
+    if not complete:
+        return data
+    # Write to a temporary file and rename, so other workers never read a partial map
+    os.makedirs(map_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=map_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return path
+
+
+# Function to return the path of a photo's thumbnail, deriving it first if the store
+# lacks it. Returns None for photos missing from the store or still held as BLOBs
+# (see image_store.migrate_blobs).
+def thumbnail_path(store, image_hash):
+    if not image_hash:
+        return None
+    path = store.path(image_hash, thumbnail=True)
+    if not os.path.exists(path):
+        try:
+            store.put(store.read(image_hash))
+        except FileNotFoundError:
+            return None
+    return path
+
+
+def _text(value):
+    if value is None or value == "":
+        return "-"
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+
+def _rows(pairs):
+    return "\n".join(f"<tr><th>{html.escape(label)}</th><td>{html.escape(_text(value))}</td></tr>"
+                     for label, value in pairs)
+
+
+# Function to render the report of one building. ``cache`` is the tile cache the
+# location map is drawn from, or None for a report without a map. Returns (HTML
+# bytes, files, summary): files are (name in the bundle, path or bytes) of the map
+# and photo thumbnails the page links to, summary is what the index lists.
+def build_report(conn, store, cache, map_dir, survey_id):
+    columns = ["latitude", "longitude"] + [column for column, _ in SURVEY_FIELDS]
+    row = conn.execute(f"SELECT {', '.join(columns)} FROM survey_data WHERE id = ?", (survey_id,)).fetchone()
+    if row is None:
+        return None
+    survey = dict(zip(columns, row))
+    review = conn.execute("SELECT id FROM review_data WHERE survey_id = ?", (survey_id,)).fetchone()
+    answers = db.fetch_review_answers(conn, review[0]) if review else {}
+    photos = db.fetch_survey_images(conn, survey_id)
+    if review:
+        for img_type, images in db.fetch_review_images(conn, review[0]).items():
+            photos.setdefault(img_type, []).extend(images)
+
+    files, sections = [], []
+    lat, lon = survey["latitude"], survey["longitude"]
+    location = f"{lat:.6f}, {lon:.6f}" if lat is not None and lon is not None else "-"
+    sections.append(f"<h2>Location</h2>\n<p>{location}</p>")
+    if cache is not None and lat is not None and lon is not None:
+        files.append(("map.png", location_map(cache, map_dir, lat, lon)))
+        sections.append('<img src="map.png" alt="Location map">')
+
+    answered = _rows((label, survey[col]) for col, label in SURVEY_FIELDS)
+    sections.append(f"<h2>Survey</h2>\n<table>\n{answered}\n</table>")
+    if review:
+        for column in MULTI_CHOICE_FIELDS:
+            answers[column] = [item for item in (answers[column] or "").split(",") if item]
+        findings = [(label, ", ".join(answers[col]) if col in MULTI_CHOICE_FIELDS else answers[col])
+                    for col, label in REVIEW_FIELDS]
+        sections.append(f"<h2>Review findings</h2>\n<table>\n{_rows(findings)}\n</table>")
+        methods = answers["retrofitting_methods"]
+        items = "".join(f"<li>{html.escape(method)}</li>" for method in methods) or "<li>None proposed</li>"
+        sections.append(f"<h2>Retrofitting methods</h2>\n<ul>{items}</ul>")
+    else:
+        sections.append("<h2>Review findings</h2>\n<p>Not reviewed yet.</p>")
+
+    figures = []
+    for img_type, images in photos.items():
+        for ordinal, (_, image_hash) in enumerate(images):
+            path = thumbnail_path(store, image_hash)
+            if path is None:
+                continue
+            name = f"photos/{img_type}_{ordinal}{store.extension(image_hash, thumbnail=True)}"
+            files.append((name, path))
+            caption = html.escape(PHOTO_CAPTIONS.get(img_type, img_type))
+            figures.append(f'<figure><img src="{name}" alt="{caption}"><figcaption>{caption}</figcaption></figure>')
+    if figures:
+        sections.append("<h2>Photos</h2>\n" + "\n".join(figures))
+
+    title = f"Building {survey_id}"
+    page = (f'<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n<title>{title}</title>\n'
+            f"<style>{STYLE}</style>\n</head>\n<body>\n<h1>{title}</h1>\n" + "\n".join(sections)
+            + "\n</body>\n</html>\n")
+    summary = (survey_id, location, survey["use_type"], answers.get("structural_system"), answers.get("soil_class"))
+    return page.encode("utf-8"), files, summary
+
+
+# Database, image store, tile cache and map directory of this worker process
+_worker = {}
+
+
+# Function to open what a report worker needs, once per process. The parent has
+# already migrated the database, so a plain pool is enough.
+def _init_worker(db_path, store_root, tile_path, map_dir):
+    _worker.update(pool=db.ConnectionPool(db_path, size=1), store=image_store.ImageStore(store_root),
+                   cache=tiles.TileCache(tile_path) if tile_path else None, map_dir=map_dir)
+
+
+def _render(survey_id):
+    with _worker["pool"].connection() as conn:
+        return survey_id, build_report(conn, _worker["store"], _worker["cache"], _worker["map_dir"], survey_id)
+
+
+# Function to fetch the basemap tiles of the maps not rendered yet. Runs in the
+# parent through the shared tile cache, so its upstream limit holds however many
+# workers render. Like a seed run, it refuses to request more than max_tiles.
+# Returns (tiles fetched, tiles that failed).
+def prefetch_tiles(conn, cache, survey_ids, map_dir=MAP_CACHE_DIR, max_tiles=tiles.MAX_SEED_TILES):
+    needed = set()
+    for survey_id in survey_ids:
+        row = conn.execute("SELECT latitude, longitude FROM survey_data WHERE id = ?", (survey_id,)).fetchone()
+        if row is None or None in row or os.path.exists(map_path(map_dir, *row)):
+            continue
+        needed.update(tile for tile in map_tiles(*row)[2] if tile not in cache)
+        if len(needed) > max_tiles:
+            raise ValueError(f"the maps need more than {max_tiles} uncached tiles; seed the area with "
+                             f"tiles.py or generate the reports offline")
+    with ThreadPoolExecutor(max_workers=cache.concurrency) as executor:
+        fetched = sum(data is not None for data in executor.map(lambda tile: cache.get(*tile), needed))
+    return fetched, len(needed) - fetched
+
+
+def _index(summaries):
+    rows = "\n".join(f'<tr><td><a href="{survey_id}/report.html">{survey_id}</a></td>'
+                     + "".join(f"<td>{html.escape(_text(value))}</td>" for value in values) + "</tr>"
+                     for survey_id, *values in summaries)
+    return (f'<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="utf-8">\n<title>Building reports</title>\n'
+            f"<style>{STYLE}</style>\n</head>\n<body>\n<h1>Building reports</h1>\n<table>\n"
+            f"<tr><th>Building</th><th>Location</th><th>Type of Use</th><th>Structural System</th>"
+            f"<th>Soil Class</th></tr>\n{rows}\n</table>\n</body>\n</html>\n").encode("utf-8")
+
+
+# Function to write the reports of ``survey_ids`` into a zip streamed to ``out``, as
+# <id>/report.html with its map and photo thumbnails, plus an index.html. Pages are
+# rendered by ``workers`` processes and added as they arrive, in id order.
+# ``progress`` is called with (done, total). Without a tile cache, reports have no
+# map; with fetch_tiles, missing basemap tiles are downloaded first. Returns the
+# number of reports written.
+def generate_reports(pool, store, survey_ids, out, tile_cache=None, map_dir=MAP_CACHE_DIR, workers=WORKERS,
+                     fetch_tiles=True, progress=None):
+    survey_ids = list(survey_ids)
+    if tile_cache is not None and fetch_tiles:
+        with pool.connection() as conn:
+            prefetch_tiles(conn, tile_cache, survey_ids, map_dir)
+    summaries = []
+    # Workers are spawned rather than forked, so they do not inherit the parent's
+    # SQLite connections or the locks of its threads
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                initializer=_init_worker,
+                                initargs=(pool.path, store.root, tile_cache.pool.path if tile_cache else None,
+                                          map_dir)) as executor:
+        for done, (survey_id, report) in enumerate(executor.map(_render, survey_ids, chunksize=CHUNK_SIZE), 1):
+            if report is not None:
+                page, files, summary = report
+                zf.writestr(f"{survey_id}/report.html", page)
+                # Maps and thumbnails are already compressed; storing them saves the CPU
+                for name, source in files:
+                    if isinstance(source, bytes):
+                        zf.writestr(f"{survey_id}/{name}", source, compress_type=zipfile.ZIP_STORED)
+                    else:
+                        zf.write(source, f"{survey_id}/{name}", compress_type=zipfile.ZIP_STORED)
+                summaries.append(summary)
+            if progress:
+                progress(done, len(survey_ids))
+        zf.writestr("index.html", _index(summaries))
+    return len(summaries)
+
+
+# Function to run generate_reports in a background thread, writing the zip to
+# ``path``, so the caller returns at once. Returns the job, a dict whose "done",
+# "total", "count" and "error" entries are updated as the run goes; "finished" is
+# set once it ends. A failed run removes ``path``.
+def start_reports(pool, store, survey_ids, path, tile_cache=None, **options):
+    survey_ids = list(survey_ids)
+    job = {"path": path, "done": 0, "total": len(survey_ids), "count": None, "error": None,
+           "finished": threading.Event()}
+
+    def progress(done, total):
+        job["done"] = done
+
+    def run():
+        try:
+            with open(path, "wb") as out:
+                job["count"] = generate_reports(pool, store, survey_ids, out, tile_cache, progress=progress,
+                                                **options)
+        except Exception as e:
+            job["error"] = str(e) or type(e).__name__
+            os.unlink(path)
+        finally:
+            job["finished"].set()
+
+    threading.Thread(target=run, name="report-generator", daemon=True).start()
+    return job
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate per-building reports of reviewed surveys into a zip.")
+    parser.add_argument("output", help="zip file to write")
+    parser.add_argument("--survey", type=int, nargs="+", help="ids of the surveys to report on; "
+                                                               "by default every reviewed survey matching the filters")
+    parser.add_argument("--structural-system", nargs="+", default=[], help="only these structural systems")
+    parser.add_argument("--soil-class", nargs="+", default=[], help="only these soil classes")
+    parser.add_argument("--use-type", nargs="+", default=[], help="only these types of use")
+    parser.add_argument("--db", default=db.DB_PATH, help="path of the survey database")
+    parser.add_argument("--store", default=image_store.IMAGE_STORE_DIR, help="root directory of the image store")
+    parser.add_argument("--tile-cache", default=tiles.TILE_DB_PATH, help="MBTiles cache the maps are drawn from")
+    parser.add_argument("--map-cache", default=MAP_CACHE_DIR, help="directory of rendered location maps")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="report worker processes")
+    parser.add_argument("--no-maps", action="store_true", help="leave the location map out of the reports")
+    parser.add_argument("--offline", action="store_true", help="draw maps from cached tiles only")
+    args = parser.parse_args(argv)
+
+    pool = db.get_pool(args.db)
+    survey_ids = args.survey
+    if survey_ids is None:
+        with pool.connection() as conn:
+            survey_ids = db.fetch_reviewed_survey_ids(conn, {"structural_systems": args.structural_system,
+                                                             "soil_classes": args.soil_class,
+                                                             "use_types": args.use_type})
+    tile_cache = None if args.no_maps else tiles.TileCache(args.tile_cache)
+
+    def progress(done, total):
+        if done % 100 == 0 or done == total:
+            print(f"\r{done}/{total} reports", end="", flush=True)
+
+    with open(args.output, "wb") as out:
+        count = generate_reports(pool, image_store.ImageStore(args.store), survey_ids, out, tile_cache,
+                                 args.map_cache, args.workers, not args.offline, progress)
+    print(f"\nWrote {count} reports to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import db
+
+
+# Optional JSON file overriding parts of SCORING, e.g. to re-weight soil classes
+SCORING_PATH = os.environ.get("BUILDING_SURVEY_SCORING")
+
+# Pre-earthquake priority score of a building: the points of its survey and latest
+# completed review answers, plus points for an older seismic code and for height,
+# multiplied by its importance category. Higher means inspect sooner.
+SCORING = {
+    # column -> {answer: points}; other answers and unanswered questions score 0
+    "answers": {
+        "soft_floor": {"Yes": 2.0},
+        "short_column": {"Yes": 1.5},
+        "structure_condition": {"Corrosion/Spalling": 1.0},
+        "vertical_damage": {"Yes": 1.5},
+        "danger_impact": {"Yes": 1.0},
+        "danger_falling": {"Yes": 0.5},
+        "soil_class": {"A": 0.0, "B": 0.5, "C": 1.0},
+        "structural_system": {"RC-frames": 0.0, "RC-walls": -0.5, "Brick walls": 1.5},
+        "irregular_vertical": {"Yes": 1.0},
+        "irregular_horizontal": {"Yes": 1.0},
+        "torsion_rotation": {"Yes": 1.0},
+        "heavy_finishes": {"Yes": 0.5},
+    },
+    # [year, points]: buildings constructed before the year, first match wins. The
+    # years follow the 1959 and 1985 Greek seismic codes and the 1995 EAK.
+    "code_eras": [[1959, 2.0], [1985, 1.0], [1995, 0.5]],
+    # Points per floor above base_floors, up to max_points
+    "floors": {"base_floors": 2, "points_per_floor": 0.25, "max_points": 2.5},
+    # Multiplier per importance category; unknown categories count as 1
+    "importance": {"Σ1": 0.8, "Σ2": 1.0, "Σ3": 1.2, "Σ4": 1.4},
+}
+
+# Version of the scores in the database. rescore() clears every other version in
+# the transaction that writes one, so all scored rows carry the same version and
+# the first one found on the score_version index tells it.
+SCORED_VERSION_SQL = "SELECT score_version FROM survey_data WHERE score_version IS NOT NULL LIMIT 1"
+
+# Every survey without a score, with its latest completed review. Rows are marked
+# stale by setting score_version to NULL, by the triggers of migration 13 or when
+# the weights change; the stale ids are a lookup on the score_version index, so
+# only those rows are read.
+STALE_SQL = '''SELECT s.id, s.importance_category, s.num_floors, s.year_construction, s.danger_falling,
+                      s.structure_condition, s.vertical_damage, s.danger_impact, s.soft_floor, s.short_column,
+                      r.soil_class, r.structural_system, r.irregular_vertical, r.irregular_horizontal,
+                      r.torsion_rotation, r.heavy_finishes
+               FROM survey_data s
+               LEFT JOIN review_data r ON r.id = (SELECT MAX(id) FROM review_data
+                                                  WHERE survey_id = s.id AND reviewed = 1)
+               WHERE s.id IN (SELECT id FROM survey_data WHERE score_version IS NULL)'''
+
+
+# Function to return SCORING with the overrides of a JSON file merged in per section
+def load_config(path=SCORING_PATH):
+    config = json.loads(json.dumps(SCORING))
+    if path:
+        with open(path, encoding="utf-8") as f:
+            for section, value in json.load(f).items():
+                if isinstance(value, dict) and isinstance(config.get(section), dict):
+                    config[section].update(value)
+                else:
+                    config[section] = value
+    return config
+
+
+# Function to return the version stored next to scores computed with ``config``.
+# Changing any weight changes the version, so every score is recomputed once.
+def config_version(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:12]
+
+
+# Function to score every row of a frame of STALE_SQL columns in one vectorised
+# pass. Returns a float array aligned with the frame.
+def compute_scores(frame, config=SCORING):
+    points = np.zeros(len(frame))
+    for column, answers in config["answers"].items():
+        points += frame[column].map(answers).fillna(0.0).to_numpy(dtype=float)
+
+    year = frame["year_construction"].to_numpy(dtype=float)
+    eras = sorted(config["code_eras"])
+    points += np.select([year < before for before, _ in eras], [era_points for _, era_points in eras], 0.0)
+
+    floors = config["floors"]
+    extra_floors = frame["num_floors"].to_numpy(dtype=float) - floors["base_floors"]
+    points += np.nan_to_num(np.clip(extra_floors * floors["points_per_floor"], 0.0, floors["max_points"]))
+
+    multiplier = frame["importance_category"].map(config["importance"]).fillna(1.0).to_numpy(dtype=float)
+    return np.round(points * multiplier, 3)
+
+
+# Function to recompute the scores of every survey whose answers or review changed,
+# or that was scored with other weights, inside the caller's write transaction so
+# no row can change between reading and writing it. Returns the number rescored.
+def rescore(conn, config=SCORING):
+    version = config_version(config)
+    scored = conn.execute(SCORED_VERSION_SQL).fetchone()
+    if scored is not None and scored[0] != version:
+        # Scored with other weights: every score is stale
+        conn.execute("UPDATE survey_data SET score_version = NULL")
+    frame = pd.read_sql_query(STALE_SQL, conn)
+    if frame.empty:
+        return 0
+    scores = compute_scores(frame, config)
+    conn.executemany("UPDATE survey_data SET priority_score = ?, score_version = ? WHERE id = ?",
+                     zip(scores.tolist(), [version] * len(frame), frame["id"].tolist()))
+    return len(frame)
+
+
+# Function to bring the scores of a pooled database up to date. When nothing changed
+# it costs two index lookups, so it is called before every listing sorted by score.
+def refresh(pool, config=None):
+    config = config or load_config()
+    with pool.connection() as conn:
+        scored = conn.execute(SCORED_VERSION_SQL).fetchone()
+        stale = conn.execute("SELECT 1 FROM survey_data WHERE score_version IS NULL LIMIT 1").fetchone()
+    if stale is None and (scored is None or scored[0] == config_version(config)):
+        return 0
+    with pool.transaction() as conn:
+        return rescore(conn, config)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute the priority scores of surveys that changed.")
+    parser.add_argument("--db", default=db.DB_PATH, help="path of the survey database")
+    parser.add_argument("--config", default=SCORING_PATH, help="JSON file overriding the default weights")
+    parser.add_argument("--all", action="store_true", help="rescore every survey, not only changed ones")
+    args = parser.parse_args(argv)
+
+    pool = db.get_pool(args.db)
+    if args.all:
+        with pool.transaction() as conn:
+            conn.execute("UPDATE survey_data SET score_version = NULL")
+    start = time.perf_counter()
+    count = refresh(pool, load_config(args.config))
+    print(f"Scored {count} surveys in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
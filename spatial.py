@@ -0,0 +1,125 @@
+import math
+import os
+
+
+# Below this many buildings in view, markers are drawn individually
+MAX_MARKERS = 300
+
+# Approximate on-screen size of a cluster cell, in pixels of a 256 px web map tile
+CLUSTER_CELL_PIXELS = 64
+
+# Surveys closer than this, in metres, are treated as the same building
+DUPLICATE_RADIUS = float(os.environ.get("BUILDING_SURVEY_DUPLICATE_RADIUS", 15))
+
+# Mean Earth radius and the length of one degree of latitude, in metres
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# Bounds used before the map has reported a viewport: mainland Greece and the islands
+DEFAULT_BOUNDS = (34.5, 19.0, 42.0, 30.0)
+
+_REVIEWED = "EXISTS (SELECT 1 FROM review_data r WHERE r.survey_id = t.id AND r.reviewed = 1)"
+
+# Points are stored as zero-size boxes, so min_lat/min_lon are the coordinates
+# (rounded to 32-bit floats, which is well below a metre)
+_IN_VIEW = '''FROM survey_rtree t
+              WHERE t.max_lat >= :south AND t.min_lat <= :north
+                AND t.max_lon >= :west AND t.min_lon <= :east'''
+
+
+# Function to index surveys inserted while survey_rtree_insert was disabled, e.g. by
+# a bulk import
+def index_surveys(conn, first_id, last_id):
+    conn.execute('''INSERT INTO survey_rtree
+                    SELECT id, latitude, latitude, longitude, longitude FROM survey_data
+                    WHERE id BETWEEN ? AND ? AND latitude IS NOT NULL AND longitude IS NOT NULL''',
+                 (first_id, last_id))
+
+
+def _viewport(bounds):
+    south, west, north, east = bounds
+    return {"south": south, "west": west, "north": north, "east": east}
+
+
+# Function to count the surveyed buildings inside (south, west, north, east)
+def count_in_view(conn, bounds):
+    return conn.execute(f"SELECT COUNT(*) {_IN_VIEW}", _viewport(bounds)).fetchone()[0]
+
+
+# Function to list the buildings inside the viewport as (id, lat, lon, reviewed)
+def buildings_in_view(conn, bounds, limit=MAX_MARKERS):
+    return conn.execute(f"SELECT t.id, t.min_lat, t.min_lon, {_REVIEWED} {_IN_VIEW} LIMIT :limit",
+                        dict(_viewport(bounds), limit=limit)).fetchall()
+
+
+# Function to list the highest-priority buildings inside the viewport as
+# (id, lat, lon, reviewed, priority score), highest score first
+def priority_in_view(conn, bounds, limit=MAX_MARKERS):
+    return conn.execute(f'''SELECT t.id, t.min_lat, t.min_lon, {_REVIEWED}, s.priority_score
+                            FROM survey_rtree t JOIN survey_data s ON s.id = t.id
+                            WHERE t.max_lat >= :south AND t.min_lat <= :north
+                              AND t.max_lon >= :west AND t.min_lon <= :east
+                            ORDER BY s.priority_score DESC LIMIT :limit''',
+                        dict(_viewport(bounds), limit=limit)).fetchall()
+
+
+# Function to return the size, in degrees, of a cluster cell at a zoom level
+def cell_size(zoom):
+    return 360.0 / (2 ** zoom) * CLUSTER_CELL_PIXELS / 256
+
+
+# Function to group the buildings inside the viewport into grid cells sized for the
+# zoom level. Returns (count, mean lat, mean lon, reviewed count, first id) per cell.
+def clusters_in_view(conn, bounds, zoom):
+    cell = cell_size(zoom)
+    return conn.execute(f'''SELECT COUNT(*), AVG(t.min_lat), AVG(t.min_lon), SUM({_REVIEWED}), MIN(t.id)
+                            {_IN_VIEW}
+                            GROUP BY CAST((t.min_lat + 90) / :cell AS INTEGER),
+                                     CAST((t.min_lon + 180) / :cell AS INTEGER)''',
+                        dict(_viewport(bounds), cell=cell)).fetchall()
+
+
+# Function to choose the markers to draw for a viewport: individual buildings when
+# few are in view, clusters otherwise. Returns (count, lat, lon, reviewed, id) rows,
+# where count is 1 for an individual building.
+def markers_in_view(conn, bounds, zoom):
+    if count_in_view(conn, bounds) <= MAX_MARKERS:
+        return [(1, lat, lon, int(reviewed), survey_id)
+                for survey_id, lat, lon, reviewed in buildings_in_view(conn, bounds)]
+    return clusters_in_view(conn, bounds, zoom)
+
+
+# Function to return the marker radius, in pixels, of a cluster
+def cluster_radius(count):
+    return min(6 + 8 * math.log10(count + 1), 30)
+
+
+# Function to return the great-circle distance between two points, in metres
+def haversine(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi, dlambda = phi2 - phi1, math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+# Function to find the surveys within ``radius`` metres of a point, nearest first,
+# as (id, distance) pairs. The R*Tree narrows the search to a bounding box of the
+# circle, so only a handful of candidates are ever measured.
+def find_nearby(conn, lat, lon, radius=DUPLICATE_RADIUS):
+    dlat = radius / METERS_PER_DEGREE
+    dlon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    candidates = conn.execute(f"SELECT t.id, t.min_lat, t.min_lon {_IN_VIEW}",
+                              _viewport((lat - dlat, lon - dlon, lat + dlat, lon + dlon))).fetchall()
+    nearby = [(survey_id, haversine(lat, lon, cand_lat, cand_lon)) for survey_id, cand_lat, cand_lon in candidates]
+    return sorted((item for item in nearby if item[1] <= radius), key=lambda item: item[1])
+
+
+# Function to return the survey a new submission at (lat, lon) duplicates, or None.
+# Submissions are linked to the first survey of the building, so every duplicate
+# cluster has a single root for reviewers to handle.
+def find_duplicate(conn, lat, lon, radius=DUPLICATE_RADIUS):
+    nearby = find_nearby(conn, lat, lon, radius)
+    if not nearby:
+        return None
+    return conn.execute("SELECT COALESCE(duplicate_of, id) FROM survey_data WHERE id = ?",
+                        (nearby[0][0],)).fetchone()[0]
@@ -1,102 +1,268 @@
 import streamlit as st
 import folium
 from streamlit_folium import st_folium
-from PIL import Image
 import sqlite3
-import io
 from folium.plugins import LocateControl
-import pandas as pd
-import matplotlib.pyplot as plt
 import random
+import os
+import tempfile
+import time
 
+# Only modules the public survey form needs are imported here; admin-only ones such
+# as charts (matplotlib) are imported where they are first used
+import db
+import export
+import profiling
+import spatial
+import stats
+import survey_options
+import surveys
+import tiles
+import write_queue
+from app_resources import get_pool, get_store, load_image
+from validation import ValidationError
 
-# Initialize SQLite database
-conn = sqlite3.connect('building_survey.db')
-c = conn.cursor()
-
-# Create table for survey data if it doesn't exist
-c.execute('''CREATE TABLE IF NOT EXISTS survey_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                latitude REAL,
-                longitude REAL,
-                type_of_use TEXT,
-                number_of_users TEXT,
-                building_importance_category TEXT,
-                non_structural_falling_danger TEXT,
-                non_structural_falling_photo BLOB,
-                number_of_floors INTEGER,
-                condition_of_structure TEXT,
-                structure_condition_photo BLOB,
-                year_of_construction INTEGER,
-                previous_damages TEXT,
-                previous_damages_photo BLOB,
-                neighboring_buildings_impact TEXT,
-                neighboring_impact_photo BLOB,
-                soft_floor TEXT,
-                soft_floor_photo BLOB,
-                short_column TEXT,
-                short_column_photo BLOB
-            )''')
-
-# Create table for review data if it doesn't exist
-c.execute('''CREATE TABLE IF NOT EXISTS review_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                survey_id INTEGER,
-                structural_system TEXT,
-                arrangement_walls TEXT,
-                irregular_vertical TEXT,
-                irregular_vertical_photo BLOB,
-                irregular_horizontal TEXT,
-                irregular_horizontal_photo BLOB,
-                torsion_rotation TEXT,
-                torsion_rotation_photo BLOB,
-                structural_vulnerabilities TEXT,
-                heavy_finishes TEXT,
-                heavy_finishes_photo BLOB,
-                input_quality INTEGER,
-                soil_class TEXT,
-                load_capacity_reduction TEXT,
-                constructed_area INTEGER,
-                constructed_area_photo BLOB,
-                structure_performance TEXT,
-                retrofitting_methods TEXT,
-                reviewed BOOLEAN DEFAULT FALSE
-            )''')
-
-# Create table for users if it doesn't exist
-c.execute('''CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE,
-                password TEXT
-            )''')
-
-conn.commit()
+
+# Time this rerun when profiling is enabled; shown to admins in the diagnostics panel
+profiling.start("stapp")
+
+# Database pool and image store shared by every session and page
+pool = get_pool()
+store = get_store()
+
+# Optional write-behind queue; None when submissions are written in the request
+@st.cache_resource
+def get_write_queue():
+    return write_queue.get_queue(pool, store) if write_queue.WRITE_BEHIND else None
+
+submissions = get_write_queue()
+
+# Seconds a queued submission is waited on before the user is told it is queued
+QUEUE_CONFIRM_TIMEOUT = 2.0
+
+# Number of photos shown per gallery page in the review view
+GALLERY_PAGE_SIZE = 4
+
+# Seconds between progress updates of a running report job
+REPORT_POLL_INTERVAL = 1.0
 
 def generate_captcha():
     return random.randint(1000, 9999)
 
+# Breakdowns offered by the dashboard: label -> (stats dimension, axis label)
+VISUALIZATIONS = {
+    "Type of Use": ("use_type", "Type of Use"),
+    "Building Importance Category": ("importance_category", "Importance Category"),
+    "Construction Decade": ("decade", "Decade of Construction"),
+    "Number of Floors": ("floors", "Number of Floors"),
+    "Reported Hazards": ("hazard", "Hazard"),
+    "Review Status": ("review_status", "Review Status"),
+}
+
+# Labels of the hazard buckets, which are stored under their survey_data column name
+HAZARD_LABELS = {
+    "danger_falling": "Non-structural falling",
+    "structure_condition": "Corrosion/Spalling",
+    "vertical_damage": "Previous damages",
+    "danger_impact": "Neighbor impact",
+    "soft_floor": "Soft floor",
+    "short_column": "Short column",
+}
+
+# Function to draw one breakdown as a bar chart. Cached on the counts themselves, so
+# a figure is only redrawn when the underlying numbers change.
+@st.cache_data(max_entries=64)
+def render_bar_chart(labels, counts, xlabel, title):
+    import charts
+
+    return charts.render_bar_chart(labels, counts, xlabel, title)
+
+# Marker colours of the overview map
+REVIEWED_COLOR = "#2e7d32"
+PENDING_COLOR = "#c62828"
+PARTLY_REVIEWED_COLOR = "#ef6c00"
+
+# Marker colours of the highest-priority view, by thirds of the buildings shown
+PRIORITY_COLORS = ("#b71c1c", "#ef6c00", "#fbc02d")
+
+# Function to rescore the surveys that changed since the last rerun. scoring needs
+# pandas, so it is imported here rather than at startup.
+def refresh_scores():
+    import scoring
+
+    scoring.refresh(pool)
+
+# Function to build the empty overview map. Markers are sent separately, so panning
+# never re-renders the base map. It is built per render rather than cached, since
+# st_folium adds the feature group to the map it is given.
+def overview_base_map():
+    south, west, north, east = spatial.DEFAULT_BOUNDS
+    return folium.Map(location=[(south + north) / 2, (west + east) / 2], zoom_start=6,
+                      tiles=tiles.TILE_URL, attr=tiles.ATTRIBUTION)
+
+# Function to show every surveyed building in the current viewport, clustered by zoom level
+@profiling.timed
+def display_overview_map():
+    st.title("Overview Map")
+
+    # The viewport reported by the previous render decides what is queried now
+    view = st.session_state.get("overview_map") or {}
+    bounds = spatial.DEFAULT_BOUNDS
+    if view.get("bounds") and view["bounds"].get("_southWest", {}).get("lat") is not None:
+        south_west, north_east = view["bounds"]["_southWest"], view["bounds"]["_northEast"]
+        bounds = (south_west["lat"], south_west["lng"], north_east["lat"], north_east["lng"])
+    zoom = view.get("zoom") or 6
+    by_priority = st.toggle("Only the highest-priority buildings", key="overview_priority")
+
+    feature_group = folium.FeatureGroup(name="Surveyed buildings")
+    if by_priority:
+        refresh_scores()
+        with pool.connection() as conn:
+            buildings = spatial.priority_in_view(conn, bounds)
+        for rank, (survey_id, lat, lon, reviewed, score) in enumerate(buildings):
+            color = PRIORITY_COLORS[rank * len(PRIORITY_COLORS) // len(buildings)]
+            folium.CircleMarker([lat, lon], radius=6, color=color, fill=True, fill_opacity=0.8,
+                                tooltip=f"Listing {survey_id} - priority {score:g} - "
+                                        f"{'Reviewed' if reviewed else 'Pending'}").add_to(feature_group)
+        markers = []
+    else:
+        with pool.connection() as conn:
+            markers = spatial.markers_in_view(conn, bounds, zoom)
+
+    for count, lat, lon, reviewed, survey_id in markers:
+        if count == 1:
+            color = REVIEWED_COLOR if reviewed else PENDING_COLOR
+            folium.CircleMarker([lat, lon], radius=6, color=color, fill=True, fill_opacity=0.8,
+                                tooltip=f"Listing {survey_id} - {'Reviewed' if reviewed else 'Pending'}").add_to(feature_group)
+        else:
+            color = REVIEWED_COLOR if reviewed == count else PENDING_COLOR if not reviewed else PARTLY_REVIEWED_COLOR
+            folium.CircleMarker([lat, lon], radius=spatial.cluster_radius(count), color=color, fill=True,
+                                fill_opacity=0.6, tooltip=f"{count} buildings ({reviewed} reviewed)").add_to(feature_group)
+
+    st_folium(overview_base_map(), key="overview_map", feature_group_to_add=feature_group,
+              center=view.get("center"), zoom=zoom, width=700, height=400,
+              returned_objects=["bounds", "zoom", "center"])
+
 # Function to visualize survey data
+@profiling.timed
 def display_data_visualization():
     st.title("Survey Data Visualization")
 
-    # Fetch the survey data
-    c.execute("SELECT use_type, COUNT(*) FROM survey_data GROUP BY use_type")
-    data = c.fetchall()
-    
-    if not data:
+    # Read the precomputed summaries; the base tables are never scanned here
+    data = stats.get_stats(pool)
+
+    if not data.get("total"):
         st.info("No survey data available for visualization.")
         return
 
-    df = pd.DataFrame(data, columns=["Type of Use", "Count"])
+    total = data["total"]["surveys"]
+    reviewed = data["review_status"]["Reviewed"]
+    total_col, reviewed_col, pending_col = st.columns(3)
+    total_col.metric("Surveyed Buildings", total)
+    reviewed_col.metric("Reviewed", reviewed)
+    pending_col.metric("Pending Review", data["review_status"]["Pending"])
+
+    breakdown = st.selectbox("Breakdown", list(VISUALIZATIONS))
+    dimension, xlabel = VISUALIZATIONS[breakdown]
+    counts = data.get(dimension, {})
+    if not counts:
+        st.info("No data for this breakdown yet.")
+        return
+    labels = [HAZARD_LABELS.get(bucket, bucket) if dimension == "hazard" else bucket for bucket in counts]
 
     # Create a bar chart
-    fig, ax = plt.subplots()
-    ax.bar(df["Type of Use"], df["Count"], color='skyblue')
-    ax.set_xlabel("Type of Use")
-    ax.set_ylabel("Number of Buildings")
-    ax.set_title("Number of Buildings by Type of Use")
-
-    st.pyplot(fig)
+    st.image(render_bar_chart(tuple(labels), tuple(counts.values()), xlabel, f"Number of Buildings by {breakdown}"))
+
+# Function to offer a download of every survey with its review. The export is
+# streamed to a temporary file first, so building it never materialises the tables.
+@profiling.timed
+def display_export():
+    st.title("Export")
+    export_format = st.selectbox("Format", export.EXPORT_FORMATS, key="export_format")
+    include_photos = st.checkbox("Include photos (zip)", key="export_photos")
+
+    if st.button("Prepare export"):
+        file_name = "surveys.zip" if include_photos else f"surveys.{export_format}"
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(file_name)[1])
+        os.close(fd)
+        try:
+            with st.spinner("Exporting..."), pool.connection() as conn:
+                if include_photos:
+                    with open(path, "wb") as out:
+                        missing = export.export_bundle(conn, store, export_format, out)
+                    if missing:
+                        st.warning(f"{missing} photos are missing from the image store and were left out.")
+                else:
+                    export.export_data(conn, export_format, path)
+        except RuntimeError as e:
+            os.unlink(path)
+            st.error(str(e))
+            return
+        previous = st.session_state.get("export_file")
+        if previous and os.path.exists(previous[0]):
+            os.unlink(previous[0])
+        st.session_state.export_file = (path, file_name)
+
+    if st.session_state.get("export_file"):
+        path, file_name = st.session_state.export_file
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                st.download_button("Download export", f, file_name=file_name)
+
+    st.subheader("Building reports")
+    report_filters = {
+        "structural_systems": st.multiselect("Type of Structural System", survey_options.STRUCTURAL_SYSTEMS,
+                                             key="report_systems"),
+        "soil_classes": st.multiselect("Soil Class", survey_options.SOIL_CLASSES, key="report_soils"),
+        "use_types": st.multiselect("Type of Use", survey_options.USE_TYPES, key="report_use_types"),
+    }
+    with pool.connection() as conn:
+        report_count = db.count_reviewed(conn, report_filters)
+    include_maps = st.checkbox("Include location maps", value=True, key="report_maps",
+                               help="Maps are drawn from the basemap tiles already cached; "
+                                    "seed the area with tiles.py to fill them in")
+
+    job = st.session_state.get("report_job")
+    running = job is not None and not job["finished"].is_set()
+    if st.button(f"Generate {report_count} reports", disabled=not report_count or running):
+        # Imported here so the public form does not load the report generator
+        import reports
+
+        with pool.connection() as conn:
+            report_ids = db.fetch_reviewed_survey_ids(conn, report_filters)
+        fd, path = tempfile.mkstemp(suffix=".zip")
+        os.close(fd)
+        # The run goes on in the background and never downloads tiles, so a large
+        # selection neither blocks this page nor floods the tile upstream
+        st.session_state.report_job = reports.start_reports(pool, store, report_ids, path,
+                                                            tiles.get_cache() if include_maps else None,
+                                                            fetch_tiles=False)
+        running = True
+
+    if running:
+        display_report_progress()
+    elif job is not None:
+        del st.session_state.report_job
+        if job["error"]:
+            st.error(f"Generating the reports failed: {job['error']}")
+        else:
+            previous = st.session_state.get("report_file")
+            if previous and os.path.exists(previous):
+                os.unlink(previous)
+            st.session_state.report_file = job["path"]
+
+    if st.session_state.get("report_file") and os.path.exists(st.session_state.report_file):
+        with open(st.session_state.report_file, "rb") as f:
+            st.download_button("Download reports", f, file_name="building_reports.zip")
+
+# Function to show the progress of the running report job. The fragment polls on its
+# own, and reruns the whole page once the job ends so the result is shown.
+@st.fragment(run_every=REPORT_POLL_INTERVAL)
+def display_report_progress():
+    job = st.session_state.report_job
+    if job["finished"].is_set():
+        st.rerun()
+    st.progress(job["done"] / max(job["total"], 1), text=f"{job['done']}/{job['total']} reports")
 
 # Function to handle user registration
 def register_user():
@@ -106,8 +272,8 @@ def register_user():
     
     if st.sidebar.button("Register"):
         try:
-            c.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password))
-            conn.commit()
+            with pool.transaction() as conn:
+                db.create_user(conn, username, password)
             st.sidebar.success("User  registered successfully!")
         except sqlite3.IntegrityError:
             st.sidebar.error("Username already exists.")
@@ -119,8 +285,8 @@ def user_login():
     password = st.sidebar.text_input("Password", type="password")
     
     if st.sidebar.button("Login"):
-        c.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, password))
-        user = c.fetchone()
+        with pool.connection() as conn:
+            user = db.find_user(conn, username, password)
         if user:
             st.session_state.logged_in = True  # Ensure session state is set correctly
             st.session_state.username = username  # Save the username to session
@@ -128,15 +294,25 @@ def user_login():
         else:
             st.sidebar.error("Invalid username or password")
 
-# Function to resize an image
-def resize_image(image):
-    img = Image.open(image)
-    img_resized = img.resize((int(img.width * 0.2), int(img.height * 0.2)))
-    buffered = io.BytesIO()
-    img_resized.save(buffered, format="JPEG")
-    return buffered.getvalue()
+# Function to show the photos of one question as a paged gallery of thumbnails.
+# Only the current page is read from the image store.
+def display_gallery(table, photos, caption, key):
+    if not photos:
+        return
+    pages = (len(photos) + GALLERY_PAGE_SIZE - 1) // GALLERY_PAGE_SIZE
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"{caption} - page", min_value=1, max_value=pages, step=1, key=f"{key}_page")
+    full_size = st.toggle("Full size", key=f"{key}_full")
+    shown = photos[(page - 1) * GALLERY_PAGE_SIZE:page * GALLERY_PAGE_SIZE]
+    columns = st.columns(1 if full_size else GALLERY_PAGE_SIZE)
+    for i, (image_id, image_hash) in enumerate(shown):
+        with columns[i % len(columns)]:
+            st.image(load_image(table, image_id, image_hash, thumbnail=not full_size),
+                     caption=caption, use_container_width=True)
 
 # Function to handle the admin login
+@profiling.timed
 def admin_login():
     st.sidebar.title("Admin Login")
     username = st.sidebar.text_input("Username")
@@ -149,155 +325,183 @@ def admin_login():
         else:
             st.sidebar.error("Invalid username or password")
 
-# Function to display the initial form for non-registered users
+# Function to show where the time of this rerun went: sections, the slowest SQL
+# statements, and percentiles over recent reruns from the metrics log
+def display_diagnostics(profiler):
+    with st.expander("Diagnostics"):
+        st.write(f"This rerun took {profiler.total * 1000:.0f} ms, {profiler.sql_seconds() * 1000:.0f} ms of it "
+                 f"in {len(profiler.statements)} SQL statements.")
+        st.table([{"section": name, "ms": round(seconds * 1000, 1)}
+                  for name, seconds in sorted(profiler.sections.items(), key=lambda item: -item[1])])
+        st.subheader("Slowest statements")
+        st.table(profiler.top_statements())
+        st.subheader("Recent reruns (ms)")
+        st.table([dict(section=name, **row) for name, row in profiling.summarize(last=1000).items()])
+
+# Function to tell the user what became of a queued submission, waiting briefly for
+# the writer to persist it. Returns the id of the saved row, or None.
+def confirm_queued(ticket, saved_message):
+    status = submissions.wait(ticket, QUEUE_CONFIRM_TIMEOUT)
+    if status["status"] == write_queue.DONE:
+        st.success(saved_message)
+        return status["result"]
+    if status["status"] == write_queue.FAILED:
+        st.error(f"Your submission could not be saved: {status['error']}")
+    else:
+        st.info(f"Your submission was received and will be saved shortly (reference {ticket[:8]}).")
+    return None
+
+# Function to build the survey map. LocateControl centres it on the user's position
+# in the browser. A new map is built on every render: st_folium adds the session's
+# marker to the map it is given, so a map shared between sessions would show one
+# user's location to everyone.
+def survey_base_map():
+    map = folium.Map(location=[38.0, 23.7], zoom_start=6, tiles=tiles.TILE_URL, attr=tiles.ATTRIBUTION)
+    LocateControl(auto_start=True).add_to(map)
+    return map
+
+# Function to let the user pick the building on the map. It runs as a fragment, so
+# a click reruns only the map, not the questions below it. The chosen point is kept
+# in st.session_state.survey_location.
+@st.fragment
+def select_location():
+    selected = st.session_state.get("survey_location")
+    marker = folium.FeatureGroup(name="Selected location")
+    if selected:
+        marker.add_child(folium.Marker(location=list(selected)))
+    location = st_folium(survey_base_map(), feature_group_to_add=marker, width=700, height=300,
+                         returned_objects=["last_clicked"], key="survey_map")
+    clicked = (location or {}).get("last_clicked")
+    if clicked and (clicked["lat"], clicked["lng"]) != selected:
+        st.session_state.survey_location = (clicked["lat"], clicked["lng"])
+        st.rerun(scope="fragment")
+    if selected:
+        st.success(f"Location Selected Succesfully!")
+
+# Function to display the initial form for non-registered users. The questions sit
+# in an st.form, so answering them sends nothing to the server until Submit.
+@profiling.timed
 def display_initial_form():
     st.title("Building Survey Form")
-    captcha_ran = generate_captcha()
+    # Kept for the session, so the code shown does not change under the user
+    if "captcha" not in st.session_state:
+        st.session_state.captcha = generate_captcha()
 
     # 1) Select location on the map
     st.header("1. Click on the map to select the location.")
-    map = folium.Map(location=[38.0, 23.7], zoom_start=6)
-    # folium.plugins.LocateControl().add_to(map)
-    folium.plugins.LocateControl(auto_start=True).add_to(map)
-    # print(folium.plugins.LocateControl())
-    # autoloc = folium.plugins.LocateControl()
-    location = st_folium(map, width=700, height=300)
-    
-    if location:
-        # if location['last_clicked']['lat'] != None and location['last_clicked']['lng'] != None:
-        # try:
-        # if location.get("last_circle_radius"):
-        #     lat, lon = location['last_circle_radius']['lat'], location['last_circle_radius']['lng']
-        #     st.success(f"Selected Location: Latitude {lat}, Longitude {lon}")
-        # elif location.get("last_clicked"):
-        if location.get("last_clicked"):
-            lat, lon = location['last_clicked']['lat'], location['last_clicked']['lng']
-            # location.add_child(folium.ClickForMarker())
-            # fg = folium.FeatureGroup(name="State bounds")
-            # fg.add_child(folium.Marker(location=[lat, lon]))
-            # location = st_folium(
-            #                 map,
-            #                 feature_group_to_add=fg,
-            #                 width=1200,
-            #                 height=500,
-            #             )
-            # st.success(f"Selected Location: Latitude {lat}, Longitude {lon}")
-            st.success(f"Location Selected Succesfully!")
-        else:
-            lat = None
-            lon = None
-        # except Exception:
-        #     pass
-    
-    # 2) Select the type of use
-    st.header("2. Select the type of use")
-    use_type = st.selectbox("Type of Use", ["Residential", "Industrial", "Concentrated Audience", 
-                                            "Public Building", "Emergency Building"],
-                             help="This is an explanatory help")
-
-    # 3) Number of users
-    st.header("3. Number of users")
-    num_users = st.selectbox("Number of Users", ["0-10", "11-100", "100+"],
-                             help="This is an explanatory help")
-
-    # 4) Building importance category
-    st.header("4. Building Importance Category")
-    importance_category = st.selectbox("Building Importance Category", ["Σ1", "Σ2", "Σ3", "Σ4"],
-                             help="This is an explanatory help")
-
-    # 5) Danger of non-structural element falling
-    st.header("5. Danger of Non-Structural Element Falling")
-    danger_falling = st.selectbox("Danger of Non-Structural Element Falling", ["No", "Yes"],
-                             help="This is an explanatory help")
-    falling_photo = None
-    if danger_falling == "Yes":
-        falling_photo = st.file_uploader("Upload photo of Non-Structural Element", type=["jpg", "png", "jpeg"])
-        # falling_photo = st.file_uploader("Upload photo of Non-Structural Element", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
-    
-    # 6) Number of floors
-    st.header("6. Number of Floors")
-    num_floors = st.number_input("Number of Floors", min_value=1, max_value=100, step=1,
-                             help="This is an explanatory help")
-
-    # 7) Condition of structure
-    st.header("7. Condition of Structure")
-    structure_condition = st.selectbox("Condition of Structure", ["No", "Corrosion/Spalling"],
-                             help="This is an explanatory help")
-    rust_photo = None
-    if structure_condition == "Corrosion/Spalling":
-        rust_photo = st.file_uploader("Upload photo of Corrosion/Spalling", type=["jpg", "png", "jpeg"])
-        # rust_photo = st.file_uploader("Upload photo of Rust/Spalling", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
-    
-    # 8) Year of construction
-    st.header("8. Year of Construction")
-    year_construction = st.number_input("Year of Construction", min_value=1800, max_value=2024, step=1,
-                             help="This is an explanatory help")
-
-    # 9) Previous damages in vertical elements
-    st.header("9. Previous Damages in Vertical Elements")
-    vertical_damage = st.selectbox("Previous Damages in Vertical Elements", ["No", "Yes"],
-                             help="This is an explanatory help")
-    damage_photo = None
-    if vertical_damage == "Yes":
-        max_crack = st.slider("Maximum Crack Width in mm (Approximately)", min_value=1, max_value=20)
-    if vertical_damage == "Yes":
-        damage_photo = st.file_uploader("Upload photo of Vertical Element Damage", type=["jpg", "png", "jpeg"])
-        # damage_photo = st.file_uploader("Upload photo of Vertical Element Damage", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
-
-    # 10) Danger of impact with neighboring buildings
-    st.header("10. Danger of Impact with Neighboring Buildings")
-    danger_impact = st.selectbox("Danger of Impact with Neighboring Buildings", ["No", "Yes"],
-                             help="This is an explanatory help")
-    impact_photo = None
-    if danger_impact == "Yes":
-        impact_photo = st.file_uploader("Upload photo of Neighboring Building", type=["jpg", "png", "jpeg"])
-        # impact_photo = st.file_uploader("Upload photo of Neighboring Building", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
-
-    # 11) Soft floor (pilotis)
-    st.header("11. Soft Floor (Pilotis)")
-    soft_floor = st.selectbox("Soft Floor (Pilotis)", ["No", "Yes"],
-                             help="This is an explanatory help")
-    soft_floor_photo = None
-    if soft_floor == "Yes":
-        soft_floor_photo = st.file_uploader("Upload photo of Soft Floor (Pilotis)", type=["jpg", "png", "jpeg"])
-        # soft_floor_photo = st.file_uploader("Upload photo of Soft Floor (Pilotis)", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
-
-    # 12) Short column
-    st.header("12. Short Column")
-    short_column = st.selectbox("Short Column", ["No", "Yes"],
-                             help="This is an explanatory help")
-    short_column_photo = None
-    if short_column == "Yes":
-        short_column_photo = st.file_uploader("Upload photo of Short Column", type=["jpg", "png", "jpeg"])
-        # short_column_photo = st.file_uploader("Upload photo of Short Column", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
-
-    # CAPTCHA implementation
-    st.header("CAPTCHA Verification")
-    captcha_input = st.text_input(f"Enter {captcha_ran}")
-    # captcha_correct = captcha_input == "12345"
-    captcha_correct = captcha_ran
-
-    # Submission button
-    # if st.button("Submit") and captcha_correct:
-    if st.button("Submit"):
+    select_location()
+
+    photo_help = "Only needed when the answer above is Yes"
+    with st.form("survey_form"):
+        # 2) Select the type of use
+        st.header("2. Select the type of use")
+        use_type = st.selectbox("Type of Use", survey_options.USE_TYPES,
+                                 help="This is an explanatory help")
+
+        # 3) Number of users
+        st.header("3. Number of users")
+        num_users = st.selectbox("Number of Users", survey_options.NUM_USERS,
+                                 help="This is an explanatory help")
+
+        # 4) Building importance category
+        st.header("4. Building Importance Category")
+        importance_category = st.selectbox("Building Importance Category", survey_options.IMPORTANCE_CATEGORIES,
+                                 help="This is an explanatory help")
+
+        # 5) Danger of non-structural element falling
+        st.header("5. Danger of Non-Structural Element Falling")
+        danger_falling = st.selectbox("Danger of Non-Structural Element Falling", survey_options.YES_NO,
+                                 help="This is an explanatory help")
+        falling_photo = st.file_uploader("Upload photo of Non-Structural Element", type=["jpg", "png", "jpeg"],
+                                         accept_multiple_files=True, help=photo_help)
+
+        # 6) Number of floors
+        st.header("6. Number of Floors")
+        num_floors = st.number_input("Number of Floors", min_value=1, max_value=100, step=1,
+                                 help="This is an explanatory help")
+
+        # 7) Condition of structure
+        st.header("7. Condition of Structure")
+        structure_condition = st.selectbox("Condition of Structure", survey_options.STRUCTURE_CONDITIONS,
+                                 help="This is an explanatory help")
+        rust_photo = st.file_uploader("Upload photo of Corrosion/Spalling", type=["jpg", "png", "jpeg"],
+                                      accept_multiple_files=True, help="Only needed for Corrosion/Spalling")
+
+        # 8) Year of construction
+        st.header("8. Year of Construction")
+        year_construction = st.number_input("Year of Construction", min_value=1800, max_value=2024, step=1,
+                                 help="This is an explanatory help")
+
+        # 9) Previous damages in vertical elements
+        st.header("9. Previous Damages in Vertical Elements")
+        vertical_damage = st.selectbox("Previous Damages in Vertical Elements", survey_options.YES_NO,
+                                 help="This is an explanatory help")
+        max_crack = st.slider("Maximum Crack Width in mm (Approximately)", min_value=1, max_value=20, help=photo_help)
+        damage_photo = st.file_uploader("Upload photo of Vertical Element Damage", type=["jpg", "png", "jpeg"],
+                                        accept_multiple_files=True, help=photo_help)
+
+        # 10) Danger of impact with neighboring buildings
+        st.header("10. Danger of Impact with Neighboring Buildings")
+        danger_impact = st.selectbox("Danger of Impact with Neighboring Buildings", survey_options.YES_NO,
+                                 help="This is an explanatory help")
+        impact_photo = st.file_uploader("Upload photo of Neighboring Building", type=["jpg", "png", "jpeg"],
+                                        accept_multiple_files=True, help=photo_help)
+
+        # 11) Soft floor (pilotis)
+        st.header("11. Soft Floor (Pilotis)")
+        soft_floor = st.selectbox("Soft Floor (Pilotis)", survey_options.YES_NO,
+                                 help="This is an explanatory help")
+        soft_floor_photo = st.file_uploader("Upload photo of Soft Floor (Pilotis)", type=["jpg", "png", "jpeg"],
+                                            accept_multiple_files=True, help=photo_help)
+
+        # 12) Short column
+        st.header("12. Short Column")
+        short_column = st.selectbox("Short Column", survey_options.YES_NO,
+                                 help="This is an explanatory help")
+        short_column_photo = st.file_uploader("Upload photo of Short Column", type=["jpg", "png", "jpeg"],
+                                              accept_multiple_files=True, help=photo_help)
+
+        # CAPTCHA implementation
+        st.header("CAPTCHA Verification")
+        captcha_input = st.text_input(f"Enter {st.session_state.captcha}")
+
+        submitted = st.form_submit_button("Submit")
+
+    if submitted:
+        captcha_correct = captcha_input.strip() == str(st.session_state.captcha)
+        location = st.session_state.get("survey_location")
         if captcha_correct:
-            if lat != None and lon != None:
-                # Insert the data into the database
-                c.execute('''INSERT INTO survey_data (latitude, longitude, use_type, num_users, importance_category, danger_falling, num_floors, structure_condition, year_construction, vertical_damage, danger_impact, soft_floor, short_column) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', (lat, lon, use_type, num_users, importance_category, danger_falling, num_floors, structure_condition, year_construction, vertical_damage, danger_impact, soft_floor, short_column))
-                survey_id = c.lastrowid
-
-                # Process and save images if they exist
-                image_types = ["falling_photo", "rust_photo", "damage_photo", "impact_photo", "soft_floor_photo", "short_column_photo"]
+            if location is not None:
+                lat, lon = location
+                survey = {"latitude": lat, "longitude": lon, "use_type": use_type, "num_users": num_users,
+                          "importance_category": importance_category, "danger_falling": danger_falling,
+                          "num_floors": num_floors, "structure_condition": structure_condition,
+                          "year_construction": year_construction, "vertical_damage": vertical_damage,
+                          "danger_impact": danger_impact, "soft_floor": soft_floor, "short_column": short_column}
+
+                # Photos are kept only for the hazards actually reported
                 images = [falling_photo, rust_photo, damage_photo, impact_photo, soft_floor_photo, short_column_photo]
-
-                for img_type, img in zip(image_types, images):
-                    if img is not None:
-                        resized_image = resize_image(img)
-                        c.execute('''INSERT INTO survey_images (survey_id, image_type, image)
-                                    VALUES (?, ?, ?)''', (survey_id, img_type, resized_image))
-
-                conn.commit()
-                st.success("Form submitted successfully!")
+                uploads = {img_type: photos
+                           for (column, answer), img_type, photos in zip(survey_options.HAZARD_COLUMNS.items(),
+                                                                         survey_options.SURVEY_IMAGE_TYPES, images)
+                           if survey[column] == answer}
+                try:
+                    if submissions is not None:
+                        survey_id = confirm_queued(submissions.submit_survey(survey, uploads),
+                                                   "Form submitted successfully!")
+                        duplicate_of = None
+                        if survey_id is not None:
+                            with pool.connection() as conn:
+                                duplicate_of = db.fetch_duplicate_of(conn, survey_id)
+                    else:
+                        _, duplicate_of = surveys.submit_survey(pool, store, survey, uploads)
+                        st.success("Form submitted successfully!")
+                except ValidationError as e:
+                    st.error("; ".join(e.errors))
+                    return
+                st.session_state.captcha = generate_captcha()
+                if duplicate_of is not None:
+                    st.info("This building has already been surveyed; your submission was added to the existing survey.")
             else:
                 st.error("Please click on the map to select location!")
         else:
@@ -307,6 +511,7 @@ def display_initial_form():
 #     st.title("Page 1")
 #     st.write("This is Page 1.")
 # Function to display non-reviewed listings for admin users
+@profiling.timed
 def display_listings():
     # st.title("Reviewed Listings")
 
@@ -326,18 +531,88 @@ def display_listings():
     # selected_listing = st.selectbox("Select a listing to preview", listing_options)
 
     st.title("Non-Reviewed Listings")
-    
-    c.execute("SELECT * FROM survey_data WHERE id NOT IN (SELECT survey_id FROM review_data WHERE reviewed = 1)")
-    listings = c.fetchall()
-    
+
+    with st.expander("Filters and sorting"):
+        filters = {
+            "use_types": st.multiselect("Type of Use", survey_options.USE_TYPES, key="queue_use_types"),
+            "importance_categories": st.multiselect("Building Importance Category", survey_options.IMPORTANCE_CATEGORIES,
+                                                    key="queue_importance"),
+            "any_hazard": st.checkbox("Only listings with a reported hazard", key="queue_hazard"),
+            "collapse_duplicates": st.checkbox("Group duplicate surveys of the same building", value=True,
+                                               key="queue_collapse"),
+        }
+        year_min, year_max = st.slider("Year of Construction", survey_options.MIN_YEAR, survey_options.MAX_YEAR,
+                                       (survey_options.MIN_YEAR, survey_options.MAX_YEAR), key="queue_years")
+        floors_min, floors_max = st.slider("Number of Floors", survey_options.MIN_FLOORS, survey_options.MAX_FLOORS,
+                                           (survey_options.MIN_FLOORS, survey_options.MAX_FLOORS), key="queue_floors")
+        # Only narrowed ranges become filters, so the default view needs no range scan
+        if (year_min, year_max) != (survey_options.MIN_YEAR, survey_options.MAX_YEAR):
+            filters.update(year_min=year_min, year_max=year_max)
+        if (floors_min, floors_max) != (survey_options.MIN_FLOORS, survey_options.MAX_FLOORS):
+            filters.update(floors_min=floors_min, floors_max=floors_max)
+        sort = st.selectbox("Sort by", list(db.QUEUE_SORTS), key="queue_sort")
+
+    # Reviewers working at the same time claim listings, so nobody starts on a building
+    # someone else is reviewing. Everyone logs in as admin, so claims go by name.
+    reviewer = st.sidebar.text_input("Reviewer name", key="reviewer").strip()
+    if reviewer:
+        filters["reviewer"] = reviewer
+        with pool.connection() as conn:
+            claims = db.fetch_claims(conn, reviewer)
+        claim_col, release_col = st.columns(2)
+        if claim_col.button(f"Claim the next {db.CLAIM_BATCH} listings"):
+            if db.QUEUE_SORTS[sort][0] == "priority_score":
+                refresh_scores()
+            with pool.transaction() as conn:
+                db.claim_next(conn, reviewer, filters, sort)
+            st.rerun()
+        if release_col.button("Release my claims", disabled=not claims):
+            with pool.transaction() as conn:
+                for survey_id, _ in claims:
+                    db.release_claim(conn, survey_id, reviewer)
+            st.rerun()
+        if claims:
+            until = time.strftime("%H:%M", time.localtime(max(expires_at for _, expires_at in claims)))
+            st.caption(f"You hold {len(claims)} claimed listing(s) until {until}.")
+            if st.toggle("Review my claimed listings", value=True, key="queue_claimed"):
+                selected_listing_id = st.selectbox("Select a claimed listing to review", [row[0] for row in claims],
+                                                   format_func=lambda survey_id: f"Listing {survey_id}")
+                review_listing(selected_listing_id)
+                return
+    else:
+        st.info("Enter your reviewer name in the sidebar to claim listings, so other reviewers skip them.")
+
+    # Start again from the first page whenever the filters or the sort order change
+    query_key = repr((filters, sort))
+    if st.session_state.get("queue_key") != query_key:
+        st.session_state.queue_key = query_key
+        st.session_state.queue_cursors = [None]
+    cursors = st.session_state.queue_cursors
+
+    if db.QUEUE_SORTS[sort][0] == "priority_score":
+        refresh_scores()
+    with pool.connection() as conn:
+        total = db.count_queue(conn, filters)
+        listings, next_cursor = db.fetch_queue_page(conn, filters, sort, after=cursors[-1])
+
     if not listings:
         st.info("No non-reviewed listings available.")
         return
-    
-    listing_options = [f"Listing {listing[0]} - Location: ({listing[1]}, {listing[2]})" for listing in listings]
-    selected_listing = st.selectbox("Select a listing to review", listing_options)
-    
-    selected_listing_id = listings[listing_options.index(selected_listing)][0]
+
+    st.caption(f"{total} non-reviewed listings - page {len(cursors)}")
+    previous_col, next_col = st.columns(2)
+    if previous_col.button("Previous page", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    if next_col.button("Next page", disabled=next_cursor is None):
+        cursors.append(next_cursor)
+        st.rerun()
+
+    listing_labels = {listing[0]: f"Listing {listing[0]} - Location: ({listing[1]}, {listing[2]})"
+                                  + (f" - priority {listing[7]:g}" if listing[7] else "")
+                                  + (f" - {listing[-1]} duplicate(s)" if listing[-1] else "")
+                      for listing in listings}
+    selected_listing_id = st.selectbox("Select a listing to review", list(listing_labels), format_func=listing_labels.get)
     review_listing(selected_listing_id)
 
 # # Function to review a selected listing for admin users
@@ -410,21 +685,35 @@ def display_listings():
 #         c.execute("SELECT * FROM survey_images WHERE survey_id = ? AND image_type = ?", (listing_id, 'short_column_photo',))
 #         listing_data_2 = c.fetchone()
 #         display_image(listing_data_2[3], "Short Column Photo")
+@profiling.timed
 def review_listing(listing_id):
     st.header(f"Reviewing Listing ID: {listing_id}")
     
     # Fetch the initial form data for the listing
-    c.execute("SELECT * FROM survey_data WHERE id = ?", (listing_id,))
-    listing_data = c.fetchone()
+    with pool.connection() as conn:
+        listing_data = db.fetch_survey(conn, listing_id)
+        images = db.fetch_survey_images(conn, listing_id)
+        duplicates = db.fetch_duplicates(conn, listing_id)
 
     # Display the initial form data
     st.subheader("Initial Form Data")
 
+    # Other submissions of the same building are reviewed together with this one
+    if duplicates:
+        st.info(f"Other submissions of this building: {', '.join(f'Listing {dup}' for dup in duplicates)}")
+        unlink = st.multiselect("Not the same building", duplicates, key=f"unlink_{listing_id}")
+        if unlink and st.button("Unlink selected listings"):
+            with pool.transaction() as conn:
+                for duplicate_id in unlink:
+                    db.unlink_duplicate(conn, duplicate_id)
+            st.rerun()
+
     # Display location on map
     latitude = listing_data[1]
     longitude = listing_data[2]
     st.write("**Location:**", f"Latitude: {latitude}, Longitude: {longitude}")
-    m = folium.Map(location=[latitude, longitude], zoom_start=16)
+    m = folium.Map(location=[latitude, longitude], zoom_start=16, tiles=tiles.TILE_URL,
+                   attr=tiles.ATTRIBUTION)
     folium.Marker([latitude, longitude], popup="Building Location").add_to(m)
     st_folium(m, width=700, height=250)
 
@@ -434,147 +723,126 @@ def review_listing(listing_id):
     #     'lon': [listing_data[2]],
     # }))
 
-    use_type = st.selectbox("Type of Use", ["Residential", "Industrial", "Concentrated Audience", "Public Building", "Emergency Building"], index=["Residential", "Industrial", "Concentrated Audience", "Public Building", "Emergency Building"].index(listing_data[3]))
-    num_users = st.selectbox("Number of Users", ["0-10", "11-100", "100+"], index=["0-10", "11-100", "100+"].index(listing_data[4]))
-    importance_category = st.selectbox("Building Importance Category", ["Σ1", "Σ2", "Σ3", "Σ4"], index=["Σ1", "Σ2", "Σ3", "Σ4"].index(listing_data[5]))
+    use_type = st.selectbox("Type of Use", survey_options.USE_TYPES, index=survey_options.USE_TYPES.index(listing_data[3]))
+    num_users = st.selectbox("Number of Users", survey_options.NUM_USERS, index=survey_options.NUM_USERS.index(listing_data[4]))
+    importance_category = st.selectbox("Building Importance Category", survey_options.IMPORTANCE_CATEGORIES, index=survey_options.IMPORTANCE_CATEGORIES.index(listing_data[5]))
     
     # Danger of non-structural element falling
-    danger_falling = st.selectbox("Danger of Non-Structural Element Falling", ["No", "Yes"], index=["No", "Yes"].index(listing_data[6]))
+    danger_falling = st.selectbox("Danger of Non-Structural Element Falling", survey_options.YES_NO, index=survey_options.YES_NO.index(listing_data[6]))
 
-    # Show the existing photo if provided for falling danger
+    # Show the existing photos if provided for falling danger
     if danger_falling == "Yes":
-        c.execute("SELECT image FROM survey_images WHERE survey_id = ? AND image_type = 'falling_photo'", (listing_id,))
-        falling_photo = c.fetchone()
-        if falling_photo:
-            st.image(falling_photo[0], caption="Non-Structural Element Falling", use_container_width=True)
+        display_gallery("survey_images", images.get('falling_photo', []), "Non-Structural Element Falling", key=f"falling_photo_{listing_id}")
 
     num_floors = st.number_input("Number of Floors", min_value=1, max_value=100, step=1, value=listing_data[7])
-    structure_condition = st.selectbox("Condition of Structure", ["No", "Corrosion/Spalling"], index=["No", "Corrosion/Spalling"].index(listing_data[8]))
+    structure_condition = st.selectbox("Condition of Structure", survey_options.STRUCTURE_CONDITIONS, index=survey_options.STRUCTURE_CONDITIONS.index(listing_data[8]))
 
-    # Show the existing photo if provided for structure condition
+    # Show the existing photos if provided for structure condition
     if structure_condition == "Corrosion/Spalling":
-        c.execute("SELECT image FROM survey_images WHERE survey_id = ? AND image_type = 'rust_photo'", (listing_id,))
-        rust_photo = c.fetchone()
-        if rust_photo:
-            st.image(rust_photo[0], caption="Rust/Spalling Condition", use_container_width=True)
+        display_gallery("survey_images", images.get('rust_photo', []), "Rust/Spalling Condition", key=f"rust_photo_{listing_id}")
 
     year_construction = st.number_input("Year of Construction", min_value=1800, max_value=2024, step=1, value=listing_data[9])
-    vertical_damage = st.selectbox("Previous Damages in Vertical Elements", ["No", "Yes"], index=["No", "Yes"].index(listing_data[10]))
+    vertical_damage = st.selectbox("Previous Damages in Vertical Elements", survey_options.YES_NO, index=survey_options.YES_NO.index(listing_data[10]))
 
-    # Show the existing photo if provided for vertical damage
+    # Show the existing photos if provided for vertical damage
     if vertical_damage == "Yes":
-        c.execute("SELECT image FROM survey_images WHERE survey_id = ? AND image_type = 'damage_photo'", (listing_id,))
-        damage_photo = c.fetchone()
-        if damage_photo:
-            st.image(damage_photo[0], caption="Vertical Element Damage", use_container_width=True)
+        display_gallery("survey_images", images.get('damage_photo', []), "Vertical Element Damage", key=f"damage_photo_{listing_id}")
 
-    danger_impact = st.selectbox("Danger of Impact with Neighboring Buildings", ["No", "Yes"], index=["No", "Yes"].index(listing_data[11]))
+    danger_impact = st.selectbox("Danger of Impact with Neighboring Buildings", survey_options.YES_NO, index=survey_options.YES_NO.index(listing_data[11]))
 
-    # Show the existing photo if provided for impact with neighboring buildings
+    # Show the existing photos if provided for impact with neighboring buildings
     if danger_impact == "Yes":
-        c.execute("SELECT image FROM survey_images WHERE survey_id = ? AND image_type = 'impact_photo'", (listing_id,))
-        impact_photo = c.fetchone()
-        if impact_photo:
-            st.image(impact_photo[0], caption="Impact with Neighboring Building", use_container_width=True)
+        display_gallery("survey_images", images.get('impact_photo', []), "Impact with Neighboring Building", key=f"impact_photo_{listing_id}")
 
-    soft_floor = st.selectbox("Soft Floor (Pilotis)", ["No", "Yes"], index=["No", "Yes"].index(listing_data[12]))
+    soft_floor = st.selectbox("Soft Floor (Pilotis)", survey_options.YES_NO, index=survey_options.YES_NO.index(listing_data[12]))
 
-    # Show the existing photo if provided for soft floor
+    # Show the existing photos if provided for soft floor
     if soft_floor == "Yes":
-        c.execute("SELECT image FROM survey_images WHERE survey_id = ? AND image_type = 'soft_floor_photo'", (listing_id,))
-        soft_floor_photo = c.fetchone()
-        if soft_floor_photo:
-            st.image(soft_floor_photo[0], caption="Soft Floor (Pilotis)", use_container_width=True)
+        display_gallery("survey_images", images.get('soft_floor_photo', []), "Soft Floor (Pilotis)", key=f"soft_floor_photo_{listing_id}")
 
-    short_column = st.selectbox("Short Column", ["No", "Yes"], index=["No", "Yes"].index(listing_data[13]))
+    short_column = st.selectbox("Short Column", survey_options.YES_NO, index=survey_options.YES_NO.index(listing_data[13]))
 
-    # Show the existing photo if provided for short column
+    # Show the existing photos if provided for short column
     if short_column == "Yes":
-        c.execute("SELECT image FROM survey_images WHERE survey_id = ? AND image_type = 'short_column_photo'", (listing_id,))
-        short_column_photo = c.fetchone()
-        if short_column_photo:
-            st.image(short_column_photo[0], caption="Short Column", use_container_width=True)
+        display_gallery("survey_images", images.get('short_column_photo', []), "Short Column", key=f"short_column_photo_{listing_id}")
 
     if st.button("Submit Changes"):
         # Update the survey_data with the modified data
-        c.execute('''UPDATE survey_data SET 
-                        use_type = ?, num_users = ?, importance_category = ?, danger_falling = ?, num_floors = ?, 
-                        structure_condition = ?, year_construction = ?, vertical_damage = ?, danger_impact = ?, 
-                        soft_floor = ?, short_column = ? WHERE id = ?''',
-                  (use_type, num_users, importance_category, danger_falling, num_floors, structure_condition, year_construction,
-                   vertical_damage, danger_impact, soft_floor, short_column, listing_id))
-
-        conn.commit()
+        survey = {"use_type": use_type, "num_users": num_users, "importance_category": importance_category,
+                  "danger_falling": danger_falling, "num_floors": num_floors,
+                  "structure_condition": structure_condition, "year_construction": year_construction,
+                  "vertical_damage": vertical_damage, "danger_impact": danger_impact,
+                  "soft_floor": soft_floor, "short_column": short_column}
+        with pool.transaction() as conn:
+            db.update_survey(conn, listing_id, survey)
         st.success("Changes submitted successfully!")
 
     # Additional Review Form
     st.subheader("Review Form")
 
-    structural_system = st.selectbox("Type of Structural System", ["RC-frames", "RC-walls", "Brick walls"])
-    arrangement_walls = st.selectbox("Arrangement of Walls", ["No", "Yes"])
+    structural_system = st.selectbox("Type of Structural System", survey_options.STRUCTURAL_SYSTEMS)
+    arrangement_walls = st.selectbox("Arrangement of Walls", survey_options.YES_NO)
 
-    irregular_vertical = st.selectbox("Irregular Structures Vertically", ["No", "Yes"])
-    irregular_vertical_photo = None
+    irregular_vertical = st.selectbox("Irregular Structures Vertically", survey_options.YES_NO)
+    irregular_vertical_photo = []
     if irregular_vertical == "Yes":
-        irregular_vertical_photo = st.file_uploader("Upload photo of vertical irregularity", type=["jpg", "png", "jpeg"])
+        irregular_vertical_photo = st.file_uploader("Upload photo of vertical irregularity", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
 
-    irregular_horizontal = st.selectbox("Irregular Structures Horizontally", ["No", "Yes"])
-    irregular_horizontal_photo = None
+    irregular_horizontal = st.selectbox("Irregular Structures Horizontally", survey_options.YES_NO)
+    irregular_horizontal_photo = []
     if irregular_horizontal == "Yes":
-        irregular_horizontal_photo = st.file_uploader("Upload photo of horizontal irregularity", type=["jpg", "png", "jpeg"])
+        irregular_horizontal_photo = st.file_uploader("Upload photo of horizontal irregularity", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
 
-    torsion_rotation = st.selectbox("Torsion/Rotation", ["No", "Yes"])
-    torsion_rotation_photo = None
+    torsion_rotation = st.selectbox("Torsion/Rotation", survey_options.YES_NO)
+    torsion_rotation_photo = []
     if torsion_rotation == "Yes":
-        torsion_rotation_photo = st.file_uploader("Upload photo of torsion/rotation", type=["jpg", "png", "jpeg"])
+        torsion_rotation_photo = st.file_uploader("Upload photo of torsion/rotation", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
 
-    structural_vulnerabilities = st.multiselect("Structural Vulnerabilities", ["Danger of impact", "Soft floor", "Short column"])
+    structural_vulnerabilities = st.multiselect("Structural Vulnerabilities", survey_options.STRUCTURAL_VULNERABILITIES)
 
-    heavy_finishes = st.selectbox("Heavy Finishes", ["No", "Yes"])
-    heavy_finishes_photo = None
+    heavy_finishes = st.selectbox("Heavy Finishes", survey_options.YES_NO)
+    heavy_finishes_photo = []
     if heavy_finishes == "Yes":
-        heavy_finishes_photo = st.file_uploader("Upload photo of heavy finishes", type=["jpg", "png", "jpeg"])
+        heavy_finishes_photo = st.file_uploader("Upload photo of heavy finishes", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
 
     input_quality = st.slider("Quality of User Input (1-5)", min_value=1, max_value=5)
 
-    soil_class = st.selectbox("Soil Class", ["A", "B", "C"])
+    soil_class = st.selectbox("Soil Class", survey_options.SOIL_CLASSES)
 
-    load_capacity_reduction = st.selectbox("Load Bearing Capacity Reduction (R)", ["Flexural cracks", "Multiple flexural cracks", "Diagonal cracks", "Bending reinforcement"])
+    load_capacity_reduction = st.selectbox("Load Bearing Capacity Reduction (R)", survey_options.LOAD_CAPACITY_REDUCTIONS)
 
     constructed_area = st.number_input("Total Constructed Area")
-    constructed_area_photo = st.file_uploader("Upload photo showing constructed area", type=["jpg", "png", "jpeg"])
+    constructed_area_photo = st.file_uploader("Upload photo showing constructed area", type=["jpg", "png", "jpeg"], accept_multiple_files=True)
 
     structure_performance = st.text_area("Additional Description of Structure Performance")
 
-    retrofitting_methods = st.multiselect("Retrofitting Methods", ["Retrofitting RC-nodes", "Retrofitting RC-beams", "Polyurethane joints", "FRPU jackets"])
+    retrofitting_methods = st.multiselect("Retrofitting Methods", survey_options.RETROFITTING_METHODS)
 
     if st.button("Submit Review"):
-        # Resize images if any
-        if irregular_vertical_photo:
-            irregular_vertical_photo = resize_image(irregular_vertical_photo)
-        if irregular_horizontal_photo:
-            irregular_horizontal_photo = resize_image(irregular_horizontal_photo)
-        if torsion_rotation_photo:
-            torsion_rotation_photo = resize_image(torsion_rotation_photo)
-        if heavy_finishes_photo:
-            heavy_finishes_photo = resize_image(heavy_finishes_photo)
-        if constructed_area_photo:
-            constructed_area_photo = resize_image(constructed_area_photo)
-        
-        # Insert the review data into the database
-        c.execute('''INSERT INTO review_data (
-                        survey_id, structural_system, arrangement_walls, irregular_vertical, irregular_vertical_photo,
-                        irregular_horizontal, irregular_horizontal_photo, torsion_rotation, torsion_rotation_photo,
-                        structural_vulnerabilities, heavy_finishes, heavy_finishes_photo, input_quality, soil_class,
-                        load_capacity_reduction, constructed_area, constructed_area_photo, structure_performance, retrofitting_methods, reviewed
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                  (listing_id, structural_system, arrangement_walls, irregular_vertical, irregular_vertical_photo,
-                   irregular_horizontal, irregular_horizontal_photo, torsion_rotation, torsion_rotation_photo,
-                   ','.join(structural_vulnerabilities), heavy_finishes, heavy_finishes_photo, input_quality, soil_class,
-                   load_capacity_reduction, constructed_area, constructed_area_photo, structure_performance, ','.join(retrofitting_methods),
-                   st.session_state.get("logged_in", False)))
-        
-        conn.commit()
+        images = [irregular_vertical_photo, irregular_horizontal_photo, torsion_rotation_photo,
+                  heavy_finishes_photo, constructed_area_photo]
+        review = {"structural_system": structural_system, "arrangement_walls": arrangement_walls,
+                  "irregular_vertical": irregular_vertical, "irregular_horizontal": irregular_horizontal,
+                  "torsion_rotation": torsion_rotation, "structural_vulnerabilities": structural_vulnerabilities,
+                  "heavy_finishes": heavy_finishes, "input_quality": input_quality, "soil_class": soil_class,
+                  "load_capacity_reduction": load_capacity_reduction, "constructed_area": constructed_area,
+                  "structure_performance": structure_performance, "retrofitting_methods": retrofitting_methods}
+        uploads = dict(zip(survey_options.REVIEW_IMAGE_TYPES, images))
+        reviewed = st.session_state.get("logged_in", False)
+        reviewer = st.session_state.get("reviewer", "").strip() or None
+        try:
+            if submissions is not None:
+                confirm_queued(submissions.submit_review(listing_id, review, uploads, reviewed, reviewer),
+                               "Listing reviewed and data saved successfully!")
+                return
+            surveys.submit_review(pool, store, listing_id, review, uploads, reviewed, reviewer)
+        except ValidationError as e:
+            st.error("; ".join(e.errors))
+            return
+        except surveys.Claimed as e:
+            st.error(f"{e}; pick another listing.")
+            return
+
         st.success("Listing reviewed and data saved successfully!")
 
 
@@ -582,13 +850,22 @@ def review_listing(listing_id):
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
 
-admin_login()
-# register_user()
-# user_login()
-
-# Only show listings if the user is logged in as admin
-if st.session_state.logged_in:
-    display_listings()
-    display_data_visualization()
-else:
-    display_initial_form()
\ No newline at end of file
+# st.rerun() and st.stop() end the script by raising, so the profile is finished in
+# a finally block; otherwise those reruns would never reach the metrics log
+try:
+    admin_login()
+    # register_user()
+    # user_login()
+
+    # Only show listings if the user is logged in as admin
+    if st.session_state.logged_in:
+        display_overview_map()
+        display_listings()
+        display_data_visualization()
+        display_export()
+    else:
+        display_initial_form()
+finally:
+    profiler = profiling.finish()
+if profiler is not None and st.session_state.logged_in:
+    display_diagnostics(profiler)
@@ -0,0 +1,82 @@
+import threading
+
+import migrations
+
+
+# Counters kept in survey_stats by the triggers of migration 8, as
+# (dimension, bucket expression, condition). The list is frozen with that migration;
+# bulk imports count their rows with the same one.
+COUNTERS = migrations.STATS_COUNTERS
+
+# Dimensions whose buckets are numbers and should be ordered numerically
+NUMERIC_DIMENSIONS = {"decade", "floors"}
+
+GENERATION_SQL = "SELECT count FROM survey_stats WHERE dimension = 'meta' AND bucket = 'generation'"
+
+# Bumped on every write to review_data, including reviews of already reviewed surveys
+REVIEW_GENERATION_SQL = "SELECT count FROM survey_stats WHERE dimension = 'meta' AND bucket = 'reviews'"
+
+
+# Bumped by every trigger, so readers can tell whether their cached copy is stale
+_BUMP_GENERATION = ("INSERT INTO survey_stats (dimension, bucket, count) VALUES ('meta', 'generation', 1) "
+                    "ON CONFLICT (dimension, bucket) DO UPDATE SET count = count + 1")
+
+
+# Function to return the review generation; cached review listings keyed on it are
+# dropped as soon as any review is written
+def review_generation(conn):
+    row = conn.execute(REVIEW_GENERATION_SQL).fetchone()
+    return row[0] if row else 0
+
+
+# Function to count surveys inserted while survey_stats_insert was disabled, e.g. by
+# a bulk import: one grouped pass over the id range instead of a trigger per row
+def add_surveys(conn, first_id, last_id):
+    for dimension, bucket, condition in COUNTERS:
+        conn.execute(f"INSERT INTO survey_stats (dimension, bucket, count) "
+                     f"SELECT '{dimension}', {bucket.format(row='survey_data')}, COUNT(*) FROM survey_data "
+                     f"WHERE id BETWEEN ? AND ? AND {condition.format(row='survey_data')} GROUP BY 2 "
+                     f"ON CONFLICT (dimension, bucket) DO UPDATE SET count = count + excluded.count",
+                     (first_id, last_id))
+    conn.execute(_BUMP_GENERATION)
+
+
+# Function to read all summaries as {dimension: {bucket: count}}
+def load(conn):
+    data = {}
+    for dimension, bucket, count in conn.execute("SELECT dimension, bucket, count FROM survey_stats "
+                                                 "WHERE dimension != 'meta' AND count > 0"):
+        data.setdefault(dimension, {})[bucket] = count
+    for dimension in NUMERIC_DIMENSIONS & data.keys():
+        data[dimension] = dict(sorted(data[dimension].items(), key=lambda item: _numeric_key(item[0])))
+    total = data.get("total", {}).get("surveys", 0)
+    reviewed = data.get("review_status", {}).get("Reviewed", 0)
+    data["review_status"] = {"Reviewed": reviewed, "Pending": max(total - reviewed, 0)}
+    return data
+
+
+def _numeric_key(bucket):
+    try:
+        return 0, int(bucket)
+    except ValueError:
+        return 1, 0
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+# Function to get the summaries of a pooled database. The process keeps one copy per
+# database and reloads it only when the triggers have bumped the generation since.
+def get_stats(pool):
+    with pool.connection() as conn:
+        row = conn.execute(GENERATION_SQL).fetchone()
+        generation = row[0] if row else 0
+        with _cache_lock:
+            cached = _cache.get(pool.path)
+        if cached and cached[0] == generation:
+            return cached[1]
+        data = load(conn)
+    with _cache_lock:
+        _cache[pool.path] = (generation, data)
+    return data
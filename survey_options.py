@@ -0,0 +1,35 @@
+# Answer options of the survey and review forms, shared by the Streamlit pages and
+# every other path that reads or writes surveys
+
+USE_TYPES = ["Residential", "Industrial", "Concentrated Audience", "Public Building", "Emergency Building"]
+NUM_USERS = ["0-10", "11-100", "100+"]
+IMPORTANCE_CATEGORIES = ["Σ1", "Σ2", "Σ3", "Σ4"]
+YES_NO = ["No", "Yes"]
+STRUCTURE_CONDITIONS = ["No", "Corrosion/Spalling"]
+
+MIN_FLOORS, MAX_FLOORS = 1, 100
+MIN_YEAR, MAX_YEAR = 1800, 2024
+
+# survey_data columns holding a hazard answer, and the answer that flags the hazard
+HAZARD_COLUMNS = {
+    "danger_falling": "Yes",
+    "structure_condition": "Corrosion/Spalling",
+    "vertical_damage": "Yes",
+    "danger_impact": "Yes",
+    "soft_floor": "Yes",
+    "short_column": "Yes",
+}
+
+# Photo questions of the survey form, as stored in survey_images.image_type
+SURVEY_IMAGE_TYPES = ["falling_photo", "rust_photo", "damage_photo", "impact_photo", "soft_floor_photo",
+                      "short_column_photo"]
+
+STRUCTURAL_SYSTEMS = ["RC-frames", "RC-walls", "Brick walls"]
+STRUCTURAL_VULNERABILITIES = ["Danger of impact", "Soft floor", "Short column"]
+SOIL_CLASSES = ["A", "B", "C"]
+LOAD_CAPACITY_REDUCTIONS = ["Flexural cracks", "Multiple flexural cracks", "Diagonal cracks", "Bending reinforcement"]
+RETROFITTING_METHODS = ["Retrofitting RC-nodes", "Retrofitting RC-beams", "Polyurethane joints", "FRPU jackets"]
+
+# Photo questions of the review form, as stored in review_images.image_type
+REVIEW_IMAGE_TYPES = ["irregular_vertical_photo", "irregular_horizontal_photo", "torsion_rotation_photo",
+                      "heavy_finishes_photo", "constructed_area_photo"]
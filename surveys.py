@@ -0,0 +1,117 @@
+# Write path for surveys and reviews, shared by the Streamlit pages and the HTTP
+# API so both validate, store photos and insert the same way.
+
+import db
+import spatial
+from survey_options import REVIEW_IMAGE_TYPES, SURVEY_IMAGE_TYPES
+from validation import ValidationError, validate_review, validate_survey
+
+
+class NotFound(LookupError):
+    """Raised when a photo or review targets a survey or review that does not exist."""
+
+
+class Claimed(Exception):
+    """Raised when a review targets a listing another reviewer holds a claim on."""
+
+
+# Function to resize and store uploads given as {image type: [file-like objects]}.
+# Returns (image type, ordinal, hash) rows. ingest needs Pillow, so it is imported here.
+def store_uploads(store, uploads):
+    if not any(uploads.values()):
+        return []
+    import ingest
+
+    files = (((img_type, ordinal), upload)
+             for img_type, photos in uploads.items()
+             for ordinal, upload in enumerate(photos or []))
+    return [(img_type, ordinal, store.put(*result))
+            for (img_type, ordinal), result in ingest.iter_process_images(files)]
+
+
+def _check_image_types(uploads, allowed):
+    unknown = [img_type for img_type, photos in uploads.items() if photos and img_type not in allowed]
+    if unknown:
+        raise ValidationError([f"unknown photo type {img_type!r}" for img_type in unknown])
+
+
+# Function to validate a survey and store its photos, the work that needs no write
+# lock. Returns (survey, image rows) ready for save_survey().
+def prepare_survey(store, record, uploads=None):
+    uploads = uploads or {}
+    survey = validate_survey(record)
+    _check_image_types(uploads, SURVEY_IMAGE_TYPES)
+    return survey, store_uploads(store, uploads)
+
+
+# Function to insert a prepared survey inside the caller's write transaction, linked
+# to any earlier survey of the same building. Returns (survey id, duplicate_of).
+def save_survey(conn, survey, images):
+    duplicate_of = spatial.find_duplicate(conn, survey["latitude"], survey["longitude"])
+    return db.insert_survey(conn, dict(survey, duplicate_of=duplicate_of), images), duplicate_of
+
+
+# Function to validate and save a survey with its photos. Photos are processed
+# before the write lock is taken, so other writers are not kept waiting.
+# Returns (survey id, duplicate_of).
+def submit_survey(pool, store, record, uploads=None):
+    survey, images = prepare_survey(store, record, uploads)
+    with pool.transaction() as conn:
+        return save_survey(conn, survey, images)
+
+
+# Function to validate a review and store its photos. Returns (review, image rows)
+# ready for save_review().
+def prepare_review(store, record, uploads=None):
+    uploads = uploads or {}
+    review = validate_review(record)
+    _check_image_types(uploads, REVIEW_IMAGE_TYPES)
+    return review, store_uploads(store, uploads)
+
+
+# Function to raise Claimed if another reviewer than ``reviewer`` holds an active
+# claim on a survey. Without a reviewer, claims are not checked.
+def check_claim(conn, survey_id, reviewer):
+    if reviewer is None:
+        return
+    holder = db.claim_holder(conn, survey_id)
+    if holder not in (None, reviewer):
+        raise Claimed(f"survey {survey_id} is claimed by {holder}")
+
+
+# Function to save a prepared review of ``survey_id`` inside the caller's write
+# transaction, replacing any earlier review of it, and release the claim on the
+# listing. A ``reviewer`` may not review a listing someone else has claimed.
+# Returns the review id.
+def save_review(conn, survey_id, review, images, reviewed=True, reviewer=None):
+    if db.fetch_survey(conn, survey_id) is None:
+        raise NotFound(f"survey {survey_id} does not exist")
+    check_claim(conn, survey_id, reviewer)
+    review_id = db.insert_review(conn, dict(review, survey_id=survey_id, reviewed=reviewed), images)
+    db.release_claim(conn, survey_id)
+    return review_id
+
+
+# Function to validate and save a review of a survey with its photos. Returns the review id.
+def submit_review(pool, store, survey_id, record, uploads=None, reviewed=True, reviewer=None):
+    with pool.connection() as conn:
+        if db.fetch_survey(conn, survey_id) is None:
+            raise NotFound(f"survey {survey_id} does not exist")
+        check_claim(conn, survey_id, reviewer)
+    review, images = prepare_review(store, record, uploads)
+    with pool.transaction() as conn:
+        return save_review(conn, survey_id, review, images, reviewed, reviewer)
+
+
+# Function to add one photo to a submitted survey or review. ``table`` is
+# survey_images or review_images. Returns (ordinal, hash).
+def add_photo(pool, store, table, owner_id, image_type, upload):
+    allowed = SURVEY_IMAGE_TYPES if table == "survey_images" else REVIEW_IMAGE_TYPES
+    _check_image_types({image_type: [upload]}, allowed)
+    fetch = db.fetch_survey if table == "survey_images" else db.fetch_review
+    with pool.connection() as conn:
+        if fetch(conn, owner_id) is None:
+            raise NotFound(f"{db.IMAGE_OWNERS[table][:-3]} {owner_id} does not exist")
+    (_, _, image_hash), = store_uploads(store, {image_type: [upload]})
+    with pool.transaction() as conn:
+        return db.add_image(conn, table, owner_id, image_type, image_hash), image_hash
@@ -0,0 +1,202 @@
+import argparse
+import os
+
+import changes
+import db
+import image_store
+
+
+# Changes applied per transaction. Progress is committed with each batch, so an
+# interrupted sync resumes after the last batch that was applied.
+BATCH_SIZE = 500
+
+# Tables whose rows reference a photo in the image store
+PHOTO_TABLES = ("survey_images", "review_images")
+
+
+class Replica:
+    """A survey database and the image store its photo rows point to."""
+
+    def __init__(self, pool, store):
+        self.pool = pool
+        self.store = store
+        with pool.connection() as conn:
+            self.id = changes.database_id(conn)
+
+
+def _read_row(conn, table, row_id):
+    return conn.execute(f"SELECT {', '.join(changes.TRACKED[table])} FROM {table} WHERE id = ?",
+                        (row_id,)).fetchone()
+
+
+# Function to copy a photo and its thumbnail to another store unless it already has
+# them. Returns True if anything was copied.
+def copy_photo(source, target, digest):
+    if digest in target and os.path.exists(target.path(digest, thumbnail=True)):
+        return False
+    try:
+        data = source.read(digest)
+    except FileNotFoundError:
+        return False
+    try:
+        thumbnail = source.read(digest, thumbnail=True)
+    except FileNotFoundError:
+        thumbnail = None
+    target.put(data, thumbnail)
+    return True
+
+
+class _Applier:
+    """Applies the changes of one source database to a target inside the target's
+    transaction, translating row ids between the two."""
+
+    def __init__(self, source, target, source_conn, target_conn):
+        self.source, self.target = source, target
+        self.sconn, self.tconn = source_conn, target_conn
+
+    # Function to return the target id of a source row, or None if the target has
+    # never seen it. Rows the target sent to the source are mapped in the source.
+    def target_id(self, table, source_id):
+        row = self.tconn.execute("SELECT local_id FROM sync_ids WHERE peer = ? AND table_name = ? AND remote_id = ?",
+                                 (self.source.id, table, source_id)).fetchone()
+        if row is None:
+            row = self.sconn.execute("SELECT remote_id FROM sync_ids WHERE peer = ? AND table_name = ? "
+                                     "AND local_id = ?", (self.target.id, table, source_id)).fetchone()
+        return row[0] if row else None
+
+    # Function to translate a reference to a source row, sending that row first if
+    # the target does not have it yet
+    def reference(self, table, source_id):
+        if source_id is None:
+            return None
+        target_id = self.target_id(table, source_id)
+        if target_id is None:
+            row = _read_row(self.sconn, table, source_id)
+            target_id = self.upsert(table, source_id, row) if row else None
+        return target_id
+
+    # Function to insert or update the target copy of a source row. Returns its target id.
+    def upsert(self, table, source_id, row):
+        columns = changes.TRACKED[table]
+        values = dict(zip(columns, row))
+        for column, referenced in changes.REFERENCES[table].items():
+            values[column] = self.reference(referenced, values[column])
+        target_id = self.target_id(table, source_id)
+        if target_id is not None and not self.tconn.execute(f"SELECT 1 FROM {table} WHERE id = ?",
+                                                            (target_id,)).fetchone():
+            target_id = None
+        key = changes.UNIQUE_KEYS.get(table)
+        if target_id is None and key is not None:
+            row = self.tconn.execute(f"SELECT id FROM {table} WHERE {key} = ?", (values[key],)).fetchone()
+            if row is not None:
+                target_id = row[0]
+                self.tconn.execute("INSERT OR REPLACE INTO sync_ids (peer, table_name, local_id, remote_id) "
+                                   "VALUES (?, ?, ?, ?)", (self.source.id, table, target_id, source_id))
+        if target_id is not None:
+            self.tconn.execute(f"UPDATE {table} SET {', '.join(f'{col} = :{col}' for col in columns)} "
+                               f"WHERE id = :id", dict(values, id=target_id))
+        else:
+            # New to the target, or deleted there since: the target assigns its own id
+            cur = self.tconn.execute(f"INSERT INTO {table} ({', '.join(columns)}) "
+                                     f"VALUES ({', '.join(':' + col for col in columns)})", values)
+            target_id = cur.lastrowid
+            self.tconn.execute("INSERT OR REPLACE INTO sync_ids (peer, table_name, local_id, remote_id) "
+                               "VALUES (?, ?, ?, ?)", (self.source.id, table, target_id, source_id))
+        self._received(table, target_id)
+        return target_id
+
+    def delete(self, table, source_id):
+        target_id = self.target_id(table, source_id)
+        if target_id is None:
+            return False
+        self.tconn.execute(f"DELETE FROM {table} WHERE id = ?", (target_id,))
+        self.tconn.execute("DELETE FROM sync_ids WHERE peer = ? AND table_name = ? AND local_id = ?",
+                           (self.source.id, table, target_id))
+        self._received(table, target_id)
+        return True
+
+    # Function to mark a target row's latest change as received from the source, so
+    # it is not sent back on the next sync in the other direction
+    def _received(self, table, target_id):
+        self.tconn.execute("UPDATE change_log SET origin = ? WHERE table_name = ? AND row_id = ?",
+                           (self.source.id, table, target_id))
+
+
+# Function to apply every change of ``source`` that ``target`` has not received
+# yet, ``batch_size`` changes per transaction. Photos are copied before the rows
+# that reference them. ``progress`` is called with the counts after each batch.
+# Returns {"rows", "deleted", "photos"}.
+def transfer(source, target, batch_size=BATCH_SIZE, progress=None):
+    counts = {"rows": 0, "deleted": 0, "photos": 0}
+    with target.pool.connection() as conn:
+        row = conn.execute("SELECT received_seq FROM sync_state WHERE peer = ?", (source.id,)).fetchone()
+    seq = row[0] if row else 0
+    while True:
+        with source.pool.connection() as sconn:
+            batch = changes.changes_since(sconn, seq, target.id, batch_size)
+            rows = {(table, row_id): _read_row(sconn, table, row_id)
+                    for _, table, row_id, deleted in batch if not deleted}
+        if not batch:
+            return counts
+        for (table, _), row in rows.items():
+            if table in PHOTO_TABLES and row and row[changes.TRACKED[table].index("image_hash")]:
+                counts["photos"] += copy_photo(source.store, target.store,
+                                               row[changes.TRACKED[table].index("image_hash")])
+        with source.pool.connection() as sconn, target.pool.transaction() as tconn:
+            applier = _Applier(source, target, sconn, tconn)
+            for _, table, row_id, deleted in batch:
+                if deleted:
+                    counts["deleted"] += applier.delete(table, row_id)
+                elif rows[(table, row_id)] is not None:
+                    # A row deleted since the batch was read arrives later as a tombstone
+                    applier.upsert(table, row_id, rows[(table, row_id)])
+                    counts["rows"] += 1
+            seq = batch[-1][0]
+            tconn.execute("INSERT INTO sync_state (peer, received_seq) VALUES (?, ?) "
+                          "ON CONFLICT (peer) DO UPDATE SET received_seq = excluded.received_seq",
+                          (source.id, seq))
+        if progress:
+            progress(counts)
+
+
+# Function to exchange changes between a field database and the central one: local
+# changes are pushed first, then everything other devices sent is pulled.
+# Returns {"pushed": counts, "pulled": counts}.
+def sync(local, central, push=True, pull=True, batch_size=BATCH_SIZE, progress=None):
+    if local.id == central.id:
+        raise ValueError("both databases have the same identity; sync a database with its peer, not a copy of itself")
+    empty = {"rows": 0, "deleted": 0, "photos": 0}
+    return {"pushed": transfer(local, central, batch_size, progress) if push else empty,
+            "pulled": transfer(central, local, batch_size, progress) if pull else empty}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exchange survey changes with the central database.")
+    parser.add_argument("central", help="path of the central survey database, e.g. on a mounted share")
+    parser.add_argument("--central-store", help="image store of the central database; "
+                                                "by default the image_store directory next to it")
+    parser.add_argument("--db", default=db.DB_PATH, help="path of this device's survey database")
+    parser.add_argument("--store", default=image_store.IMAGE_STORE_DIR, help="image store of this device")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="changes applied per transaction")
+    direction = parser.add_mutually_exclusive_group()
+    direction.add_argument("--push-only", action="store_true", help="only send this device's changes")
+    direction.add_argument("--pull-only", action="store_true", help="only receive the central changes")
+    args = parser.parse_args(argv)
+
+    central_store = args.central_store or os.path.join(os.path.dirname(os.path.abspath(args.central)), "image_store")
+    local = Replica(db.get_pool(args.db), image_store.ImageStore(args.store))
+    central = Replica(db.get_pool(args.central), image_store.ImageStore(central_store))
+
+    def progress(counts):
+        print(f"\r{counts['rows']} rows, {counts['deleted']} deletions, {counts['photos']} photos",
+              end="", flush=True)
+
+    result = sync(local, central, not args.pull_only, not args.push_only, args.batch_size, progress)
+    for direction, counts in result.items():
+        print(f"\n{direction}: {counts['rows']} rows, {counts['deleted']} deletions, {counts['photos']} photos",
+              end="")
+    print()
+
+
+if __name__ == "__main__":
+    main()
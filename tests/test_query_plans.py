@@ -0,0 +1,33 @@
+import random
+
+import benchmark
+import db
+
+
+def _survey_db(path, count=200, seed=0):
+    rng = random.Random(seed)
+    pool = db.get_pool(str(path))
+    with pool.transaction() as conn:
+        for _ in range(count):
+            survey_id = db.insert_survey(conn, benchmark.synthetic_survey(rng), [])
+            if rng.random() < 0.3:
+                db.insert_review(conn, dict(benchmark.synthetic_review(rng), survey_id=survey_id, reviewed=1), [])
+    return pool
+
+
+# The hot queries of the review queue and listings must use their indexes
+def test_hot_queries_use_indexes(tmp_path):
+    pool = _survey_db(tmp_path / "plans.db")
+    with pool.connection() as conn:
+        assert db.check_query_plans(conn) == {}
+    pool.close()
+
+
+# A dropped index shows up as a full scan
+def test_missing_index_is_reported(tmp_path):
+    pool = _survey_db(tmp_path / "plans.db")
+    with pool.transaction() as conn:
+        conn.execute("DROP INDEX idx_survey_images_survey_type")
+    with pool.connection() as conn:
+        assert "survey_images" in db.check_query_plans(conn)
+    pool.close()
@@ -0,0 +1,12 @@
+import statistics
+
+import benchmark
+
+
+# The public form must not load the admin-only modules, and the app's own imports
+# must stay cheap both on a cold start and on a rerun
+def test_public_form_startup():
+    cold, own, rerun, missing, loaded = benchmark.measure_startup(repeat=3)
+    assert loaded == []
+    assert statistics.median(own) < benchmark.OWN_STARTUP_BUDGET_MS
+    assert statistics.median(rerun) < benchmark.RERUN_BUDGET_MS
@@ -0,0 +1,273 @@
+import argparse
+import math
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+
+# MBTiles file holding the cached basemap tiles
+TILE_DB_PATH = os.environ.get("BUILDING_SURVEY_TILE_DB", "tile_cache.mbtiles")
+
+OSM_TILE_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+
+# Where missing tiles are fetched from; point it at a local server to work offline
+TILE_UPSTREAM = os.environ.get("BUILDING_SURVEY_TILE_UPSTREAM", OSM_TILE_URL)
+
+# Tile URL the app's maps load, as seen from the surveyors' browsers. By default
+# they load OpenStreetMap directly, which works on any phone and over HTTPS but
+# bypasses the cache. The API server is not always running and its address is not
+# known here, so the cache is opt-in: to serve the maps from it, set this to the
+# public address of the API server's /tiles route, e.g.
+# https://survey.example.org/tiles/{z}/{x}/{y}.png.
+TILE_URL = os.environ.get("BUILDING_SURVEY_TILE_URL", OSM_TILE_URL)
+
+ATTRIBUTION = "&copy; <a href=\"https://www.openstreetmap.org/copyright\">OpenStreetMap</a> contributors"
+
+# Size at which least recently used tiles are evicted, down to EVICT_TO of it
+MAX_CACHE_BYTES = int(os.environ.get("BUILDING_SURVEY_TILE_CACHE_MB", 512)) * 1024 * 1024
+EVICT_TO = 0.9
+
+# Upstream requests in flight at once, shared by map requests and seeding; the
+# OpenStreetMap tile policy asks for no more than two
+UPSTREAM_CONCURRENCY = 2
+
+# Seconds to wait for one upstream tile
+UPSTREAM_TIMEOUT = 10
+
+# Identifies the proxy to the upstream, as tile servers require
+USER_AGENT = "building-survey-tile-cache/1.0"
+
+MAX_ZOOM = 19
+
+# Most tiles one seed run may request, about 1.5 GB of OpenStreetMap tiles
+MAX_SEED_TILES = 100000
+
+# A hit refreshes a tile's last use at most this often, so browsing a cached area
+# costs no writes
+TOUCH_INTERVAL = 3600
+
+
+class TileCache:
+    """Basemap tiles cached in an MBTiles file, fetched from the upstream on a miss.
+
+    Tiles are addressed by web-map z/x/y and stored with the flipped TMS row the
+    MBTiles format uses, so the file opens in any MBTiles viewer. Concurrent misses
+    of the same tile share one upstream request.
+    """
+
+    def __init__(self, path=TILE_DB_PATH, upstream=TILE_UPSTREAM, max_bytes=MAX_CACHE_BYTES,
+                 concurrency=UPSTREAM_CONCURRENCY):
+        self.upstream = upstream
+        self.max_bytes = max_bytes
+        self.concurrency = concurrency
+        self.pool = db.ConnectionPool(path)
+        with self.pool.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            conn.execute('''CREATE TABLE IF NOT EXISTS tiles (
+                            zoom_level INTEGER,
+                            tile_column INTEGER,
+                            tile_row INTEGER,
+                            tile_data BLOB,
+                            size INTEGER NOT NULL,
+                            last_used REAL NOT NULL
+                        )''')
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_tiles_last_used ON tiles (last_used)")
+            conn.executemany("INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)",
+                             [("name", "Building survey basemap cache"), ("format", "png"),
+                              ("type", "baselayer"), ("attribution", ATTRIBUTION)])
+            self._bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+        self._upstream = threading.BoundedSemaphore(concurrency)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    # Function to return a tile's PNG bytes, fetching and caching it on a miss.
+    # Returns None when the upstream cannot provide it.
+    def get(self, z, x, y):
+        if not valid_tile(z, x, y):
+            return None
+        data = self.cached(z, x, y)
+        return data if data is not None else self._fetch_once(z, x, y)
+
+    # Function to return a tile's PNG bytes if it is cached, without going upstream
+    def cached(self, z, x, y):
+        key = (z, x, (1 << z) - 1 - y)
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT tile_data, last_used FROM tiles "
+                               "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", key).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > TOUCH_INTERVAL:
+            with self.pool.transaction() as conn:
+                conn.execute("UPDATE tiles SET last_used = ? "
+                             "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (now, *key))
+        return row[0]
+
+    def __contains__(self, tile):
+        z, x, y = tile
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                (z, x, (1 << z) - 1 - y)).fetchone() is not None
+
+    # Function to fetch a missing tile, letting concurrent callers wait on the first
+    # caller's request instead of repeating it
+    def _fetch_once(self, z, x, y):
+        key = (z, x, (1 << z) - 1 - y)
+        with self._lock:
+            event = self._inflight.get(key)
+            owner = event is None
+            if owner:
+                event = self._inflight[key] = threading.Event()
+        if not owner:
+            event.wait(UPSTREAM_TIMEOUT * 2)
+            with self.pool.connection() as conn:
+                row = conn.execute("SELECT tile_data FROM tiles "
+                                   "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", key).fetchone()
+            return row[0] if row else None
+        try:
+            data = self.fetch(z, x, y)
+            if data is not None:
+                self.put(z, x, y, data)
+            return data
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    # Function to download one tile from the upstream within the concurrency limit.
+    # Returns None on any HTTP or network error.
+    def fetch(self, z, x, y):
+        request = urllib.request.Request(self.upstream.format(z=z, x=x, y=y), headers={"User-Agent": USER_AGENT})
+        with self._upstream:
+            try:
+                with urllib.request.urlopen(request, timeout=UPSTREAM_TIMEOUT) as response:
+                    return response.read()
+            except (urllib.error.URLError, OSError):
+                return None
+
+    def put(self, z, x, y, data):
+        with self.pool.transaction() as conn:
+            conn.execute('''INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data, size, last_used)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET
+                                tile_data = excluded.tile_data, size = excluded.size, last_used = excluded.last_used''',
+                         (z, x, (1 << z) - 1 - y, data, len(data), time.time()))
+        with self._lock:
+            self._bytes += len(data)
+            full = self._bytes > self.max_bytes
+        if full:
+            self.evict()
+
+    # Function to delete least recently used tiles until the cache is back under
+    # EVICT_TO of its size cap. Returns the number of tiles evicted.
+    def evict(self, max_bytes=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self.pool.transaction() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+            excess, doomed = total - int(max_bytes * EVICT_TO), []
+            if total > max_bytes:
+                for rowid, size in conn.execute("SELECT rowid, size FROM tiles ORDER BY last_used"):
+                    if excess <= 0:
+                        break
+                    doomed.append((rowid,))
+                    excess -= size
+                conn.executemany("DELETE FROM tiles WHERE rowid = ?", doomed)
+            self._bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+        return len(doomed)
+
+    # Function to download every tile of (south, west, north, east) for the zoom
+    # levels in ``zooms`` that is not cached yet. ``progress`` is called with
+    # (done, total). Returns (tiles fetched, tiles that failed).
+    def seed(self, bounds, zooms, progress=None):
+        tiles = [tile for tile in tiles_in_bounds(bounds, zooms) if tile not in self]
+        if len(tiles) > MAX_SEED_TILES:
+            raise ValueError(f"{len(tiles)} tiles to seed, more than {MAX_SEED_TILES}; narrow the area or zooms")
+        fetched = failed = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for done, data in enumerate(executor.map(lambda tile: self._fetch_once(*tile), tiles), start=1):
+                if data is None:
+                    failed += 1
+                else:
+                    fetched += 1
+                if progress:
+                    progress(done, len(tiles))
+        return fetched, failed
+
+    def stats(self):
+        with self.pool.connection() as conn:
+            count, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tiles").fetchone()
+        return {"tiles": count, "bytes": size, "max_bytes": self.max_bytes}
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)
+
+
+# Function to convert a latitude/longitude to the x/y of the web-map tile holding it
+def tile_of(lat, lon, z):
+    lat = max(min(lat, 85.0511), -85.0511)
+    n = 1 << z
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+# Function to list the (z, x, y) tiles covering (south, west, north, east) at each zoom
+def tiles_in_bounds(bounds, zooms):
+    south, west, north, east = bounds
+    for z in zooms:
+        min_x, min_y = tile_of(north, west, z)
+        max_x, max_y = tile_of(south, east, z)
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                yield z, x, y
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# Function to get the process-wide cache of an MBTiles file
+def get_cache(path=TILE_DB_PATH):
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = TileCache(path)
+        return cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the local basemap tile cache.")
+    parser.add_argument("--cache", default=TILE_DB_PATH, help="path of the MBTiles cache")
+    parser.add_argument("--upstream", default=TILE_UPSTREAM, help="tile URL template with {z}, {x} and {y}")
+    commands = parser.add_subparsers(dest="command", required=True)
+    seed = commands.add_parser("seed", help="download the tiles of an area ahead of field work")
+    seed.add_argument("--bounds", type=float, nargs=4, metavar=("SOUTH", "WEST", "NORTH", "EAST"), required=True)
+    seed.add_argument("--zoom", type=int, nargs=2, metavar=("MIN", "MAX"), default=(6, 14))
+    commands.add_parser("evict", help="shrink the cache to its size cap")
+    commands.add_parser("stats", help="show the number and size of cached tiles")
+    args = parser.parse_args(argv)
+
+    cache = TileCache(args.cache, args.upstream)
+    if args.command == "seed":
+        def progress(done, total):
+            if done % 100 == 0 or done == total:
+                print(f"\r{done}/{total} tiles", end="", flush=True)
+
+        fetched, failed = cache.seed(args.bounds, range(args.zoom[0], args.zoom[1] + 1), progress)
+        print(f"\nFetched {fetched} tiles, {failed} failed")
+    elif args.command == "evict":
+        print(f"Evicted {cache.evict()} tiles")
+    else:
+        stats = cache.stats()
+        print(f"{stats['tiles']} tiles, {stats['bytes'] / 1024 / 1024:.1f} of {stats['max_bytes'] / 1024 / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import math
+
+import survey_options
+
+
+class ValidationError(ValueError):
+    """Raised with every problem found in a record, not just the first."""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+# Answers of survey_data that must be one of the form's options
+SURVEY_CHOICES = {
+    "use_type": survey_options.USE_TYPES,
+    "num_users": survey_options.NUM_USERS,
+    "importance_category": survey_options.IMPORTANCE_CATEGORIES,
+    "danger_falling": survey_options.YES_NO,
+    "structure_condition": survey_options.STRUCTURE_CONDITIONS,
+    "vertical_damage": survey_options.YES_NO,
+    "danger_impact": survey_options.YES_NO,
+    "soft_floor": survey_options.YES_NO,
+    "short_column": survey_options.YES_NO,
+}
+
+# Numeric answers of survey_data as (type, minimum, maximum)
+SURVEY_NUMBERS = {
+    "latitude": (float, -90.0, 90.0),
+    "longitude": (float, -180.0, 180.0),
+    "num_floors": (int, survey_options.MIN_FLOORS, survey_options.MAX_FLOORS),
+    "year_construction": (int, survey_options.MIN_YEAR, survey_options.MAX_YEAR),
+}
+
+
+def _blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def _check_choices(record, choices, cleaned, errors):
+    for field, options in choices.items():
+        value = record.get(field)
+        value = value.strip() if isinstance(value, str) else value
+        if _blank(value):
+            errors.append(f"{field} is required")
+        elif value not in options:
+            errors.append(f"{field} must be one of {', '.join(options)} (got {value!r})")
+        else:
+            cleaned[field] = value
+
+
+def _check_number(record, field, kind, minimum, maximum, cleaned, errors, required=True):
+    value = record.get(field)
+    if _blank(value):
+        if required:
+            errors.append(f"{field} is required")
+        return
+    try:
+        number = float(value)
+    except (TypeError, ValueError, OverflowError):
+        errors.append(f"{field} must be a number (got {value!r})")
+        return
+    # inf and nan parse as floats but fit no column; inf would also overflow int()
+    if not math.isfinite(number):
+        errors.append(f"{field} must be a finite number (got {value!r})")
+        return
+    number = kind(number)
+    if kind is int and float(value) != number:
+        errors.append(f"{field} must be a whole number (got {value!r})")
+    elif not minimum <= number <= maximum:
+        errors.append(f"{field} must be between {minimum} and {maximum} (got {value!r})")
+    else:
+        cleaned[field] = number
+
+
+# Function to check a survey record against the options of the survey form and
+# return it with only the survey_data fields, converted to their column types
+def validate_survey(record):
+    cleaned, errors = {}, []
+    for field, (kind, minimum, maximum) in SURVEY_NUMBERS.items():
+        _check_number(record, field, kind, minimum, maximum, cleaned, errors)
+    _check_choices(record, SURVEY_CHOICES, cleaned, errors)
+    if errors:
+        raise ValidationError(errors)
+    return cleaned
+
+
+# Answers of review_data that must be one of the review form's options
+REVIEW_CHOICES = {
+    "structural_system": survey_options.STRUCTURAL_SYSTEMS,
+    "arrangement_walls": survey_options.YES_NO,
+    "irregular_vertical": survey_options.YES_NO,
+    "irregular_horizontal": survey_options.YES_NO,
+    "torsion_rotation": survey_options.YES_NO,
+    "heavy_finishes": survey_options.YES_NO,
+    "soil_class": survey_options.SOIL_CLASSES,
+    "load_capacity_reduction": survey_options.LOAD_CAPACITY_REDUCTIONS,
+}
+
+# Multi-select answers of review_data, stored comma-separated
+REVIEW_MULTI_CHOICES = {
+    "structural_vulnerabilities": survey_options.STRUCTURAL_VULNERABILITIES,
+    "retrofitting_methods": survey_options.RETROFITTING_METHODS,
+}
+
+
+# Function to check a review record against the options of the review form and
+# return it with only the review_data answers, multi-selects joined with commas
+def validate_review(record):
+    cleaned, errors = {}, []
+    _check_choices(record, REVIEW_CHOICES, cleaned, errors)
+    for field, options in REVIEW_MULTI_CHOICES.items():
+        value = record.get(field) or []
+        values = [item.strip() for item in value.split(",")] if isinstance(value, str) else list(value)
+        values = [item for item in values if not _blank(item)]
+        unknown = [item for item in values if item not in options]
+        if unknown:
+            errors.append(f"{field} must be among {', '.join(options)} (got {', '.join(map(str, unknown))})")
+        else:
+            cleaned[field] = ",".join(values)
+    _check_number(record, "input_quality", int, 1, 5, cleaned, errors)
+    _check_number(record, "constructed_area", float, 0.0, float("inf"), cleaned, errors, required=False)
+    cleaned.setdefault("constructed_area", 0.0)
+    performance = record.get("structure_performance")
+    cleaned["structure_performance"] = "" if performance is None else str(performance)
+    if errors:
+        raise ValidationError(errors)
+    return cleaned
@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+import db
+import surveys
+
+
+# Journal of submissions waiting to be written to the survey database. It is a
+# separate SQLite file, so appending never waits on the survey database's write lock.
+QUEUE_DB_PATH = os.environ.get("BUILDING_SURVEY_QUEUE_DB", "building_survey_queue.db")
+
+# Submissions go through the queue instead of being written in the request when set
+WRITE_BEHIND = os.environ.get("BUILDING_SURVEY_WRITE_BEHIND", "") not in ("", "0", "false")
+
+# Most submissions the writer applies in one transaction
+BATCH_SIZE = 500
+
+# Seconds the writer sleeps when nobody wakes it, to pick up entries appended by
+# other processes sharing the journal
+POLL_INTERVAL = 1.0
+
+# Seconds finished entries stay in the journal for status lookups
+RETENTION = 24 * 3600
+
+PENDING, DONE, FAILED = "pending", "done", "failed"
+
+
+# Function to apply one journal entry inside the writer's transaction. Returns the
+# id of the inserted survey or review.
+def _apply(conn, kind, payload):
+    images = [tuple(image) for image in payload["images"]]
+    if kind == "survey":
+        return surveys.save_survey(conn, payload["survey"], images)[0]
+    return surveys.save_review(conn, payload["survey_id"], payload["review"], images, payload["reviewed"],
+                               payload.get("reviewer"))
+
+
+class WriteQueue:
+    """Durable write-behind queue for survey and review submissions.
+
+    Submitting validates the record, stores its photos and appends it to the
+    journal, then returns a ticket at once. A single writer thread drains the
+    journal and applies as many submissions as are waiting in one transaction, so
+    a burst costs one commit instead of one per user. Each ticket's status can be
+    polled until the submission is persisted.
+    """
+
+    def __init__(self, pool, store, path=QUEUE_DB_PATH, batch_size=BATCH_SIZE):
+        self.pool = pool
+        self.store = store
+        self.batch_size = batch_size
+        self.journal = db.ConnectionPool(path)
+        with self.journal.connection() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS submissions (
+                            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                            ticket TEXT UNIQUE NOT NULL,
+                            kind TEXT NOT NULL,
+                            payload TEXT NOT NULL,
+                            status TEXT NOT NULL,
+                            result INTEGER,
+                            error TEXT,
+                            created_at REAL,
+                            finished_at REAL
+                        )''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_status ON submissions (status, seq)")
+        self._wake = threading.Event()
+        self._finished = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # Function to start the writer thread; entries left by a crash are applied first
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="survey-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _append(self, kind, payload):
+        ticket = uuid.uuid4().hex
+        with self.journal.transaction() as conn:
+            conn.execute("INSERT INTO submissions (ticket, kind, payload, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                         (ticket, kind, json.dumps(payload), PENDING, time.time()))
+        self._wake.set()
+        return ticket
+
+    # Function to queue a survey with its photos. Raises ValidationError like
+    # surveys.submit_survey(); returns the ticket of the submission.
+    def submit_survey(self, record, uploads=None):
+        survey, images = surveys.prepare_survey(self.store, record, uploads)
+        return self._append("survey", {"survey": survey, "images": images})
+
+    # Function to queue a review of ``survey_id`` with its photos. Raises Claimed
+    # like surveys.submit_review(); returns the ticket.
+    def submit_review(self, survey_id, record, uploads=None, reviewed=True, reviewer=None):
+        with self.pool.connection() as conn:
+            surveys.check_claim(conn, survey_id, reviewer)
+        review, images = surveys.prepare_review(self.store, record, uploads)
+        return self._append("review", {"survey_id": survey_id, "review": review, "images": images,
+                                       "reviewed": bool(reviewed), "reviewer": reviewer})
+
+    # Function to return {"status", "kind", "result", "error"} of a ticket, or None if unknown
+    def status(self, ticket):
+        with self.journal.connection() as conn:
+            row = conn.execute("SELECT status, kind, result, error FROM submissions WHERE ticket = ?",
+                               (ticket,)).fetchone()
+        return dict(zip(("status", "kind", "result", "error"), row)) if row else None
+
+    # Function to wait up to ``timeout`` seconds for a ticket to leave the pending
+    # state. Returns its final status, or the pending one on timeout.
+    def wait(self, ticket, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        with self._finished:
+            while True:
+                status = self.status(ticket)
+                remaining = deadline - time.monotonic()
+                if status is None or status["status"] != PENDING or remaining <= 0:
+                    return status
+                self._finished.wait(min(remaining, POLL_INTERVAL))
+
+    def pending(self):
+        with self.journal.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM submissions WHERE status = ?", (PENDING,)).fetchone()[0]
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                applied = self.drain()
+            except Exception:
+                # Keep the writer alive through a locked or briefly unavailable database
+                applied = 0
+                self._stopped.wait(POLL_INTERVAL)
+            if not applied:
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+
+    # Function to apply one batch of pending submissions. Each runs under a savepoint,
+    # so a failing entry is marked failed without losing the rest of the batch.
+    # Returns how many entries were processed.
+    def drain(self):
+        with self.journal.connection() as conn:
+            batch = conn.execute("SELECT ticket, kind, payload FROM submissions WHERE status = ? ORDER BY seq LIMIT ?",
+                                 (PENDING, self.batch_size)).fetchall()
+        if not batch:
+            return 0
+        outcomes = []
+        with self.pool.transaction() as conn:
+            for ticket, kind, payload in batch:
+                done = conn.execute("SELECT result FROM applied_submissions WHERE ticket = ?", (ticket,)).fetchone()
+                if done:
+                    outcomes.append((DONE, done[0], None, ticket))
+                    continue
+                conn.execute("SAVEPOINT submission")
+                try:
+                    result = _apply(conn, kind, json.loads(payload))
+                    conn.execute("INSERT INTO applied_submissions (ticket, result) VALUES (?, ?)", (ticket, result))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO submission")
+                    outcomes.append((FAILED, None, str(e), ticket))
+                else:
+                    outcomes.append((DONE, result, None, ticket))
+                conn.execute("RELEASE submission")
+        now = time.time()
+        with self.journal.transaction() as conn:
+            conn.executemany("UPDATE submissions SET status = ?, result = ?, error = ?, finished_at = ? "
+                             "WHERE ticket = ?", [(status, result, error, now, ticket)
+                                                  for status, result, error, ticket in outcomes])
+            conn.execute("DELETE FROM submissions WHERE status != ? AND finished_at < ?", (PENDING, now - RETENTION))
+        with self._finished:
+            self._finished.notify_all()
+        return len(batch)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+# Function to get the process-wide queue of a pooled database, with its writer running
+def get_queue(pool, store, path=QUEUE_DB_PATH):
+    with _queues_lock:
+        queue = _queues.get((pool.path, path))
+        if queue is None:
+            queue = _queues[(pool.path, path)] = WriteQueue(pool, store, path).start()
+        return queue